@@ -1,65 +1,184 @@
-from ADCPi import ADCPi
-from time import sleep
-
-adc = ADCPi(0x68, 0x69, 18)
-
-Sensors = {
-    "A1": 1,
-    "A2": 2,
-    "A3": 3,
-    "B1": 4,
-    "B2": 5,
-    "B3": 6
-}
-
-# Initial 2024 calibration
-# SensorCalibration = {"dry": {"A1": 0.911, "A2": 0.747,
-#                              "A3": 0.774, "B1": 0.836,
-#                              "B2": 0.645, "B3": 0.799},
-#                      "wet": {"A1": 0.612, "A2": 0.513,
-#                              "A3": 0.494, "B1": 0.613,
-#                              "B2": 0.472, "B3": 0.593}}
-
-# Calibration on 23 Jan 2025
-SensorCalibration = {"dry": {"A1": 0.980, "A2": 0.869,
-                             "A3": 0.868, "B1": 0.988,
-                             "B2": 0.849, "B3": 0.960},
-                     "wet": {"A1": 0.617, "A2": 0.457,
-                             "A3": 0.497, "B1": 0.626,
-                             "B2": 0.447, "B3": 0.569}}
-
-
-print("Sensors initialized")
+import heapq
+import statistics
+import threading
+import hardware
+import metrics
+from hardware import ADCTimeoutError, clock
+from i2cBus import i2c_lock
+
+from zones import zones
+from calibration import calibrations
+
+# ADC Pi boards, opened on first use
+adcs = {}
+adc_lock = threading.Lock()
+
+# Sensor channel of each container, from zones.json
+Sensors = {c_id: (zones.adc_board[i], zones.channel[i])
+           for i, c_id in enumerate(zones.ids)}
+
+# Calibrations by date, including the initial 2024 one and the current one,
+# are in calibrations.json (see calibration.py)
+
+
+# Sampling plan used by get_raw_sensor_values, per channel:
+#   samples: max number of samples
+#   min_samples: samples taken before the channel may stop early
+#   tolerance: the channel stops once the standard error of its samples
+#              (volts) is at or below this
+#   interval: spacing in seconds between two samples of the same channel
+# Channels missing from SamplingPlan use the defaults.
+default_num_samples = 10
+default_min_samples = 3
+default_tolerance = 0.002
+default_sample_interval = 0.5
+SamplingPlan = {}
+
+adc_read_seconds = metrics.histogram(
+    "irrigation_adc_read_seconds", "Duration of one ADC read", ["container"])
+adc_samples = metrics.counter(
+    "irrigation_adc_samples_total", "Successful ADC reads", ["container"])
+adc_timeouts = metrics.counter(
+    "irrigation_adc_timeouts_total", "ADC reads that timed out", ["container"])
+sensor_std_error = metrics.gauge(
+    "irrigation_sensor_std_error_volts", "Standard error of the samples of the last sweep", ["container"])
+sweep_duration = metrics.histogram(
+    "irrigation_sensor_sweep_seconds", "Duration of a sweep over the soil sensors")
+
+# A read slower than read_deadline (seconds) counts as a timeout. A channel
+# gives up after max_timeouts, and no read starts later than
+# sweep_time_budget seconds after the start of a sweep. The duration of a
+# read is only checked once it returns: a read that hangs is cut by the
+# conversion timeout of the ADC driver (hardware.adc_conversion_timeout, with
+# ADCPi versions having set_conversion_timeout), not by read_deadline.
+read_deadline = 1.0
+max_timeouts = 3
+sweep_time_budget = 30
+
+
+def get_adc(board):
+    # Open the ADC board on first use
+    with adc_lock:
+        if board not in adcs:
+            adcs[board] = hardware.get_adc(board)
+            print(f"Sensors of ADC board {board} initialized")
+    return adcs[board]
 
 
 def get_one_raw_sensor_value(sensor_id):
-    return round(adc.read_voltage(Sensors[sensor_id]), 4)
+    i = zones.index[sensor_id]
+    with i2c_lock:
+        return round(get_adc(zones.adc_board[i]).read_voltage(zones.channel[i]), 4)
 
 
 def get_raw_sensor_value(sensor_id):
-    total = 0
-    num_samples = 10
-    successful_attempts = 0
-
-    # Take readings
-    for _ in range(num_samples):
-        try:
-            total += get_one_raw_sensor_value(sensor_id)
-            successful_attempts += 1
-            sleep(0.5)
-        except ADCPi.TimeoutError:  # Correctly reference TimeoutError
+    values, _ = get_raw_sensor_values([sensor_id])
+    return values[sensor_id]
+
+
+def get_raw_sensor_values(sensor_ids, sampling_plan=None):
+    """Read several channels in one interleaved sweep.
+
+    Every sample of every channel is placed on a shared timeline and the
+    channel that is due next is read, so the pause between two samples of
+    one channel is spent reading the others. Reads stay serialized on the
+    I2C bus.
+
+    A channel stops as soon as it has min_samples and the standard error of
+    its samples is within tolerance, so stable channels finish after a few
+    samples while noisy ones take up to samples. Its value is the median of
+    the samples, which ignores single spikes. Reads slower than
+    read_deadline (checked when the read returns) count as timeouts, a
+    channel gives up after max_timeouts
+    and the sweep starts no read after sweep_time_budget.
+
+    sampling_plan maps sensor_id to {"samples", "min_samples", "tolerance",
+    "interval"} and falls back to SamplingPlan and the defaults.
+
+    Returns (values, timings). values maps sensor_id to the median voltage,
+    or None when no read succeeded. timings maps sensor_id to the number of
+    samples and timeouts, the variance and standard error of the samples,
+    the time spent on the bus and the time from the start of the sweep to
+    the last sample of that channel.
+    """
+    if sampling_plan is None:
+        sampling_plan = {}
+
+    plan = {}
+    timings = {}
+    samples = {}
+    due = []
+    for order, sensor_id in enumerate(sensor_ids):
+        channel_plan = {"samples": default_num_samples, "min_samples": default_min_samples,
+                        "tolerance": default_tolerance, "interval": default_sample_interval}
+        channel_plan.update(SamplingPlan.get(sensor_id, {}))
+        channel_plan.update(sampling_plan.get(sensor_id, {}))
+        plan[sensor_id] = channel_plan
+        timings[sensor_id] = {"samples": 0, "timeouts": 0, "variance": None,
+                              "std_error": None, "read_seconds": 0.0, "elapsed_seconds": 0.0}
+        samples[sensor_id] = []
+        if channel_plan["samples"] > 0:
+            due.append((0.0, order, sensor_id))
+    heapq.heapify(due)
+
+    sweep_start = clock.monotonic()
+    while due:
+        due_time, order, sensor_id = heapq.heappop(due)
+        if due_time > sweep_time_budget:
             print(
-                f"TimeoutError: Could not read sensor {sensor_id}. Retrying...")
-
-    # Avoid division by zero
-    if successful_attempts > 0:
-        average_value = round(total / successful_attempts, 4)
-        print(
-            f"Sensor {sensor_id} - Successful attempts: {successful_attempts}, Average value: {average_value}")
-        return average_value
-    else:
-        print(f"Sensor {sensor_id} - No successful attempts. Returning None.")
-        return None
+                f"Sensor sweep time budget of {sweep_time_budget}s used up, {len(due) + 1} channel(s) stopped early")
+            break
+        wait = sweep_start + due_time - clock.monotonic()
+        if wait > 0:
+            clock.sleep(wait)
+
+        timing = timings[sensor_id]
+        read_start = clock.monotonic()
+        try:
+            value = get_one_raw_sensor_value(sensor_id)
+            if clock.monotonic() - read_start > read_deadline:
+                raise ADCTimeoutError(f"read took longer than {read_deadline}s")
+            samples[sensor_id].append(value)
+            timing["samples"] += 1
+            adc_samples.inc(container=sensor_id)
+            next_due = read_start - sweep_start + plan[sensor_id]["interval"]
+        except ADCTimeoutError as e:
+            timing["timeouts"] += 1
+            adc_timeouts.inc(container=sensor_id)
+            print(f"TimeoutError: Could not read sensor {sensor_id} ({e})")
+            next_due = read_start - sweep_start
+        read_end = clock.monotonic()
+        timing["read_seconds"] += read_end - read_start
+        adc_read_seconds.observe(read_end - read_start, container=sensor_id)
+        timing["elapsed_seconds"] = read_end - sweep_start
+
+        n = timing["samples"]
+        if n >= 2:
+            timing["variance"] = statistics.variance(samples[sensor_id])
+            timing["std_error"] = (timing["variance"] / n) ** 0.5
+        if n >= plan[sensor_id]["samples"] or timing["timeouts"] >= max_timeouts:
+            continue
+        if n >= max(2, plan[sensor_id]["min_samples"]) and timing["std_error"] <= plan[sensor_id]["tolerance"]:
+            continue
+        heapq.heappush(due, (next_due, order, sensor_id))
+
+    values = {}
+    for sensor_id in sensor_ids:
+        values[sensor_id] = round(statistics.median(
+            samples[sensor_id]), 4) if samples[sensor_id] else None
+
+    sweep_seconds = clock.monotonic() - sweep_start
+    sweep_duration.observe(sweep_seconds)
+    print(f"Sensor sweep of {len(values)} channels took {sweep_seconds:.1f}s")
+    for sensor_id, timing in timings.items():
+        if timing["std_error"] is not None:
+            sensor_std_error.set(timing["std_error"], container=sensor_id)
+        std_error = f"{timing['std_error']:.4f}" if timing["std_error"] is not None else "-"
+        print(f"Sensor {sensor_id} - samples: {timing['samples']}, timeouts: {timing['timeouts']}, "
+              f"std error: {std_error}, bus time: {timing['read_seconds']:.2f}s, "
+              f"done after: {timing['elapsed_seconds']:.2f}s, median value: {values[sensor_id]}")
+
+    return values, timings
 
 
 def get_sensor_percent_wet(container_id):
@@ -67,28 +186,28 @@ def get_sensor_percent_wet(container_id):
     return get_calibrated_value(container_id, val)
 
 
-def get_calibrated_value(container_id, sensor_value):
-    dry = SensorCalibration['dry'][container_id]
-    wet = SensorCalibration['wet'][container_id]
-    return round(min(1, max(0, (sensor_value-dry)/(wet-dry))), 4)
+def get_calibrated_value(container_id, sensor_value, temperature=None):
+    # Curve of the calibration in effect, temperature compensated when the
+    # curve has a coefficient and the room temperature is given
+    curve = calibrations.set_at(clock.time()).curve(container_id)
+    return curve.value(sensor_value, temperature)
 
 
 def test():
     print(", ".join(Sensors))
     while True:
         sensor_data = []
-        for channel_name, pin in Sensors.items():
-            sensor_value = get_raw_sensor_value(channel_name)
+        sensor_values, _ = get_raw_sensor_values(list(Sensors))
+        for channel_name, sensor_value in sensor_values.items():
             sensor_data.append(str(sensor_value))
 
-        for channel_name, pin in Sensors.items():
-            sensor_value = get_raw_sensor_value(channel_name)
+        for channel_name, sensor_value in sensor_values.items():
             sensor_data.append(
                 str(get_calibrated_value(channel_name, sensor_value)))
 
         print(", ".join(sensor_data))
 
-        sleep(1)
+        clock.sleep(1)
 
 
 if __name__ == "__main__":
@@ -1,44 +1,51 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
-import RPi.GPIO as GPIO
 from time import sleep
 import time
 import signal
 import sys
 import atexit
-
-Pumps = {
-    "A1": 22,
-    "A2": 23,
-    "A3": 24,
-    "B1": 26,
-    "B2": 20,
-    "B3": 21
-}
-
-PumpsCalibration = {"100ml_seconds": {"A1": 85.3, "A2": 119.3,
-                                      "A3": 137.7, "B1": 85.3,
-                                      "B2": 107.3, "B3": 98.8}}
-
-
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-
-for channel_id, pin in Pumps.items():
-    GPIO.setup(pin, GPIO.OUT)
-
-print("Pumps initialized")
+import threading
+import hardware
+from zones import zones
+
+# GPIO bank and pin and calibration of each pump, from zones.json
+Pumps = {c_id: (zones.gpio_bank[i], zones.pin[i])
+         for i, c_id in enumerate(zones.ids)}
+PumpsCalibration = {"100ml_seconds": dict(zip(zones.ids, zones.seconds_per_100ml))}
+
+# GPIO bank of each zone, indexed by zone number once set up
+gpio = None
+gpio_lock = threading.Lock()
+
+
+def get_gpio():
+    # Set up the pump outputs of every bank on first use, with every pump stopped
+    global gpio
+    with gpio_lock:
+        if gpio is None:
+            pump_gpio = [hardware.get_gpio(bank) for bank in zones.gpio_bank]
+            for i, bank_gpio in enumerate(pump_gpio):
+                bank_gpio.setup_output(zones.pin[i])
+                bank_gpio.write(zones.pin[i], True)
+            # Register the cleanup function with atexit
+            atexit.register(cleanup)
+            gpio = pump_gpio
+            print(f"Pumps initialized ({len(zones)} pumps on {len(zones.gpio_banks)} GPIO bank(s))")
+    return gpio
 
 # HIGH = STOP PUMP
 # LOW = START PUMP
 
 
 def start_pump(channel_id):
-    GPIO.output(Pumps[channel_id], GPIO.LOW)
+    i = zones.index[channel_id]
+    get_gpio()[i].write(zones.pin[i], False)
 
 
 def stop_pump(channel_id):
-    GPIO.output(Pumps[channel_id], GPIO.HIGH)
+    i = zones.index[channel_id]
+    get_gpio()[i].write(zones.pin[i], True)
 
 
 def start_all_pumps():
@@ -73,41 +80,31 @@ def test_pumps_simultaneously():
 
 
 def seconds_for_pump(channel_id, ml):
-    seconds_for_100ml = PumpsCalibration["100ml_seconds"][channel_id]
+    seconds_for_100ml = zones.seconds_per_100ml[zones.index[channel_id]]
     seconds_required = seconds_for_100ml / 100 * ml
     return seconds_required
 
 
 def seconds_to_ml(channel_id, seconds):
-    seconds_for_100ml = PumpsCalibration["100ml_seconds"][channel_id]
+    seconds_for_100ml = zones.seconds_per_100ml[zones.index[channel_id]]
     ml = (seconds / seconds_for_100ml) * 100
     return ml
 
 
-stop_all_pumps()
-
-
 def cleanup():
     stop_all_pumps()
 
 
-# Register the cleanup function with atexit
-atexit.register(cleanup)
-
-
 def signal_handler(sig, frame):
     print("Signal received:", sig)
     cleanup()
     sys.exit(0)  # Exit the program
 
 
-# Register the signal handler for termination signals
-signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
-signal.signal(signal.SIGTERM, signal_handler)  # Handle kill command
-
-
 if __name__ == "__main__":
-    #     pass
+    # Register the signal handler for termination signals
+    signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
+    signal.signal(signal.SIGTERM, signal_handler)  # Handle kill command
 
     try:
         start_time = time.time()
@@ -4,26 +4,19 @@
 # Adafruit CircuitPython library
 
 import time
-import board
-import adafruit_sht4x
-
-i2c = board.I2C()   # uses board.SCL and board.SDA
-sht = adafruit_sht4x.SHT4x(i2c)
-print("Found SHT4x with serial number", hex(sht.serial_number))
-
-sht.mode = adafruit_sht4x.Mode.NOHEAT_HIGHPRECISION
-# Can also set the mode to enable heater
-# sht.mode = adafruit_sht4x.Mode.LOWHEAT_100MS
-print("Current mode is: ", adafruit_sht4x.Mode.string[sht.mode])
+import hardware
+from i2cBus import i2c_lock
 
 
 def getTemperatureHumiditySHT40():
-    temperature, relative_humidity = sht.measurements
+    with i2c_lock:
+        # The sensor is opened on first use
+        temperature, relative_humidity = hardware.get_sht40().measurements()
     return temperature, relative_humidity
 
 def test():
     while True:
-        temperature, relative_humidity = sht.measurements
+        temperature, relative_humidity = getTemperatureHumiditySHT40()
         print("Temperature: %0.1f°C" % temperature, "Humidity: %0.1f %%" % relative_humidity)
         time.sleep(1)
 
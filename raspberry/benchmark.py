@@ -0,0 +1,295 @@
+# Benchmarks of the controller hot paths
+# Runs on the simulated backend against synthetic pump histories (1k to 1M
+# doses) and zone configs (6 to 200 containers), and writes the results as
+# JSON. Compared with a baseline, any case slower than the baseline by more
+# than the threshold is reported and the exit status is 1.
+#
+# Usage:
+#   python3 benchmark.py --output baseline.json
+#   python3 benchmark.py --baseline baseline.json --threshold 0.25
+#   python3 benchmark.py --quick --profile /tmp/cycle.prof
+#
+# To profile one cycle of a live run instead, start main.py with
+# IRRIGATION_PROFILE_CYCLE=/tmp/cycle.prof.
+
+import argparse
+import cProfile
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Before importing the controller modules, which open the hardware backend
+os.environ.setdefault("IRRIGATION_BACKEND", "sim")
+os.environ.setdefault("IRRIGATION_METRICS_PORT", "0")
+
+from control import ml_allowed, watering_thresholds  # noqa: E402
+from hardware import clock  # noqa: E402
+from helpers import EnviroSnapshot  # noqa: E402
+from historyStore import HistoryStore  # noqa: E402
+from log import log_add_entry, log_initialize  # noqa: E402
+from pumpHistory import PumpHistory  # noqa: E402
+from sendToServer import build_payload, build_record  # noqa: E402
+from zones import make_config  # noqa: E402
+
+container_counts = [6, 50, 200]
+history_entries = [1000, 10000, 100000, 1000000]
+quick_container_counts = [6, 50]
+quick_history_entries = [1000, 10000]
+# Entries of the history used by the cases that do not depend on its length
+cycle_history_entries = 10000
+
+# Simulated seconds per real second in the cycle case: sensor sample spacing
+# costs little real time while the history windows stay meaningful
+cycle_sim_speed = 1000
+
+# Each measurement repeats the case until it took at least this long
+min_measure_seconds = 0.05
+
+
+def measure(function, repeat):
+    """Median and min wall and CPU time of one call of function."""
+    start = time.perf_counter()
+    function()
+    number = max(1, int(min_measure_seconds / max(time.perf_counter() - start, 1e-9)))
+
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(number):
+            function()
+        wall.append((time.perf_counter() - wall_start) / number)
+        cpu.append((time.process_time() - cpu_start) / number)
+    return {"seconds": statistics.median(wall), "min_seconds": min(wall),
+            "cpu_seconds": statistics.median(cpu), "repeat": repeat, "number": number}
+
+
+def container_ids(num_containers):
+    return [zone["id"] for zone in make_config(num_containers)["zones"]]
+
+
+def synthetic_history(containers, entries, now):
+    """PumpHistory holding entries doses spread over the largest window."""
+    history = PumpHistory(containers, max(watering_thresholds))
+    per_container = max(1, entries // len(containers))
+    span = max(watering_thresholds) * 3600 - 60
+    step = span / per_container
+    data = {}
+    for c_id in containers:
+        times = [now - span + i * step for i in range(per_container)]
+        data[c_id] = {"compacted_ml": 0.0, "times": times,
+                      "cumulative": [10.0 * (i + 1) for i in range(per_container)]}
+    history.load_dict(data)
+    return history
+
+
+def synthetic_reading(containers, now):
+    values = {c_id: {'tgt': 0.8, 'raw': 0.7123, 'pct': 0.5432} for c_id in containers}
+    enviro = EnviroSnapshot(
+        timestamp=now,
+        datetime_string=datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"),
+        datetime_utc_string=datetime.fromtimestamp(
+            now, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        cpu_temp=45.1, room_temp_SHT40=21.3, room_humidity_SHT40=45.2,
+        room_temp_BMP280=21.6, room_pressure_BMP280=1013.2)
+    return values, enviro
+
+
+def history_cases(num_containers, entries, repeat):
+    containers = container_ids(num_containers)
+    now = clock.time()
+    history = synthetic_history(containers, entries, now)
+    snapshot = json.dumps(history.to_dict())
+
+    def allowed_all():
+        # watering_allowed_ml_time_based for every container of a cycle
+        for c_id in containers:
+            ml_allowed(history.window_sums(c_id, watering_thresholds, now), 0.8, 30)
+
+    def add_all():
+        for c_id in containers:
+            history.add(c_id, 10.0)
+
+    def load():
+        PumpHistory(containers, max(watering_thresholds)).load_dict(json.loads(snapshot))
+
+    return {"watering_allowed": measure(allowed_all, repeat),
+            "history_add": measure(add_all, repeat),
+            "history_load": measure(load, max(1, repeat // 3))}
+
+
+def output_cases(num_containers, repeat, directory):
+    containers = container_ids(num_containers)
+    now = clock.time()
+    history = synthetic_history(containers, cycle_history_entries, now)
+    values, enviro = synthetic_reading(containers, now)
+    log_path = os.path.join(directory, f"log_{num_containers}.csv")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        log_initialize(containers, log_path)
+    store = HistoryStore(os.path.join(directory, f"history_{num_containers}"))
+
+    def log_entry():
+        log_add_entry(containers, values, enviro, log_path, history, store)
+
+    def payload():
+        json.dumps(build_payload([build_record(values, enviro, history, containers)]))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = {"log_add_entry": measure(log_entry, repeat)}
+    results["build_payload"] = measure(payload, repeat)
+    return results
+
+
+def cycle_case(num_containers, repeat, directory, profile_path=None):
+    """Full cycle of main.py, in a child process using num_containers zones."""
+    zones_path = os.path.join(directory, f"zones_{num_containers}.json")
+    with open(zones_path, "w") as f:
+        json.dump(make_config(num_containers), f)
+    env = dict(os.environ, IRRIGATION_BACKEND="sim", IRRIGATION_ZONES=zones_path,
+               IRRIGATION_SIM_SPEED=str(cycle_sim_speed), IRRIGATION_METRICS_PORT="0",
+               IRRIGATION_LOG_DIR=os.path.join(directory, f"cycle_{num_containers}"))
+    command = [sys.executable, os.path.abspath(__file__), "--cycle-worker",
+               "--repeat", str(repeat)]
+    if profile_path:
+        command += ["--profile", profile_path]
+    result = subprocess.run(command, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Cycle benchmark failed:\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def cycle_worker(repeat, profile_path):
+    # Runs in the child process started by cycle_case
+    import main
+    os.makedirs(main.log_directory, exist_ok=True)
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        log_initialize(main.Containers, main.local_filepath_log)
+        main.history_store = HistoryStore(main.history_store_directory)
+        main.pump_journal.load()
+        main.pump_history.load_dict(synthetic_history(
+            main.Containers, cycle_history_entries, clock.time()).to_dict())
+        # Log writes run on the I/O workers as in main.py, so the cycle times
+        # are those of the scheduler thread
+        main.io_pool.start()
+
+        def sense():
+            # Every container is read, as when all of them are changing
+            main.sensing_schedule.wake()
+            main.sense()
+
+        def cycle():
+            sense()
+            main.control()
+            main.log_reading()
+            json.dumps(build_payload([build_record(
+                main.latest_reading["values"], main.latest_reading["enviro"],
+                main.pump_history, main.Containers)]))
+
+        cycle()  # opens the simulated devices
+        results["cycle_sense"] = measure(sense, repeat)
+        # Control and logging only act on a new reading, so the reading is
+        # marked unseen before each run
+        for name, function in {"control": main.control, "logging": main.log_reading}.items():
+            def run(name=name, function=function):
+                main.reading_seen_by[name] = 0
+                function()
+            results[f"cycle_{name}"] = measure(run, repeat)
+        results["cycle"] = measure(cycle, repeat)
+
+        if profile_path:
+            profiler = cProfile.Profile()
+            profiler.runcall(cycle)
+            profiler.dump_stats(profile_path)
+        main.io_pool.stop()
+        main.pump_journal.close()
+    print(json.dumps(results))
+
+
+def run_benchmarks(args):
+    counts = quick_container_counts if args.quick else container_counts
+    entries_list = quick_history_entries if args.quick else history_entries
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for num_containers in counts:
+            for entries in entries_list:
+                for name, result in history_cases(num_containers, entries, args.repeat).items():
+                    results[f"{name}/containers={num_containers}/entries={entries}"] = result
+                print(f"history cases: {num_containers} containers, {entries} entries done")
+            for name, result in output_cases(num_containers, args.repeat, directory).items():
+                results[f"{name}/containers={num_containers}"] = result
+            profile_path = None
+            if args.profile:
+                root, extension = os.path.splitext(args.profile)
+                profile_path = f"{root}_{num_containers}{extension or '.prof'}"
+            for name, result in cycle_case(num_containers, args.repeat, directory, profile_path).items():
+                results[f"{name}/containers={num_containers}"] = result
+            print(f"output and cycle cases: {num_containers} containers done")
+            if profile_path:
+                print(f"Profile of one cycle written to {profile_path}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Cases whose min time grew by more than threshold over the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["min_seconds"] / baseline[name]["min_seconds"]
+        if ratio > 1 + threshold:
+            regressions.append((name, baseline[name]["min_seconds"], result["min_seconds"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the controller hot paths")
+    parser.add_argument("--quick", action="store_true",
+                        help="only 6 and 50 containers and up to 10k history entries")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown counted as a regression")
+    parser.add_argument("--profile", help="cProfile one full cycle per container count")
+    parser.add_argument("--cycle-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cycle_worker:
+        cycle_worker(args.repeat, args.profile)
+        return
+
+    results = run_benchmarks(args)
+    report = {"version": 1, "created": datetime.now(timezone.utc).isoformat(),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "results": results}
+
+    print(f"{'case':<60} {'median ms':>10} {'min ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<60} {result['seconds'] * 1000:>10.3f} {result['min_seconds'] * 1000:>10.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after, ratio in regressions:
+            print(f"REGRESSION {name}: {before * 1000:.3f} ms -> {after * 1000:.3f} ms ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression above {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
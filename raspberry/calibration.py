@@ -0,0 +1,446 @@
+# Soil sensor calibration
+# calibrations.json keeps every calibration of the sensors as a set of
+# curves per container with the UTC date from which it applies. Readings are
+# converted with the set in effect at their time, so percentages stored
+# before a recalibration can be re-derived from the raw voltages.
+#
+# Curve types:
+#   linear: {"dry": volts, "wet": volts}, 0 at dry and 1 at wet
+#   points: {"raw": [volts, ...], "pct": [0..1, ...]}, piecewise linear
+#           through measured points
+#   any curve can add {"temperature_coefficient": volts per degree C,
+#                      "reference_temperature": degrees C (default 20)};
+#           the raw value is first corrected to the reference temperature
+#           with the room temperature (SHT40) of the reading
+#
+# The set in effect is the one place of the current calibration: the
+# controller and the simulated sensors read it. Containers missing from a set
+# use the dry/wet of their zone in zones.json, which only synthetic zones
+# set; a container with neither is a load error.
+# IRRIGATION_CALIBRATIONS selects another file.
+#
+# Curves can be fitted from calibration measurements, as in
+# sensor_calibration.xlsx, exported as CSV with the columns
+# container,raw,pct[,temperature] (pct 0 for dry soil and 1 for wet soil).
+#
+# Usage:
+#   python3 calibration.py fit measurements.csv --type points
+#   python3 calibration.py store log/history log/history.recalibrated
+#   python3 calibration.py csv log/log.csv log/log_recalibrated.csv
+#
+# Recalibrating history uses numpy (pip3 install numpy); the controller does
+# not need it.
+
+import argparse
+import csv
+import json
+import math
+import os
+import shutil
+import time
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+from zones import zones
+
+calibrations_file_path = os.environ.get(
+    "IRRIGATION_CALIBRATIONS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibrations.json"))
+
+default_reference_temperature = 20.0
+
+# Lookup tables map raw values rounded to table_step volts (the precision of
+# the logged raw values) from 0 to table_max volts
+table_step = 0.0001
+table_max = 5.0
+
+# Column of the history store and log.csv holding the temperature used for
+# temperature compensation
+temperature_column = "room_temp_SHT40"
+temperature_csv_header = "room temp C (SHT40)"
+
+
+def clamp(value):
+    return round(min(1, max(0, value)), 4)
+
+
+class Curve:
+    """Conversion of a raw sensor voltage to a 0..1 moisture fraction."""
+
+    def __init__(self, temperature_coefficient=0.0,
+                 reference_temperature=default_reference_temperature):
+        self.temperature_coefficient = temperature_coefficient
+        self.reference_temperature = reference_temperature
+        self.table = None
+
+    def corrected(self, raw, temperature):
+        if not self.temperature_coefficient or temperature is None:
+            return raw
+        return raw - self.temperature_coefficient * (temperature - self.reference_temperature)
+
+    def value(self, raw, temperature=None):
+        return clamp(self.fraction(self.corrected(raw, temperature)))
+
+    def fraction(self, raw):
+        raise NotImplementedError
+
+    def raw_at(self, fraction):
+        # Raw value at the reference temperature giving fraction, for the
+        # simulated sensors
+        raise NotImplementedError
+
+    def fractions(self, raws):
+        # numpy array version of fraction()
+        raise NotImplementedError
+
+    def lookup_table(self):
+        import numpy as np
+        if self.table is None:
+            grid = np.arange(0, table_max + table_step / 2, table_step)
+            self.table = np.round(np.clip(self.fractions(grid), 0, 1), 4)
+        return self.table
+
+    def values(self, raws, temperatures=None):
+        """Fractions of numpy arrays of raw values (NaN where missing) and
+        temperatures, through the lookup table."""
+        import numpy as np
+        raws = np.asarray(raws, dtype=float)
+        if self.temperature_coefficient and temperatures is not None:
+            temperatures = np.asarray(temperatures, dtype=float)
+            correction = self.temperature_coefficient * (temperatures - self.reference_temperature)
+            # Rows without a temperature are not corrected
+            raws = raws - np.where(np.isnan(correction), 0, correction)
+        table = self.lookup_table()
+        missing = np.isnan(raws)
+        indices = np.rint(np.where(missing, 0, raws) / table_step)
+        indices = np.clip(indices, 0, len(table) - 1).astype(np.intp)
+        return np.where(missing, np.nan, table[indices])
+
+    def to_dict(self):
+        data = {}
+        if self.temperature_coefficient:
+            data["temperature_coefficient"] = round(self.temperature_coefficient, 6)
+            data["reference_temperature"] = self.reference_temperature
+        return data
+
+
+class LinearCurve(Curve):
+    def __init__(self, dry, wet, **compensation):
+        super().__init__(**compensation)
+        self.dry = dry
+        self.wet = wet
+
+    def fraction(self, raw):
+        return (raw - self.dry) / (self.wet - self.dry)
+
+    def fractions(self, raws):
+        return (raws - self.dry) / (self.wet - self.dry)
+
+    def raw_at(self, fraction):
+        return self.dry + (self.wet - self.dry) * fraction
+
+    def to_dict(self):
+        return dict(type="linear", dry=round(self.dry, 4), wet=round(self.wet, 4),
+                    **super().to_dict())
+
+
+class PointsCurve(Curve):
+    def __init__(self, raw, pct, **compensation):
+        super().__init__(**compensation)
+        if len(raw) != len(pct) or len(raw) < 2:
+            raise ValueError("A points curve needs at least 2 raw/pct pairs")
+        points = sorted(zip(raw, pct))
+        self.raw = [r for r, _ in points]
+        self.pct = [p for _, p in points]
+
+    def fraction(self, raw):
+        # Constant beyond the first and last points
+        i = bisect_right(self.raw, raw)
+        if i == 0:
+            return self.pct[0]
+        if i == len(self.raw):
+            return self.pct[-1]
+        r0, r1 = self.raw[i - 1], self.raw[i]
+        p0, p1 = self.pct[i - 1], self.pct[i]
+        return p0 + (p1 - p0) * (raw - r0) / (r1 - r0)
+
+    def fractions(self, raws):
+        import numpy as np
+        return np.interp(raws, self.raw, self.pct)
+
+    def raw_at(self, fraction):
+        # Points ordered by pct, the first one of a flat segment
+        points = sorted(zip(self.pct, self.raw))
+        i = bisect_right([p for p, _ in points], fraction)
+        if i == 0:
+            return points[0][1]
+        if i == len(points):
+            return points[-1][1]
+        (p0, r0), (p1, r1) = points[i - 1], points[i]
+        return r0 + (r1 - r0) * (fraction - p0) / (p1 - p0)
+
+    def to_dict(self):
+        return dict(type="points", raw=[round(r, 4) for r in self.raw],
+                    pct=[round(p, 4) for p in self.pct], **super().to_dict())
+
+
+curve_types = {"linear": LinearCurve, "points": PointsCurve}
+
+
+def make_curve(data):
+    data = dict(data)
+    kind = data.pop("type", "linear")
+    if kind not in curve_types:
+        raise ValueError(f"Unknown calibration curve type {kind}")
+    return curve_types[kind](**data)
+
+
+def zone_curve(container_id):
+    i = zones.index[container_id]
+    if math.isnan(zones.dry[i]) or math.isnan(zones.wet[i]):
+        return None
+    return LinearCurve(zones.dry[i], zones.wet[i])
+
+
+def epoch(date_time):
+    return datetime.fromisoformat(date_time).replace(tzinfo=timezone.utc).timestamp()
+
+
+class CalibrationSet:
+    def __init__(self, name, effective, curves):
+        self.name = name
+        self.effective = effective
+        self.effective_time = epoch(effective)
+        self.curves = curves
+
+    def curve(self, container_id):
+        curve = self.curves.get(container_id)
+        if curve is None and container_id in zones.index:
+            # Kept so the zone curve and its lookup table are built once
+            curve = self.curves[container_id] = zone_curve(container_id)
+        return curve
+
+    def check(self):
+        for c_id in zones.ids:
+            if self.curve(c_id) is None:
+                raise ValueError(f"Container {c_id} has no curve in calibration set "
+                                 f"{self.name} and no dry/wet in zones.json")
+
+
+class Calibrations:
+    """Calibration sets ordered by effective date."""
+
+    def __init__(self, sets):
+        self.sets = sorted(sets, key=lambda s: s.effective_time)
+        self.times = [s.effective_time for s in self.sets]
+
+    def set_at(self, timestamp):
+        # Readings older than every set use the first one
+        i = bisect_right(self.times, timestamp)
+        return self.sets[max(i - 1, 0)]
+
+    def current(self):
+        return self.set_at(time.time())
+
+    def segments(self, times):
+        """(set, first row, end row) for numpy array times sorted ascending."""
+        import numpy as np
+        boundaries = np.searchsorted(times, self.times[1:], side='left')
+        starts = [0] + boundaries.tolist()
+        ends = boundaries.tolist() + [len(times)]
+        return [(s, start, end) for s, start, end in zip(self.sets, starts, ends) if start < end]
+
+
+def load_calibrations(path=calibrations_file_path):
+    sets = []
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            config = json.load(f)
+        for entry in config["sets"]:
+            curves = {c_id: make_curve(curve) for c_id, curve in entry["curves"].items()}
+            sets.append(CalibrationSet(entry["name"], entry["effective"], curves))
+    if not sets:
+        sets.append(CalibrationSet("zones", "1970-01-01 00:00:00", {}))
+    for calibration_set in sets:
+        calibration_set.check()
+    return Calibrations(sets)
+
+
+calibrations = load_calibrations()
+
+
+def fit(measurements, kind="linear", reference_temperature=default_reference_temperature):
+    """Curve per container fitted from measurements, a list of dicts with
+    container, raw, pct and optionally temperature.
+
+    linear fits pct = a + b * raw by least squares; points takes the mean raw
+    of every pct level. With temperatures, raw is also regressed on the
+    temperature and the slope becomes the temperature coefficient.
+    """
+    import numpy as np
+    by_container = {}
+    for m in measurements:
+        by_container.setdefault(m["container"], []).append(m)
+
+    curves = {}
+    for c_id, rows in by_container.items():
+        raw = np.array([float(m["raw"]) for m in rows])
+        pct = np.array([float(m["pct"]) for m in rows])
+        temperatures = [m.get("temperature") for m in rows]
+        compensation = {}
+        if all(t not in (None, "") for t in temperatures):
+            temperatures = np.array([float(t) for t in temperatures])
+            if np.ptp(temperatures) > 0:
+                # raw = c0 + c1 * pct + k * (temperature - reference)
+                design = np.column_stack(
+                    [np.ones_like(raw), pct, temperatures - reference_temperature])
+                coefficients = np.linalg.lstsq(design, raw, rcond=None)[0]
+                compensation = {"temperature_coefficient": float(coefficients[2]),
+                                "reference_temperature": reference_temperature}
+                raw = raw - coefficients[2] * (temperatures - reference_temperature)
+
+        if kind == "points":
+            levels = sorted(set(pct.tolist()))
+            if len(levels) < 2:
+                raise ValueError(f"{c_id}: a points curve needs measurements at 2 pct levels")
+            curves[c_id] = PointsCurve([float(raw[pct == level].mean()) for level in levels],
+                                       levels, **compensation)
+        else:
+            if np.ptp(raw) == 0:
+                raise ValueError(f"{c_id}: the raw values of a linear fit must differ")
+            b, a = np.polyfit(raw, pct, 1)
+            curves[c_id] = LinearCurve(float(-a / b), float((1 - a) / b), **compensation)
+    return curves
+
+
+def read_measurements(path):
+    with open(path, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def recalibrate_store(store, calibrations=calibrations, containers=None):
+    """Recompute the <container>_pct columns of a HistoryStore from the raw
+    columns, one day and one container at a time. Returns the number of
+    values written."""
+    import numpy as np
+    written = 0
+    for day in sorted(store.index):
+        rows = store.index[day]["rows"]
+        if not rows:
+            continue
+        times = np.frombuffer(store.read_column(day, "time", 0, rows), dtype=float)
+        temperatures = np.frombuffer(
+            store.read_column(day, temperature_column, 0, rows), dtype=float)
+        day_containers = containers
+        if day_containers is None:
+            day_containers = [name[:-len("_raw.f64")]
+                              for name in os.listdir(os.path.join(store.directory, day))
+                              if name.endswith("_raw.f64")]
+        segments = calibrations.segments(times)
+        for c_id in day_containers:
+            raws = np.frombuffer(store.read_column(day, f"{c_id}_raw", 0, rows), dtype=float)
+            pct = np.full(rows, np.nan)
+            for calibration_set, start, end in segments:
+                curve = calibration_set.curve(c_id)
+                if curve is not None:
+                    pct[start:end] = curve.values(raws[start:end], temperatures[start:end])
+            store.write_column(day, f"{c_id}_pct", pct)
+            written += rows
+    return written
+
+
+def recalibrate_csv(csv_path, output_path, calibrations=calibrations):
+    """Write a copy of log.csv with the <container>_pct_humidity columns
+    recomputed from the raw columns. Returns the number of rows."""
+    import numpy as np
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        lines = [line for line in reader if line]
+    if not lines:
+        return 0
+    columns = list(zip(*lines))
+
+    def numbers(index):
+        return np.array([float(v) if v not in ("", "None") else np.nan for v in columns[index]])
+
+    # log.csv holds local time; "YYYY-MM-DD HH:MM:SS" strings sort like the
+    # times, so the rows are matched to the sets by comparing strings
+    date_times = np.array(columns[0])
+    order = np.argsort(date_times, kind="stable")
+    sorted_times = date_times[order]
+    boundaries = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+                  for t in calibrations.times[1:]]
+    starts = [0] + np.searchsorted(sorted_times, boundaries, side='left').tolist()
+    ends = starts[1:] + [len(lines)]
+
+    temperatures = None
+    if temperature_csv_header in header:
+        temperatures = numbers(header.index(temperature_csv_header))[order]
+
+    for index, name in enumerate(header):
+        if not name.endswith("_pct_humidity"):
+            continue
+        c_id = name[:-len("_pct_humidity")]
+        raw_index = header.index(f"{c_id}_raw_humidity")
+        raws = numbers(raw_index)[order]
+        pct = np.full(len(lines), np.nan)
+        for calibration_set, start, end in zip(calibrations.sets, starts, ends):
+            curve = calibration_set.curve(c_id)
+            if curve is not None and start < end:
+                pct[start:end] = curve.values(
+                    raws[start:end], temperatures[start:end] if temperatures is not None else None)
+        values = np.empty(len(lines), dtype=object)
+        values[order] = ["" if np.isnan(v) else str(v) for v in pct.tolist()]
+        columns[index] = values.tolist()
+
+    with open(output_path, 'w', newline='') as f:
+        # log.csv is written with plain "\n" line endings
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(zip(*columns))
+    return len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soil sensor calibration")
+    commands = parser.add_subparsers(dest="command", required=True)
+    fit_parser = commands.add_parser("fit", help="fit curves from calibration measurements")
+    fit_parser.add_argument("measurements", help="CSV with container,raw,pct[,temperature]")
+    fit_parser.add_argument("--type", choices=list(curve_types), default="linear")
+    fit_parser.add_argument("--reference-temperature", type=float,
+                            default=default_reference_temperature)
+    store_parser = commands.add_parser("store", help="write a recalibrated copy of a history store")
+    store_parser.add_argument("directory")
+    store_parser.add_argument("output_directory")
+    csv_parser = commands.add_parser("csv", help="write a recalibrated copy of log.csv")
+    csv_parser.add_argument("csv_path")
+    csv_parser.add_argument("output_path")
+    parser.add_argument("--calibrations", default=calibrations_file_path)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "fit":
+        curves = fit(read_measurements(args.measurements), args.type, args.reference_temperature)
+        # Ready to be pasted as the curves of a new set in calibrations.json
+        print(json.dumps({c_id: curve.to_dict() for c_id, curve in curves.items()}, indent=1))
+        return
+
+    loaded = load_calibrations(args.calibrations)
+    if args.command == "store":
+        from historyStore import HistoryStore
+        # The controller keeps appending to its store: the copy is rewritten
+        # instead, and replaces it while the controller is stopped
+        if os.path.exists(args.output_directory):
+            parser.error(f"{args.output_directory} already exists")
+        shutil.copytree(args.directory, args.output_directory)
+        store = HistoryStore(args.output_directory)
+        written = recalibrate_store(store, loaded)
+        print(f"Recalibrated {written} values in {time.perf_counter() - started:.2f}s")
+    else:
+        rows = recalibrate_csv(args.csv_path, args.output_path, loaded)
+        print(f"Recalibrated {rows} rows in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
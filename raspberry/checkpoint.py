@@ -0,0 +1,47 @@
+import json
+import os
+from hardware import clock
+
+
+class Checkpoint:
+    """Small state file of the controller for warm restarts.
+
+    save() writes the state as one line of JSON to a temporary file and
+    renames it over the checkpoint, so a crash leaves either the previous or
+    the new checkpoint. It is not fsync'd: losing the last checkpoint on a
+    power cut only means a cold start. load() returns the saved state, or
+    None when there is none, it is unreadable or older than max_age seconds.
+    """
+
+    version = 1
+
+    def __init__(self, path, max_age=30 * 60):
+        self.path = path
+        self.max_age = max_age
+
+    def save(self, state):
+        data = {"version": self.version, "saved": clock.time()}
+        data.update(state)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading checkpoint: {e}")
+            return None
+        if data.get("version") != self.version:
+            print(f"Ignoring checkpoint of version {data.get('version')}")
+            return None
+        age = clock.time() - data["saved"]
+        if not 0 <= age <= self.max_age:
+            print(f"Ignoring checkpoint saved {age:.0f}s ago")
+            return None
+        data["age"] = age
+        return data
@@ -0,0 +1,49 @@
+# Watering control law
+# Shared by main.py and the offline tools. The functions only use arithmetic
+# and the rounding/minimum/maximum functions passed in, so they work on plain
+# floats as well as on NumPy arrays holding many containers at once.
+
+# Targets of the containers are set in zones.json
+target_threshold_baseline = 0.8
+
+# Update watering thresholds
+watering_thresholds = {
+    12: 3 * 1000,  # max ml per 12 hours / 83mL/h
+    6: 3 * 800,   # max ml per 6 hours / 133mL/h
+    3: 3 * 500,    # max ml per 3 hours / 166mL/h
+    1: 3 * 200    # max ml per 1 hours / 200mL/h
+}
+P_factor = 30
+low_pass_filter_factor = 10
+
+
+def low_pass_filter_step(previous, value, factor=low_pass_filter_factor, steps=1):
+    # steps: sensing periods since the previous value, so that a container
+    # read less often keeps the same time constant
+    keep = ((factor - 1) / factor) ** steps
+    return previous * keep + value * (1 - keep)
+
+
+def ml_requested(target_percent_wet, filtered_percent_wet, p_factor=P_factor, rounding=round):
+    # Amount of water to add based on humidity difference
+    return rounding((target_percent_wet - filtered_percent_wet) * p_factor)
+
+
+def ml_allowed(ml_added_in_windows, target_percent_wet, add_ml_requested,
+               thresholds=watering_thresholds, baseline=target_threshold_baseline,
+               minimum=min, maximum=max):
+    # Iterate over all thresholds to compute remaining ml for each time window
+    remaining_ml_allowed = float('inf')  # Start with no restriction (infinite)
+
+    for hours, max_ml in thresholds.items():
+        max_ml = max_ml * target_percent_wet / baseline
+
+        # Remaining ml allowed for this time window
+        remaining_ml_in_window = max_ml - ml_added_in_windows[hours]
+
+        # Update the remaining ml allowed based on the most restrictive window
+        remaining_ml_allowed = minimum(
+            remaining_ml_allowed, remaining_ml_in_window)
+
+    # Return the requested amount, capped at the remaining amount (never negative)
+    return maximum(0, minimum(add_ml_requested, remaining_ml_allowed))
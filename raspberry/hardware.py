@@ -0,0 +1,363 @@
+# Hardware drivers
+# Every device is opened on first use, through the backend selected with the
+# IRRIGATION_BACKEND environment variable:
+#   real (default): ADC Pi boards, GPIO banks (relay board on the Pi header,
+#        MCP23017 expanders), SHT40, BMP280 and CPU sensor
+#   sim: in-memory devices driven by a soil/water model, for running the
+#        control loop on any Linux machine. IRRIGATION_SIM_SPEED runs the
+#        simulated clock faster than real time (e.g. 60 = one minute per second).
+#        IRRIGATION_SIM_SPEED=virtual gives a clock that only moves when set,
+#        for replaying recorded data (see replay.py).
+#
+# Drivers of both backends expose the same small interface, and the modules
+# using them never import a hardware library themselves. ADC boards and GPIO
+# banks are declared in zones.json and opened once per board or bank.
+
+import os
+import random
+import threading
+import time
+from calibration import calibrations
+from i2cBus import i2c_lock
+from zones import zones
+
+backend = os.environ.get("IRRIGATION_BACKEND", "real")
+simulated = backend == "sim"
+
+devices = {}
+devices_lock = threading.RLock()
+
+
+class ADCTimeoutError(Exception):
+    """Raised by read_voltage when the ADC conversion timed out."""
+
+
+# Longest wait for one ADC conversion (seconds), the slowest 18 bit
+# conversion taking about 0.27 s
+adc_conversion_timeout = 1.0
+
+
+# Clocks
+
+class RealClock:
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def real_seconds(self, seconds):
+        """Real time to wait for the given duration of this clock."""
+        return seconds
+
+
+class SimulatedClock:
+    """Clock running speed times faster than real time."""
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.real_start = time.monotonic()
+        self.start = start if start is not None else time.time()
+
+    def elapsed(self):
+        return (time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.start + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def sleep(self, seconds):
+        time.sleep(self.real_seconds(seconds))
+
+    def real_seconds(self, seconds):
+        return seconds / self.speed
+
+
+class VirtualClock:
+    """Clock standing still until set, e.g. to the time of a replayed row."""
+
+    def __init__(self, start=0.0):
+        self.start = start
+        self.now = start
+
+    def set(self, timestamp):
+        self.now = timestamp
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now - self.start
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def real_seconds(self, seconds):
+        return 0.0
+
+
+if simulated and os.environ.get("IRRIGATION_SIM_SPEED") == "virtual":
+    clock = VirtualClock()
+elif simulated:
+    clock = SimulatedClock(float(os.environ.get("IRRIGATION_SIM_SPEED", "1")))
+else:
+    clock = RealClock()
+
+
+# Real drivers
+
+class RealADC:
+    def __init__(self, board):
+        from ADCPi import ADCPi
+        self.ADCPi = ADCPi
+        self.adc = ADCPi(*board["addresses"], board["bit_rate"])
+        # Only recent versions of the library let the timeout be set. With
+        # older ones nothing bounds a read that hangs.
+        if hasattr(self.adc, "set_conversion_timeout"):
+            self.adc.set_conversion_timeout(adc_conversion_timeout)
+
+    def read_voltage(self, channel):
+        try:
+            return self.adc.read_voltage(channel)
+        except self.ADCPi.TimeoutError as e:
+            raise ADCTimeoutError(str(e))
+
+
+class RealGPIO:
+    # GPIO pins of the Pi header (BCM numbering)
+    # HIGH = STOP PUMP
+    # LOW = START PUMP
+    def __init__(self, bank):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_output(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def write(self, pin, high):
+        self.GPIO.output(pin, self.GPIO.HIGH if high else self.GPIO.LOW)
+
+
+class RealMCP23017:
+    # 16 GPIO pins of an MCP23017 I2C expander (pins 0-15)
+    def __init__(self, bank):
+        import board
+        from adafruit_mcp230xx.mcp23017 import MCP23017
+        with i2c_lock:
+            self.mcp = MCP23017(board.I2C(), address=bank.get("address", 0x20))
+        self.pins = {}
+
+    def setup_output(self, pin):
+        with i2c_lock:
+            self.pins[pin] = self.mcp.get_pin(pin)
+            self.pins[pin].switch_to_output(value=True)
+
+    def write(self, pin, high):
+        with i2c_lock:
+            self.pins[pin].value = high
+
+
+class RealSHT40:
+    # SHT40 on ENV IV Board from M5 Stack, I2C channel 0x44
+    def __init__(self):
+        import board
+        import adafruit_sht4x
+        self.sht = adafruit_sht4x.SHT4x(board.I2C())
+        print("Found SHT4x with serial number", hex(self.sht.serial_number))
+        self.sht.mode = adafruit_sht4x.Mode.NOHEAT_HIGHPRECISION
+        # Can also set the mode to enable heater
+        # sht.mode = adafruit_sht4x.Mode.LOWHEAT_100MS
+        print("Current mode is: ",
+              adafruit_sht4x.Mode.string[self.sht.mode])
+
+    def measurements(self):
+        return self.sht.measurements
+
+
+class RealBMP280:
+    # BMP280 on ENV IV Board from M5 Stack, I2C channel 0x76
+    i2c_channel = 0x76
+
+    def __init__(self):
+        import board
+        import adafruit_bmp280
+        self.bmp280 = adafruit_bmp280.Adafruit_BMP280_I2C(
+            board.I2C(), self.i2c_channel)
+        # change this to match the location's pressure (hPa) at sea level
+        self.bmp280.sea_level_pressure = 1013.25
+
+    def temperature_pressure(self):
+        return self.bmp280.temperature, self.bmp280.pressure
+
+    def altitude(self):
+        return self.bmp280.altitude
+
+
+class RealCPU:
+    def __init__(self):
+        from gpiozero import CPUTemperature
+        self.cpu = CPUTemperature()
+
+    @property
+    def temperature(self):
+        return self.cpu.temperature
+
+
+# Simulated drivers
+
+class SoilModel:
+    """Water content of the containers, reacting to the simulated pumps.
+
+    Moisture is a fraction between 0 (dry) and 1 (wet) per container. It
+    halves every drying_half_life_hours and rises with the water pumped in.
+    The ADC voltage is the one giving the moisture through the curve of the
+    calibration in effect (calibrations.json), plus measurement noise.
+    """
+
+    drying_half_life_hours = 48
+    ml_for_full_range = 600
+    noise_volts = 0.003
+
+    def __init__(self):
+        self.zone_by_sensor = {(zones.adc_board[i], zones.channel[i]): i
+                               for i in range(len(zones))}
+        self.zone_by_pump = {(zones.gpio_bank[i], zones.pin[i]): i
+                             for i in range(len(zones))}
+        self.ml_per_second = [100 / seconds for seconds in zones.seconds_per_100ml]
+        self.moisture = [0.5] * len(zones)
+        self.pump_on = [False] * len(zones)
+        self.ml_pumped = [0.0] * len(zones)
+        self.lock = threading.Lock()
+        self.last_update = clock.monotonic()
+
+    def advance(self):
+        now = clock.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        decay = 2 ** (-elapsed / (self.drying_half_life_hours * 3600))
+        for i, moisture in enumerate(self.moisture):
+            moisture *= decay
+            if self.pump_on[i]:
+                ml = self.ml_per_second[i] * elapsed
+                self.ml_pumped[i] += ml
+                moisture += ml / self.ml_for_full_range
+            self.moisture[i] = min(1.0, moisture)
+
+    def set_pump(self, bank, pin, on):
+        with self.lock:
+            self.advance()
+            i = self.zone_by_pump.get((bank, pin))
+            if i is not None:
+                self.pump_on[i] = on
+
+    def voltage(self, board, channel):
+        with self.lock:
+            self.advance()
+            i = self.zone_by_sensor[(board, channel)]
+            curve = calibrations.set_at(clock.time()).curve(zones.ids[i])
+            return curve.raw_at(self.moisture[i]) + random.gauss(0, self.noise_volts)
+
+
+class SimulatedADC:
+    timeout_probability = 0.001
+
+    def __init__(self, board):
+        self.board = board["name"]
+
+    def read_voltage(self, channel):
+        if random.random() < self.timeout_probability:
+            raise ADCTimeoutError("Simulated conversion timeout")
+        return get_soil_model().voltage(self.board, channel)
+
+
+class SimulatedGPIO:
+    def __init__(self, bank):
+        self.bank = bank["name"]
+        self.levels = {}
+
+    def setup_output(self, pin):
+        self.levels[pin] = True
+
+    def write(self, pin, high):
+        self.levels[pin] = high
+        # Relay board: LOW starts the pump
+        get_soil_model().set_pump(self.bank, pin, not high)
+
+
+class SimulatedSHT40:
+    def measurements(self):
+        hour = time.localtime(clock.time()).tm_hour
+        temperature = 21 + 3 * (1 - abs(hour - 14) / 12)
+        return temperature + random.gauss(0, 0.05), 45 + random.gauss(0, 0.5)
+
+
+class SimulatedBMP280:
+    def temperature_pressure(self):
+        temperature, _ = get_sht40().measurements()
+        return temperature + 0.3, 1013.25 + random.gauss(0, 0.1)
+
+    def altitude(self):
+        return 0.0
+
+
+class SimulatedCPU:
+    @property
+    def temperature(self):
+        return 45 + random.gauss(0, 0.5)
+
+
+drivers = {
+    "real": {"adc": RealADC, "gpio_pi": RealGPIO, "gpio_mcp23017": RealMCP23017,
+             "sht40": RealSHT40, "bmp280": RealBMP280, "cpu": RealCPU},
+    "sim": {"adc": SimulatedADC, "gpio_pi": SimulatedGPIO, "gpio_mcp23017": SimulatedGPIO,
+            "sht40": SimulatedSHT40, "bmp280": SimulatedBMP280, "cpu": SimulatedCPU,
+            "soil": SoilModel},
+}
+
+
+def get_device(kind, config=None):
+    # Boards and banks are opened once each, with their config
+    name = kind if config is None else f"{kind}:{config['name']}"
+    device = devices.get(name)
+    if device is None:
+        with devices_lock:
+            device = devices.get(name)
+            if device is None:
+                if config is None:
+                    device = drivers[backend][kind]()
+                else:
+                    device = drivers[backend][kind](config)
+                devices[name] = device
+    return device
+
+
+def get_adc(board):
+    return get_device("adc", zones.adc_boards[board])
+
+
+def get_gpio(bank):
+    config = zones.gpio_banks[bank]
+    return get_device("gpio_" + config["type"], config)
+
+
+def get_sht40():
+    return get_device("sht40")
+
+
+def get_bmp280():
+    return get_device("bmp280")
+
+
+def get_cpu():
+    return get_device("cpu")
+
+
+def get_soil_model():
+    return get_device("soil")
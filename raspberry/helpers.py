@@ -1,30 +1,68 @@
 from TemperatureHumidity import getTemperatureHumiditySHT40
 from Pressure import getTemperaturePressureBMP280
 from datetime import datetime, timezone
-from time import strftime
+from collections import namedtuple
+import threading
+from hardware import clock
 
+# Environmental readings of one cycle, shared by the console, the log and
+# the uploader so that they all report the same values
+EnviroSnapshot = namedtuple("EnviroSnapshot", [
+    "timestamp", "datetime_string", "datetime_utc_string", "cpu_temp",
+    "room_temp_SHT40", "room_humidity_SHT40",
+    "room_temp_BMP280", "room_pressure_BMP280"])
 
-def print_enviro(cpu):
-    cpuTempC = round(cpu.temperature, 1)
-    roomTempC_SHT40, roomHumiditySHT40 = getTemperatureHumiditySHT40()
-    roomTempC_BMP280, roomPressureBMP280 = getTemperaturePressureBMP280()
+# A snapshot younger than this (seconds) is reused instead of reading again
+enviro_snapshot_max_age = 10
 
+enviro_cache = {"snapshot": None, "taken": None}
+enviro_cache_lock = threading.Lock()
+
+
+def get_enviro_snapshot(cpu, max_age=enviro_snapshot_max_age):
+    with enviro_cache_lock:
+        if enviro_cache["snapshot"] is not None and clock.monotonic() - enviro_cache["taken"] < max_age:
+            return enviro_cache["snapshot"]
+
+        roomTempC_SHT40, roomHumiditySHT40 = getTemperatureHumiditySHT40()
+        roomTempC_BMP280, roomPressureBMP280 = getTemperaturePressureBMP280()
+        timestamp = clock.time()
+        snapshot = EnviroSnapshot(
+            timestamp=timestamp,
+            datetime_string=get_datetime_string(timestamp),
+            datetime_utc_string=get_datetime_utc_string(timestamp),
+            cpu_temp=round(cpu.temperature, 1),
+            room_temp_SHT40=roomTempC_SHT40,
+            room_humidity_SHT40=roomHumiditySHT40,
+            room_temp_BMP280=roomTempC_BMP280,
+            room_pressure_BMP280=roomPressureBMP280)
+
+        enviro_cache["snapshot"] = snapshot
+        enviro_cache["taken"] = clock.monotonic()
+        return snapshot
+
+
+def print_enviro(enviro):
     # Create a formatted print statement
     print_data = (
-        f"{get_datetime_string()}, "
-        f"CPU: {cpuTempC:.1f}°C, "
-        f"SHT40: {roomTempC_SHT40:.1f}°C, "
-        f"BMP280: {roomTempC_BMP280:.1f}°C, "
-        f"Humidity: {roomHumiditySHT40:.1f}%, "
-        f"Pressure: {roomPressureBMP280:.2f}hPa"
+        f"{enviro.datetime_string}, "
+        f"CPU: {enviro.cpu_temp:.1f}°C, "
+        f"SHT40: {enviro.room_temp_SHT40:.1f}°C, "
+        f"BMP280: {enviro.room_temp_BMP280:.1f}°C, "
+        f"Humidity: {enviro.room_humidity_SHT40:.1f}%, "
+        f"Pressure: {enviro.room_pressure_BMP280:.2f}hPa"
     )
 
     print(print_data)
 
 
-def get_datetime_string():
-    return strftime("%Y-%m-%d %H:%M:%S")
+def get_datetime_string(timestamp=None):
+    if timestamp is None:
+        timestamp = clock.time()
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def get_datetime_utc_string():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+def get_datetime_utc_string(timestamp=None):
+    if timestamp is None:
+        timestamp = clock.time()
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,326 @@
+# Columnar history store
+# Readings are stored per UTC day in log/history/<YYYY-MM-DD>/, one file of
+# raw float64 values per column (<column>.f64), all columns of a day having
+# one value per row. index.json keeps the first/last time and row count of
+# every day, so range queries only open the days they need and only read the
+# rows of the range. Missing values are stored as NaN.
+#
+# Usage:
+#   python3 historyStore.py migrate log/log.csv log/history.new
+#   python3 historyStore.py query log/history A2_pct --days 30 --points 500
+
+import argparse
+import csv
+import json
+import math
+import os
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+# Header names of log.csv for each column
+csv_enviro_headers = {"cpu temp C": "cpu_temp",
+                      "room temp C (SHT40)": "room_temp_SHT40",
+                      "room temp C (BMP280)": "room_temp_BMP280",
+                      "room humidity % (SHT40)": "room_humidity_SHT40",
+                      "room press hPa (BMP280)": "room_pressure_BMP280"}
+csv_container_suffixes = {"_tgt_humidity": "tgt", "_raw_humidity": "raw",
+                          "_pct_humidity": "pct", "_pump_ml_since_prev_entry": "pump_ml"}
+
+value_size = array('d').itemsize
+nan = float("nan")
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return nan
+
+
+class HistoryStore:
+    """Append-only columnar store of the readings, one chunk per UTC day."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = {}
+        # Days whose files were checked for consistency by this process
+        self.checked_days = set()
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                print(f"Error loading history index: {e}")
+                self.index = {}
+        # Rebuild entries the index does not know or that changed since
+        for day in sorted(os.listdir(self.directory)):
+            day_path = os.path.join(self.directory, day)
+            if not os.path.isdir(day_path):
+                continue
+            rows = self.column_rows(day, "time")
+            if day not in self.index or self.index[day]["rows"] != rows:
+                times = self.read_column(day, "time", 0, rows)
+                self.index[day] = {"rows": rows,
+                                   "min_time": times[0] if rows else None,
+                                   "max_time": times[-1] if rows else None}
+
+    def save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def column_path(self, day, column):
+        return os.path.join(self.directory, day, f"{column}.f64")
+
+    def column_rows(self, day, column):
+        path = self.column_path(day, column)
+        return os.path.getsize(path) // value_size if os.path.isfile(path) else 0
+
+    def read_column(self, day, column, start_row, end_row):
+        values = array('d')
+        path = self.column_path(day, column)
+        if not os.path.isfile(path):
+            values.extend([nan] * (end_row - start_row))
+            return values
+        with open(path, 'rb') as f:
+            f.seek(start_row * value_size)
+            values.frombytes(f.read((end_row - start_row) * value_size))
+        # Column added after the start of the day
+        values.extend([nan] * (end_row - start_row - len(values)))
+        return values
+
+    def write_column(self, day, column, values):
+        """Replace a column of a day with values, one per row of the day."""
+        values = array('d', values)
+        if len(values) != self.index.get(day, {}).get("rows", 0):
+            raise ValueError(f"{column} of {day} needs one value per row")
+        path = self.column_path(day, column)
+        with open(path + ".tmp", 'wb') as f:
+            values.tofile(f)
+        os.replace(path + ".tmp", path)
+
+    def align_columns(self, day, columns):
+        """Pad or truncate the column files of a day to the same number of
+        rows, e.g. after a crash in the middle of an append."""
+        rows = self.index.get(day, {}).get("rows", 0)
+        for column in columns:
+            path = self.column_path(day, column)
+            size = os.path.getsize(path) if os.path.isfile(path) else 0
+            if size > rows * value_size:
+                with open(path, 'r+b') as f:
+                    f.truncate(rows * value_size)
+            elif size < rows * value_size:
+                with open(path, 'ab') as f:
+                    array('d', [nan] * (rows - size // value_size)).tofile(f)
+
+    def last_time(self):
+        """Time of the last row stored, None when the store is empty."""
+        return max((entry["max_time"] for entry in self.index.values() if entry["rows"]),
+                   default=None)
+
+    def append_rows(self, rows, save_index=True):
+        """Append rows given as dicts of column -> value, "time" being the
+        epoch timestamp. Rows must come in time order, after the rows
+        already stored: queries bisect on the time column. Otherwise
+        ValueError is raised and nothing is written."""
+        last_time = self.last_time()
+        for row in rows:
+            if last_time is not None and row["time"] < last_time:
+                raise ValueError(f"Row at {row['time']} is older than the last row stored ({last_time})")
+            last_time = row["time"]
+
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(day_of(row["time"]), []).append(row)
+
+        for day, day_rows in by_day.items():
+            os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+            columns = {"time"}
+            for row in day_rows:
+                columns.update(row)
+            for column in os.listdir(os.path.join(self.directory, day)):
+                columns.add(column[:-len(".f64")])
+            if day not in self.checked_days:
+                self.align_columns(day, columns)
+                self.checked_days.add(day)
+            else:
+                # New columns in the middle of the day start with NaN
+                self.align_columns(
+                    day, [c for c in columns if not os.path.isfile(self.column_path(day, c))])
+
+            for column in columns:
+                values = array('d', [to_float(row.get(column))
+                                     for row in day_rows])
+                with open(self.column_path(day, column), 'ab') as f:
+                    values.tofile(f)
+
+            entry = self.index.setdefault(
+                day, {"rows": 0, "min_time": None, "max_time": None})
+            entry["rows"] += len(day_rows)
+            if entry["min_time"] is None:
+                entry["min_time"] = day_rows[0]["time"]
+            entry["max_time"] = day_rows[-1]["time"]
+
+        if save_index:
+            self.save_index()
+
+    def append(self, row):
+        self.append_rows([row])
+
+    def query(self, start, end, columns):
+        """Values of columns for start <= time < end, as arrays keyed by
+        column, including "time"."""
+        result = {column: array('d') for column in ["time"] + list(columns)}
+        for day in sorted(self.index):
+            entry = self.index[day]
+            if not entry["rows"] or entry["max_time"] < start or entry["min_time"] >= end:
+                continue
+            times = self.read_column(day, "time", 0, entry["rows"])
+            first = bisect_left(times, start)
+            last = bisect_left(times, end)
+            if first >= last:
+                continue
+            result["time"].extend(times[first:last])
+            for column in columns:
+                result[column].extend(
+                    self.read_column(day, column, first, last))
+        return result
+
+    def rows(self, start, end=math.inf):
+        """Rows with start <= time < end as dicts of every column stored,
+        missing values as None."""
+        rows = []
+        for day in sorted(self.index):
+            entry = self.index[day]
+            if not entry["rows"] or entry["max_time"] < start or entry["min_time"] >= end:
+                continue
+            columns = sorted(name[:-len(".f64")]
+                             for name in os.listdir(os.path.join(self.directory, day))
+                             if name.endswith(".f64") and name != "time.f64")
+            data = self.query(max(start, entry["min_time"]),
+                              min(end, math.nextafter(entry["max_time"], math.inf)), columns)
+            for i, timestamp in enumerate(data["time"]):
+                row = {"time": timestamp}
+                for column in columns:
+                    value = data[column][i]
+                    row[column] = None if math.isnan(value) else value
+                rows.append(row)
+        return rows
+
+    def downsample(self, start, end, column, points):
+        """min/mean/max of column over points equal time buckets, as a list
+        of (bucket start, min, mean, max). Empty buckets are left out."""
+        data = self.query(start, end, [column])
+        bucket_seconds = (end - start) / points
+        buckets = []
+        times = data["time"]
+        values = data[column]
+        for bucket in range(points):
+            bucket_start = start + bucket * bucket_seconds
+            first = bisect_left(times, bucket_start)
+            last = bisect_left(times, bucket_start + bucket_seconds)
+            bucket_values = [v for v in values[first:last] if not math.isnan(v)]
+            if bucket_values:
+                buckets.append((bucket_start, min(bucket_values),
+                                sum(bucket_values) / len(bucket_values), max(bucket_values)))
+        return buckets
+
+
+def csv_columns(header):
+    """Column names of the values of a log.csv row, date time excluded."""
+    names = []
+    for name in header[1:]:
+        if name in csv_enviro_headers:
+            names.append(csv_enviro_headers[name])
+            continue
+        for csv_suffix, suffix in csv_container_suffixes.items():
+            if name.endswith(csv_suffix):
+                names.append(name[:-len(csv_suffix)] + "_" + suffix)
+                break
+        else:
+            names.append(name)
+    return names
+
+
+def migrate_csv(csv_path, store, batch_size=10000):
+    """Stream log.csv into the store, batch_size rows at a time. Rows not
+    after the last row of the store are skipped, so that migrating twice
+    does not duplicate them."""
+    migrated = 0
+    skipped = 0
+    stored_until = store.last_time()
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        names = csv_columns(next(reader))
+
+        batch = []
+        last_time = None
+        for line in reader:
+            if not line:
+                continue
+            # log.csv holds local time
+            timestamp = time.mktime(time.strptime(line[0], "%Y-%m-%d %H:%M:%S"))
+            if last_time is not None and timestamp < last_time:
+                # Clock set back (e.g. DST): keep the store in time order
+                timestamp = last_time
+            last_time = timestamp
+            if stored_until is not None and timestamp <= stored_until:
+                skipped += 1
+                continue
+            row = {"time": timestamp}
+            row.update(zip(names, line[1:]))
+            batch.append(row)
+            if len(batch) >= batch_size:
+                store.append_rows(batch, save_index=False)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            store.append_rows(batch, save_index=False)
+            migrated += len(batch)
+    store.save_index()
+    print(f"Migrated {migrated} rows from {csv_path}"
+          + (f", {skipped} rows already in the store skipped" if skipped else ""))
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar history store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="convert log.csv")
+    migrate.add_argument("csv_path")
+    migrate.add_argument("directory")
+    query = commands.add_parser("query", help="downsampled range query")
+    query.add_argument("directory")
+    query.add_argument("column")
+    query.add_argument("--days", type=float, default=1)
+    query.add_argument("--points", type=int, default=200)
+    args = parser.parse_args()
+
+    store = HistoryStore(args.directory)
+    if args.command == "migrate":
+        migrate_csv(args.csv_path, store)
+    else:
+        end = max((entry["max_time"] for entry in store.index.values()
+                   if entry["rows"]), default=time.time()) + 1
+        start = end - args.days * 86400
+        started = time.perf_counter()
+        buckets = store.downsample(start, end, args.column, args.points)
+        print(f"{len(buckets)} points in {time.perf_counter() - started:.3f}s")
+        for bucket_start, low, mean, high in buckets:
+            print(f"{datetime.fromtimestamp(bucket_start):%Y-%m-%d %H:%M},{low:.4f},{mean:.4f},{high:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import threading
+
+# The ADC Pi, the SHT40 and the BMP280 all sit on the same I2C bus.
+# Every transaction goes through this lock so that threads never interleave
+# requests on the bus.
+i2c_lock = threading.RLock()
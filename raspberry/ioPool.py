@@ -0,0 +1,150 @@
+# Background I/O
+# Writes that can block on the SD card or the network run on one worker
+# thread per sink instead of the scheduler thread, so a slow sink delays
+# nothing but its own queue. Each sink delivers its calls one at a time, in
+# the order they were submitted, from a bounded queue:
+#   - a call submitted with a key replaces the call with the same key still
+#     waiting (coalescing, for state of which only the latest copy matters,
+#     e.g. the checkpoint),
+#   - when max_pending calls are waiting, the oldest call without a key is
+#     dropped to make room, and counted. Calls with a key are never dropped,
+#     there is at most one waiting per key.
+# submit() never blocks. Queue depth, wait before a call starts, duration,
+# drops and coalesced calls are exported as metrics per sink.
+
+import threading
+from collections import deque
+import metrics
+from hardware import clock
+
+io_queue_depth = metrics.gauge(
+    "irrigation_io_queue_depth", "Calls waiting in the queue of an I/O sink", ["sink"])
+io_wait = metrics.histogram(
+    "irrigation_io_wait_seconds", "Time a call waited in the queue of its I/O sink", ["sink"])
+io_duration = metrics.histogram(
+    "irrigation_io_duration_seconds", "Duration of a call of an I/O sink", ["sink"])
+io_dropped = metrics.counter(
+    "irrigation_io_dropped_total", "Calls dropped because their I/O sink was full", ["sink"])
+io_coalesced = metrics.counter(
+    "irrigation_io_coalesced_total", "Calls replaced by a newer call with the same key", ["sink"])
+io_failures = metrics.counter(
+    "irrigation_io_failures_total", "Calls of an I/O sink that raised an exception", ["sink"])
+
+
+class IOSink:
+    """Runs the calls submitted to one sink, in order, on its own thread."""
+
+    def __init__(self, name, max_pending=60):
+        self.name = name
+        self.max_pending = max_pending
+        # Waiting calls as [key, function, args, submitted], oldest first
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.busy = False
+        self.thread = None
+        self.counts = {"done": 0, "dropped": 0, "coalesced": 0, "failed": 0}
+        self.max_depth = 0
+        self.max_wait = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"io-{self.name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, key=None):
+        with self.condition:
+            if key is not None:
+                for call in self.pending:
+                    if call[0] == key:
+                        call[1:] = [function, args, clock.monotonic()]
+                        self.counts["coalesced"] += 1
+                        io_coalesced.inc(sink=self.name)
+                        return
+            if len(self.pending) >= self.max_pending:
+                oldest = next((call for call in self.pending if call[0] is None), None)
+                if oldest is not None:
+                    self.pending.remove(oldest)
+                    self.counts["dropped"] += 1
+                    io_dropped.inc(sink=self.name)
+                    print(f"I/O sink {self.name} is full, oldest call dropped")
+            self.pending.append([key, function, args, clock.monotonic()])
+            self.max_depth = max(self.max_depth, len(self.pending))
+            io_queue_depth.set(len(self.pending), sink=self.name)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                _, function, args, submitted = self.pending.popleft()
+                io_queue_depth.set(len(self.pending), sink=self.name)
+                self.busy = True
+
+            start = clock.monotonic()
+            wait = start - submitted
+            self.max_wait = max(self.max_wait, wait)
+            io_wait.observe(wait, sink=self.name)
+            try:
+                function(*args)
+            except Exception as e:
+                self.counts["failed"] += 1
+                io_failures.inc(sink=self.name)
+                print(f"I/O sink {self.name} call {getattr(function, '__name__', function)} failed: {e!r}")
+            else:
+                self.counts["done"] += 1
+            io_duration.observe(clock.monotonic() - start, sink=self.name)
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def stop(self, timeout=None):
+        """Run the calls still waiting, then stop. Returns False if they did
+        not finish within timeout (seconds)."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is None:
+            return True
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def depth(self):
+        with self.condition:
+            return len(self.pending) + self.busy
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts, depth=len(self.pending), max_depth=self.max_depth,
+                        max_wait=round(self.max_wait, 3))
+
+
+class IOPool:
+    """The sinks of the controller by name, started and stopped together."""
+
+    def __init__(self, max_pending):
+        # max_pending: {sink name: max calls waiting}
+        self.sinks = {name: IOSink(name, size) for name, size in max_pending.items()}
+
+    def start(self):
+        for sink in self.sinks.values():
+            sink.start()
+
+    def submit(self, sink_name, function, *args, key=None):
+        self.sinks[sink_name].submit(function, *args, key=key)
+
+    def stop(self, timeout=None):
+        """Drain and stop every sink, each within timeout (seconds). Returns
+        the names of the sinks whose thread is still running."""
+        running = []
+        for name, sink in self.sinks.items():
+            if not sink.stop(timeout):
+                print(f"I/O sink {name} did not finish its {sink.depth()} waiting call(s)")
+                running.append(name)
+        return running
+
+    def stats(self):
+        return {name: sink.stats() for name, sink in self.sinks.items()}
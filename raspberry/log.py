@@ -1,7 +1,4 @@
 import os
-from TemperatureHumidity import getTemperatureHumiditySHT40
-from Pressure import getTemperaturePressureBMP280
-from helpers import get_datetime_string
 
 
 def log_initialize(Containers, local_filepath_log):
@@ -23,21 +20,24 @@ def log_initialize(Containers, local_filepath_log):
     print("Log initialized")
 
 
-def log_add_entry(Containers, sensor_values, cpu, local_filepath_log, log_pump_ml_added):
-    cpuTempC = round(cpu.temperature, 1)
-    roomTempC_SHT40, roomHumiditySHT40 = getTemperatureHumiditySHT40()
-    roomTempC_BMP280, roomPressureBMP280 = getTemperaturePressureBMP280()
+def log_add_entry(Containers, sensor_values, enviro, local_filepath_log, pump_history, history_store=None):
+    log_write_entry(log_entry_line(Containers, sensor_values, enviro, pump_history),
+                    reading_row(Containers, sensor_values, enviro, pump_history),
+                    local_filepath_log, history_store)
 
+
+def log_entry_line(Containers, sensor_values, enviro, pump_history):
+    # Line of log.csv for one reading, built without touching the SD card
     # Limit the values to 1 digit after the comma
-    roomTempC_SHT40 = f"{roomTempC_SHT40:.1f}"
-    roomTempC_BMP280 = f"{roomTempC_BMP280:.1f}"
-    roomHumiditySHT40 = f"{roomHumiditySHT40:.1f}"
-    roomPressureBMP280 = f"{roomPressureBMP280:.1f}"
+    roomTempC_SHT40 = f"{enviro.room_temp_SHT40:.1f}"
+    roomTempC_BMP280 = f"{enviro.room_temp_BMP280:.1f}"
+    roomHumiditySHT40 = f"{enviro.room_humidity_SHT40:.1f}"
+    roomPressureBMP280 = f"{enviro.room_pressure_BMP280:.1f}"
 
     # Construct the log entry
     log_entry = "{0},{1},{2},{3},{4},{5}".format(
-        get_datetime_string(),
-        cpuTempC,
+        enviro.datetime_string,
+        enviro.cpu_temp,
         roomTempC_SHT40,
         roomTempC_BMP280,
         roomHumiditySHT40,
@@ -48,15 +48,15 @@ def log_add_entry(Containers, sensor_values, cpu, local_filepath_log, log_pump_m
     sensor_data = []
 
     for container_id in Containers:
-        # Access the last entry in the log for pump_ml_added
-        pump_ml_added_value = sum(
-            entry["ml"] for entry in log_pump_ml_added[container_id]) if log_pump_ml_added[container_id] else 0
+        # Cumulative ml added to the container
+        pump_ml_added_value = pump_history.total_ml(container_id)
 
-        # Append a dictionary with the sensor values to the list
+        # Append a dictionary with the sensor values to the list. Containers
+        # not read for this entry have empty fields.
         sensor_data.append({
-            'humidity_tgt': str(sensor_values[container_id]['tgt']),
-            'humidity_raw': str(sensor_values[container_id]['raw']),
-            'humidity_pct': str(sensor_values[container_id]['pct']),
+            'humidity_tgt': csv_field(sensor_values[container_id]['tgt']),
+            'humidity_raw': csv_field(sensor_values[container_id]['raw']),
+            'humidity_pct': csv_field(sensor_values[container_id]['pct']),
             # Use the calculated value here
             'pump_ml_added': str(pump_ml_added_value)
         })
@@ -71,13 +71,41 @@ def log_add_entry(Containers, sensor_values, cpu, local_filepath_log, log_pump_m
     log_entry += "," + ",".join(humidity_raw_values)
     log_entry += "," + ",".join(humidity_pct_values)
     log_entry += "," + ",".join(pump_ml_added_values) + "\n"
+    return log_entry
+
+
+def csv_field(value):
+    return "" if value is None else str(value)
+
 
+def log_write_entry(log_entry, row, local_filepath_log, history_store=None):
     # Write the log entry to the file
     with open(local_filepath_log, "a") as log:
         log.write(log_entry)
 
-    # Reset pump times
-    log_pump_ml_added = {container_id: []
-                         for container_id in Containers}  # Reset to empty list
+    # Same entry in the columnar store used for queries over the history
+    if history_store is not None:
+        try:
+            history_store.append(row)
+        except ValueError as e:
+            # Clock set back: the row stays in log.csv only
+            print(f"Log entry not added to the history store: {e}")
 
     print("Log entry added")
+
+
+def reading_row(Containers, sensor_values, enviro, pump_history):
+    # Values of one reading by channel, as used by the history store and
+    # the rollups
+    row = {"time": enviro.timestamp,
+           "cpu_temp": enviro.cpu_temp,
+           "room_temp_SHT40": enviro.room_temp_SHT40,
+           "room_temp_BMP280": enviro.room_temp_BMP280,
+           "room_humidity_SHT40": enviro.room_humidity_SHT40,
+           "room_pressure_BMP280": enviro.room_pressure_BMP280}
+    for container_id in Containers:
+        row[f"{container_id}_tgt"] = sensor_values[container_id]['tgt']
+        row[f"{container_id}_raw"] = sensor_values[container_id]['raw']
+        row[f"{container_id}_pct"] = sensor_values[container_id]['pct']
+        row[f"{container_id}_pump_ml"] = pump_history.total_ml(container_id)
+    return row
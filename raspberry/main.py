@@ -1,142 +1,194 @@
-from datetime import timedelta
-import json
-from CapacitiveSoilSensor import get_raw_sensor_value, get_calibrated_value
-from Pump import start_pump, stop_pump, stop_all_pumps, seconds_for_pump
-from log import log_initialize, log_add_entry
-from time import sleep, time
-from datetime import datetime, timedelta
-from helpers import print_enviro
-from sendToServer import send_data_to_server
+from CapacitiveSoilSensor import get_raw_sensor_values, get_calibrated_value
+from Pump import stop_all_pumps, seconds_to_ml
+from log import log_initialize, log_entry_line, log_write_entry, reading_row
+from helpers import print_enviro, get_enviro_snapshot
+from sendToServer import Uploader, build_record
+from pumpHistory import PumpHistory
+from pumpJournal import PumpJournal
+from checkpoint import Checkpoint
+from metrics import MetricsServer, metrics_port
+from historyStore import HistoryStore
+from rollups import Rollups
+from telemetry import TelemetryLog
+from scheduler import Scheduler
+from pumpSupervisor import PumpSupervisor
+from pumpProcess import PumpProcess
+from ioPool import IOPool
+from sensingSchedule import SensingSchedule
+from control import target_threshold_baseline, watering_thresholds, P_factor, low_pass_filter_step, ml_requested, ml_allowed
+import hardware
+from hardware import clock
+from zones import zones
+import cProfile
+import pstats
 import os
 import os.path
-from gpiozero import CPUTemperature
 import signal
 import sys
 import atexit
-import threading
+from collections import deque
 
-cpu = CPUTemperature()
-
-Containers = ["A1", "A2", "A3", "B1", "B2", "B3"]
-target_threshold = {"A": 0.8, "B": 0.4}
-target_threshold_baseline = 0.8
+# Containers in zone order, see zones.json
+Containers = zones.ids
 
 # Max ml allowed per container within 24 hours
 max_ml_per_24h = 1000
 
-local_filepath_log = "/home/pi/Irrigation/raspberry/log/log.csv"
-# Path for saving ml added
-pump_ml_log_file_path = "/home/pi/Irrigation/raspberry/log/pump_ml_log.json"
-# To avoid race conditions on uploading
-upload_lock = threading.Lock()
-# Modified log to track water added with timestamps
-log_pump_ml_added = {container_id: [] for container_id in Containers}
+# Directory of the log files, can be overridden e.g. for simulated runs
+log_directory = os.environ.get(
+    "IRRIGATION_LOG_DIR", "/home/pi/Irrigation/raspberry/log")
+local_filepath_log = os.path.join(log_directory, "log.csv")
+# Columnar copy of the log, one chunk per day, for fast range queries
+history_store_directory = os.path.join(log_directory, "history")
+history_store = None
+# Hourly and daily aggregates, one JSON line per closed bucket
+rollups_file_path = os.path.join(log_directory, "rollups.jsonl")
+rollups = Rollups(rollups_file_path,
+                  cumulative=[f"{c_id}_pump_ml" for c_id in Containers])
+# Compact binary copy of the log (see telemetry.py), written once an hour.
+# Rows of the hour lost in a crash are appended again from the history store
+# at the next start.
+telemetry_file_path = os.path.join(log_directory, "telemetry.bin")
+telemetry_log = TelemetryLog(telemetry_file_path)
+# Path for saving ml added (snapshot) and the journal of doses since the snapshot
+pump_ml_log_file_path = os.path.join(log_directory, "pump_ml_log.json")
+pump_ml_journal_file_path = os.path.join(log_directory, "pump_ml_log.journal")
+# Records waiting to be uploaded to the server
+upload_queue_file_path = os.path.join(log_directory, "upload_queue.sqlite")
+uploader = None
+# Simulated readings are never sent to the server
+upload_enabled = not hardware.simulated
+# "json" for api_store_data.php, "telemetry" for a server decoding telemetry.py
+# batches, at IRRIGATION_UPLOAD_URL when set
+upload_encoding = os.environ.get("IRRIGATION_UPLOAD_ENCODING", "json")
+upload_url = os.environ.get("IRRIGATION_UPLOAD_URL")
+
+# Water added per container, indexed by time for the watering thresholds
+pump_history = PumpHistory(Containers, max(watering_thresholds))
+pump_journal = PumpJournal(
+    pump_history, pump_ml_log_file_path, pump_ml_journal_file_path)
 low_pass_filter_values = {container_id: None for container_id in Containers}
-
-# Track pump threads for graceful stop
-pump_threads = []
-pump_thread_stop_event = threading.Event()
-
-
-def load_log_pump_ml_added():
-    global log_pump_ml_added
-    if os.path.isfile(pump_ml_log_file_path):
-        try:
-            with open(pump_ml_log_file_path, 'r') as f:
-                log_pump_ml_added = json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Error loading pump ml log file: {e}")
-            # Use an empty log if the file couldn't be loaded
-            log_pump_ml_added = {container_id: []
-                                 for container_id in Containers}
-
-
-def save_log_pump_ml_added():
-    try:
-        with open(pump_ml_log_file_path, 'w') as f:
-            json.dump(log_pump_ml_added, f)
-    except IOError as e:
-        print(f"Error saving pump ml log file: {e}")
+# Time of the last value filtered per container (epoch seconds)
+low_pass_filter_times = {container_id: None for container_id in Containers}
+
+# Filter state, last cycle and unfinished doses, restored after a restart
+checkpoint_file_path = os.path.join(log_directory, "checkpoint.json")
+checkpoint = Checkpoint(checkpoint_file_path)
+# Unfinished doses are only resumed after a short interruption (seconds)
+dose_resume_max_age = 5 * 60
+# Doses are journaled in full when submitted, and corrected by the measured
+# ml once finished when they differ by this much at least (ml)
+dose_correction_min_ml = 0.5
+# Doses finished by the pump thread, journaled by the control job
+finished_doses = deque()
+last_cycle = None
+cleaned_up = False
+
+# Period of each job of the main loop (seconds). Control, logging and upload
+# act on each new sensor reading once.
+job_periods = {"sensing": 60, "control": 60, "logging": 60, "upload": 60}
+scheduler = Scheduler()
+# Latest sensor reading, the containers read for it (the others have no
+# raw or pct value) and the reading each job processed last
+latest_reading = {"seq": 0, "values": None, "enviro": None, "fresh": ()}
+reading_seen_by = {}
+# Each container is read at every run of the sensing job during and after a
+# dose or while its moisture changes, and down to every max_interval seconds
+# while it is flat (see sensingSchedule.py).
+# IRRIGATION_SENSING_MAX_INTERVAL=60 reads every container at every run.
+sensing_schedule = SensingSchedule(
+    Containers, job_periods["sensing"],
+    max_interval=int(os.environ.get("IRRIGATION_SENSING_MAX_INTERVAL", "480")))
+
+# Max number of pumps running at the same time, to limit the power draw
+max_running_pumps = 3
+# IRRIGATION_PUMP_PROCESS=1 runs the pumps in a separate process (see
+# pumpProcess.py) instead of a thread of the controller
+pump_process_enabled = os.environ.get("IRRIGATION_PUMP_PROCESS", "0") == "1"
+
+
+def dose_started(dose):
+    # Called by the pump thread, with its lock held: the checkpoint is
+    # rewritten by the files sink with the doses in flight from then on
+    io_pool.submit("files", write_current_checkpoint, key="checkpoint")
+
+
+def dose_done(dose):
+    # Called by the pump thread, with its lock held
+    sensing_schedule.dose(dose["container_id"])
+    finished_doses.append(dose)
+    io_pool.submit("files", write_current_checkpoint, key="checkpoint")
+
+
+if pump_process_enabled:
+    pump_supervisor = PumpProcess(
+        max_running_pumps, on_dose_done=dose_done, on_dose_started=dose_started)
+else:
+    pump_supervisor = PumpSupervisor(
+        max_running_pumps, on_dose_done=dose_done, on_dose_started=dose_started)
+
+# Local HTTP endpoint of the metrics, see metrics.py
+metrics_server = None
+
+# Writes to the SD card (log files and checkpoint) and to the upload queue
+# run on their own threads (see ioPool.py), so that a slow card or upload
+# queue never delays sensing and control. Up to an hour of readings waits
+# when a sink falls behind, then the oldest ones are dropped.
+io_pool = IOPool({"files": 60, "upload": 60})
+
+# Opt-in profile of one cycle (sensing to upload), written to the file named
+# by IRRIGATION_PROFILE_CYCLE. The first cycle opens the devices and is
+# not representative, so the second one is profiled.
+profile_cycle_path = os.environ.get("IRRIGATION_PROFILE_CYCLE")
+profile_cycle_number = 2
+profile_state = {"cycle": 0, "profiler": cProfile.Profile()}
 
 
 def add_ml_to_container(container_id, ml_to_add):
-    start_time = time()
-    seconds_this_pump = seconds_for_pump(container_id, ml_to_add)
-    start_pump(container_id)
-    print('thread for' + container_id + '+' + str(ml_to_add) +
-          'ml (' + str(seconds_this_pump) + 'sec')
-
-    try:
-        # Wait for the pump to finish or until stop event is set
-        while time() - start_time < seconds_this_pump:
-            if pump_thread_stop_event.is_set():
-                break
-            sleep(0.2)
-    finally:
-        # Stop the pump in case of interruption or completion
-        stop_pump(container_id)
-
-
-# Update watering thresholds
-watering_thresholds = {
-    12: 3 * 1000,  # max ml per 12 hours / 83mL/h
-    6: 3 * 800,   # max ml per 6 hours / 133mL/h
-    3: 3 * 500,    # max ml per 3 hours / 166mL/h
-    1: 3 * 200    # max ml per 1 hours / 200mL/h
-}
-P_factor = 30
+    sensing_schedule.dose(container_id)
+    pump_supervisor.submit(container_id, ml_to_add)
 
 
 def watering_allowed_ml_time_based(container_id, target_percent_wet, target_threshold_baseline, add_ml_requested):
-    current_time = datetime.now()
-
-    # Iterate over all thresholds to compute remaining ml for each time window
-    remaining_ml_allowed = float('inf')  # Start with no restriction (infinite)
-
-    for hours, max_ml in watering_thresholds.items():
-        max_ml = max_ml * target_percent_wet / target_threshold_baseline
-        cutoff_time = current_time - timedelta(hours=hours)
-
-        # Calculate total ml added within this time window
-        ml_added_in_window = sum(entry["ml"]
-                                 for entry in log_pump_ml_added[container_id]
-                                 if datetime.fromisoformat(entry["time"]) > cutoff_time)
-
-        # Calculate remaining ml allowed for this time window
-        remaining_ml_in_window = max_ml - ml_added_in_window
-
-        # Update the remaining ml allowed based on the most restrictive window
-        remaining_ml_allowed = min(
-            remaining_ml_allowed, remaining_ml_in_window)
+    # Total ml added within each time window, from one pass over the index
+    ml_added_in_windows = pump_history.window_sums(
+        container_id, watering_thresholds)
 
-    # Return the allowed amount, capped at the remaining amount
-    return min(add_ml_requested, remaining_ml_allowed) if remaining_ml_allowed > 0 else 0
+    return ml_allowed(ml_added_in_windows, target_percent_wet, add_ml_requested,
+                      watering_thresholds, target_threshold_baseline)
 
 
 def low_pass_filter(container_id, value):
-    factor = 10
+    now = clock.time()
     if low_pass_filter_values[container_id] == None:
         low_pass_filter_values[container_id] = value
     else:
-        low_pass_filter_values[container_id] = (
-            low_pass_filter_values[container_id] * (factor-1) + value) / factor
+        # One step per sensing period since the last value, as containers
+        # are not all read every period
+        last = low_pass_filter_times[container_id]
+        steps = 1 if last is None else max(1, round((now - last) / job_periods["sensing"]))
+        low_pass_filter_values[container_id] = low_pass_filter_step(
+            low_pass_filter_values[container_id], value, steps=steps)
+    low_pass_filter_times[container_id] = now
     return low_pass_filter_values[container_id]
 
 
 def check_and_water(container_id, sensor_values):
     sensor_percent_wet = sensor_values[container_id]['pct']
+    if sensor_percent_wet is None:
+        print(f"Container {container_id} has no reading this cycle, skipped")
+        return
     filtered_sensor_percent_wet = low_pass_filter(
         container_id, sensor_percent_wet)
-    target_percent_wet = target_threshold[container_id[0]]  # 'A' or 'B'
+    target_percent_wet = sensor_values[container_id]['tgt']
 
     if filtered_sensor_percent_wet >= target_percent_wet:
         print(
             f"Container {container_id} ({filtered_sensor_percent_wet * 100:.1f}%) OK")
     else:
         # Calculate the amount of water to add based on humidity difference
-        # ml_to_add = 0
-        ml_to_add = round(
-            (target_percent_wet - filtered_sensor_percent_wet) * P_factor)
+        ml_to_add = ml_requested(
+            target_percent_wet, filtered_sensor_percent_wet, P_factor)
 
         # Calculate the allowed water based on time-based limits
         ml_to_add_allowed = watering_allowed_ml_time_based(
@@ -146,66 +198,253 @@ def check_and_water(container_id, sensor_values):
               target_percent_wet, ml_to_add, ml_to_add_allowed)
 
         if ml_to_add_allowed > 0:
-            global log_pump_ml_added
-            # Log ml added with timestamp
-            current_time = datetime.now()
-            log_pump_ml_added[container_id].append(
-                {"time": current_time.isoformat(), "ml": ml_to_add_allowed})
-            save_log_pump_ml_added()  # Save log of ml added
             print(
                 f"Container {container_id} ({filtered_sensor_percent_wet * 100:.1f}%) too dry - humidifying with {ml_to_add_allowed:.0f} ml (Time-based)")
-
-            # Create and track pump thread
-            pump_thread = threading.Thread(
-                target=add_ml_to_container, args=(container_id, ml_to_add_allowed))
-            pump_threads.append(pump_thread)
-            pump_thread.start()
+            try:
+                add_ml_to_container(container_id, ml_to_add_allowed)
+            except RuntimeError as e:
+                # Not journaled, so that it does not count against the limits
+                print(f"Dose of container {container_id} not submitted: {e}")
+                return
+            # Journal ml added with timestamp
+            pump_journal.record(container_id, ml_to_add_allowed)
         else:
             print(
                 f"Container {container_id} ({filtered_sensor_percent_wet * 100:.1f}%) no watering needed at this time (Time-based)")
 
 
+def journal_finished_doses():
+    # The watering limits count the measured ml of finished doses: a dose cut
+    # short or run longer than requested is corrected in the journal
+    while finished_doses:
+        dose = finished_doses.popleft()
+        correction = dose["actual_ml"] - dose["ml"]
+        if abs(correction) >= dose_correction_min_ml:
+            print(f"Dose of container {dose['container_id']}: {dose['actual_ml']:.1f} ml "
+                  f"of {dose['ml']:.1f} ml added, journal corrected")
+            pump_journal.record(dose["container_id"], correction)
+
+
+def settle_in_flight(doses):
+    # After the pumps were stopped: doses cut short were corrected by
+    # journal_finished_doses, doses that did not start are taken off the
+    # journal here. The doses resumed from the checkpoint are then journaled
+    # again.
+    for dose in doses:
+        if dose["off_time"] is None:
+            pump_journal.record(dose["container_id"],
+                                -seconds_to_ml(dose["container_id"], dose["seconds_remaining"]))
+        dose["settled"] = True
+
+
+def sense():
+    # Read the environmental sensors once for the whole cycle
+    enviro = get_enviro_snapshot(hardware.get_cpu())
+    print_enviro(enviro)
+
+    # Containers not due this run have no value, so that they are neither
+    # logged nor uploaded as new readings
+    due = sensing_schedule.due()
+    values = {c_id: {'tgt': zones.target[i], 'raw': None, 'pct': None}
+              for i, c_id in enumerate(zones.ids)}
+    raw_values, _ = get_raw_sensor_values(due) if due else ({}, {})
+    for c_id in due:
+        value = raw_values[c_id]
+        values[c_id]['raw'] = value
+        if value is not None:
+            values[c_id]['pct'] = get_calibrated_value(c_id, value, enviro.room_temp_SHT40)
+    sensing_schedule.update({c_id: values[c_id]['pct'] for c_id in due})
+
+    latest_reading["values"] = values
+    latest_reading["enviro"] = enviro
+    latest_reading["fresh"] = frozenset(due)
+    latest_reading["seq"] += 1
+
+
+def new_reading_for(job_name):
+    # True once per reading for each job, so that a job running faster than
+    # the sensing job does not process the same reading twice
+    if latest_reading["seq"] == reading_seen_by.get(job_name, 0):
+        return False
+    reading_seen_by[job_name] = latest_reading["seq"]
+    return True
+
+
+def control():
+    global last_cycle
+    if not new_reading_for("control"):
+        return
+    journal_finished_doses()
+    # Only on the containers read, those not due have no value
+    for container_id in Containers:
+        if container_id in latest_reading["fresh"]:
+            check_and_water(container_id, latest_reading["values"])
+    last_cycle = latest_reading["enviro"].timestamp
+    save_checkpoint()
+
+
+def save_checkpoint():
+    # Only the latest checkpoint waiting to be written is kept
+    io_pool.submit("files", write_checkpoint, checkpoint_state(), key="checkpoint")
+
+
+def checkpoint_state():
+    # Copied now, written later by the files sink
+    return {"last_cycle": last_cycle,
+            "low_pass_filter_values": dict(low_pass_filter_values),
+            "in_flight": pump_supervisor.in_flight()}
+
+
+def write_checkpoint(state):
+    # The rollups are updated by the files sink, so they are read there too
+    checkpoint.save(dict(state, rollups=rollups.to_dict()))
+
+
+def write_current_checkpoint():
+    # Run by the files sink when a pump starts or stops, so that the doses in
+    # flight of the checkpoint are the ones of the pumps
+    write_checkpoint(checkpoint_state())
+
+
+def restore_checkpoint():
+    global last_cycle
+    state = checkpoint.load()
+    if state is None:
+        return
+    last_cycle = state["last_cycle"]
+    for container_id, value in state["low_pass_filter_values"].items():
+        if container_id in low_pass_filter_values:
+            low_pass_filter_values[container_id] = value
+    rollups.load_dict(state.get("rollups", {}))
+    print(f"Restored filter state from checkpoint saved {state['age']:.0f}s ago")
+
+    # After a clean stop (settled doses) the pump time not run is known and
+    # was taken off the journal: it is run and journaled again. After a
+    # crash the journal still holds the doses in full, as submitted, and a
+    # running dose may have run until the crash: only the time left to its
+    # off time is run again, already counted by the watering limits. Doses
+    # still waiting for a pump were not started when the checkpoint was
+    # written, which happens whenever a pump starts or stops.
+    if state["age"] > dose_resume_max_age:
+        return
+    now = clock.time()
+    for dose in state["in_flight"]:
+        if dose["container_id"] not in Containers:
+            continue
+        if dose.get("settled") or dose.get("off_time") is None:
+            seconds = dose["seconds_remaining"]
+        else:
+            seconds = dose["off_time"] - now
+        if seconds > 0:
+            ml = seconds_to_ml(dose["container_id"], seconds)
+            print(f"Resuming dose of container {dose['container_id']}: {ml:.1f} ml left")
+            add_ml_to_container(dose["container_id"], ml)
+            if dose.get("settled"):
+                pump_journal.record(dose["container_id"], ml)
+
+
+def recover_telemetry():
+    last_time = telemetry_log.open()
+    if last_time is None:
+        return
+    rows = [row for row in history_store.rows(last_time) if row["time"] > last_time]
+    for row in rows:
+        telemetry_log.append(row)
+    if rows:
+        print(f"Telemetry log: {len(rows)} readings recovered from the history store")
+
+
+def log_reading():
+    if not new_reading_for("logging"):
+        return
+    # Built now, with the pump totals of this cycle, and written by the
+    # files sink
+    values, enviro = latest_reading["values"], latest_reading["enviro"]
+    io_pool.submit("files", write_reading,
+                   log_entry_line(Containers, values, enviro, pump_history),
+                   reading_row(Containers, values, enviro, pump_history))
+
+
+def write_reading(log_entry, row):
+    log_write_entry(log_entry, row, local_filepath_log, history_store)
+    telemetry_log.append(row)
+    rollups.add(row["time"], {c: v for c, v in row.items() if c != "time"})
+
+
+def upload_reading():
+    if not new_reading_for("upload") or uploader is None:
+        return
+    # Queue the data for the upload worker, the queue being on the SD card
+    io_pool.submit("upload", uploader.enqueue, build_record(
+        latest_reading["values"], latest_reading["enviro"], pump_history, Containers))
+
+
+def profiled_job(name, function):
+    # Run function under the profiler during the profiled cycle
+    def run():
+        if name == "sensing":
+            profile_state["cycle"] += 1
+        if profile_state["cycle"] != profile_cycle_number:
+            return function()
+        profile_state["profiler"].enable()
+        try:
+            return function()
+        finally:
+            profile_state["profiler"].disable()
+            if name == "upload":
+                profile_state["profiler"].dump_stats(profile_cycle_path)
+                print(f"Profile of cycle {profile_cycle_number} written to {profile_cycle_path}")
+                pstats.Stats(profile_state["profiler"]).sort_stats(
+                    "cumulative").print_stats(20)
+    return run
+
+
 def main():
+    global uploader, history_store, metrics_server
     print("Script is running. Press Ctrl+C to stop.")
+    # Relays keep their state across a crash or a power glitch: every pump is
+    # switched off before anything else
+    stop_all_pumps()
 
+    # Register the cleanup function with atexit
+    atexit.register(cleanup)
+    # Register the signal handler for termination signals
+    signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
+    signal.signal(signal.SIGTERM, signal_handler)  # Handle kill command
+
+    os.makedirs(log_directory, exist_ok=True)
     if not os.path.isfile(local_filepath_log):
         log_initialize(Containers, local_filepath_log)
+    history_store = HistoryStore(history_store_directory)
+    recover_telemetry()
 
-    load_log_pump_ml_added()  # Load ml added data from file
+    pump_journal.load()  # Load ml added data from snapshot and journal
+    # Before any other thread, as the pump process is forked
+    pump_supervisor.start()
+    restore_checkpoint()
 
-    try:
-        while True:
-            current_time = datetime.now()
-            current_seconds = current_time.second
-
-            # Check if we're at the top of the minute (00 second)
-            if current_seconds == 0:
-                print_enviro(cpu)
-
-                values = {c_id: {'tgt': None, 'raw': None, 'pct': None}
-                          for c_id in Containers}
-                for c_id in Containers:
-                    value = get_raw_sensor_value(c_id)
-                    values[c_id]['tgt'] = target_threshold[c_id[0]]
-                    values[c_id]['raw'] = value
-                    values[c_id]['pct'] = get_calibrated_value(c_id, value)
-
-                # Start logging and uploading data in a separate thread
-                threading.Thread(target=log_add_entry, args=(
-                    Containers, values, cpu, local_filepath_log, log_pump_ml_added)).start()
-
-                for container_id in Containers:
-                    check_and_water(container_id, values)
-
-                # Send the data to the server
-                threading.Thread(target=send_data_to_server, args=(
-                    values, cpu, log_pump_ml_added, Containers)).start()
-
-                sleep_duration = 60 - datetime.now().second - 1
-                sleep(sleep_duration)
-            else:
-                sleep(0.2)
+    if metrics_port:
+        try:
+            metrics_server = MetricsServer(metrics_port)
+            metrics_server.start()
+        except OSError as e:
+            print(f"Metrics endpoint not started: {e}")
+
+    if upload_enabled:
+        uploader = Uploader(upload_queue_file_path, upload_url, encoding=upload_encoding)
+        uploader.start()
+    io_pool.start()
+
+    # Jobs sharing a deadline run in this order
+    jobs = {"sensing": sense, "control": control,
+            "logging": log_reading, "upload": upload_reading}
+    for name, function in jobs.items():
+        if profile_cycle_path:
+            function = profiled_job(name, function)
+        scheduler.add_job(name, job_periods[name], function)
 
+    try:
+        scheduler.run()
     except KeyboardInterrupt:
         print("KeyboardInterrupt caught. Exiting...")
     except SystemExit:
@@ -213,31 +452,48 @@ def main():
 
 
 def cleanup():
+    global cleaned_up
+    # Called by the signal handler and again by atexit
+    if cleaned_up:
+        return
+    cleaned_up = True
     print("Performing cleanup...")
-    save_log_pump_ml_added()  # Save ml added data before exiting
-
-    # Stop all pump threads gracefully
-    pump_thread_stop_event.set()
-    for thread in pump_threads:
-        thread.join()
+    scheduler.stop()
+    print(f"Job stats: {scheduler.stats()}")
+    print(f"Sensing stats: {sensing_schedule.stats()}")
+    # Before stopping the pumps, so that the checkpoint holds unfinished doses
+    state = checkpoint_state()
+    # Stop running doses before switching every pump off, then journal what
+    # they actually added
+    pump_supervisor.stop()
+    journal_finished_doses()
+    settle_in_flight(state["in_flight"])
+
+    # Readings still waiting are written before the files are closed. A sink
+    # still running after the timeout keeps its files and the uploader open:
+    # they are left as they are (the journal is replayed at the next start)
+    # rather than closed under its writes.
+    running_sinks = io_pool.stop(timeout=10)
+    print(f"I/O stats: {io_pool.stats()}")
+    if "files" not in running_sinks:
+        pump_journal.snapshot()  # Save ml added data before exiting
+        pump_journal.close()
+        telemetry_log.close()
+        write_checkpoint(state)
+
+    if uploader is not None and "upload" not in running_sinks:
+        uploader.stop(timeout=5)
 
     stop_all_pumps()
+    if metrics_server is not None:
+        metrics_server.stop()
     print("Cleanup complete.")
 
 
-# Register the cleanup function with atexit
-atexit.register(cleanup)
-
-
 def signal_handler(sig, frame):
     print(f"Signal received: {sig}")
     cleanup()
     sys.exit(0)
 
-
-# Register the signal handler for termination signals
-signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
-signal.signal(signal.SIGTERM, signal_handler)  # Handle kill command
-
 if __name__ == "__main__":
     main()
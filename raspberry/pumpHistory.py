@@ -0,0 +1,91 @@
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+from hardware import clock
+
+
+class PumpHistory:
+    """Time-indexed record of the ml added to each container.
+
+    For every container the dose timestamps (epoch seconds) are kept in an
+    array next to a running cumulative total, so the ml added within any time
+    window is one bisect and one subtraction. Doses older than the largest
+    window are dropped and only survive through the cumulative total.
+    """
+
+    def __init__(self, container_ids, max_window_hours):
+        self.max_window_seconds = max_window_hours * 3600
+        self.times = {c_id: array('d') for c_id in container_ids}
+        self.cumulative = {c_id: array('d') for c_id in container_ids}
+        self.compacted_ml = {c_id: 0.0 for c_id in container_ids}
+
+    def add(self, container_id, ml, timestamp=None):
+        if timestamp is None:
+            timestamp = clock.time()
+        times = self.times[container_id]
+        # Keep the index sorted even if the clock stepped backwards
+        if times and timestamp < times[-1]:
+            timestamp = times[-1]
+        times.append(timestamp)
+        self.cumulative[container_id].append(
+            self.total_ml(container_id) + ml)
+        self.compact(container_id, timestamp)
+
+    def total_ml(self, container_id):
+        """Total ml ever added to the container, including compacted doses."""
+        cumulative = self.cumulative[container_id]
+        return cumulative[-1] if cumulative else self.compacted_ml[container_id]
+
+    def ml_since(self, container_id, cutoff):
+        """ml added strictly after the epoch timestamp cutoff."""
+        index = bisect_right(self.times[container_id], cutoff)
+        if index == 0:
+            before = self.compacted_ml[container_id]
+        else:
+            before = self.cumulative[container_id][index - 1]
+        return self.total_ml(container_id) - before
+
+    def window_sums(self, container_id, windows_hours, now=None):
+        """ml added within each window, as {hours: ml}."""
+        if now is None:
+            now = clock.time()
+        return {hours: self.ml_since(container_id, now - hours * 3600)
+                for hours in windows_hours}
+
+    def compact(self, container_id, now=None):
+        """Fold doses older than the largest window into the cumulative total."""
+        if now is None:
+            now = clock.time()
+        times = self.times[container_id]
+        if not times or times[0] > now - self.max_window_seconds:
+            return
+        index = bisect_right(times, now - self.max_window_seconds)
+        cumulative = self.cumulative[container_id]
+        self.compacted_ml[container_id] = cumulative[index - 1]
+        del times[:index]
+        del cumulative[:index]
+
+    def to_dict(self):
+        return {c_id: {"compacted_ml": self.compacted_ml[c_id],
+                       "times": list(self.times[c_id]),
+                       "cumulative": list(self.cumulative[c_id])}
+                for c_id in self.times}
+
+    def load_dict(self, data):
+        """Load the output of to_dict, or the legacy format which stores a
+        list of {"time": isoformat, "ml": ml} entries per container."""
+        for c_id, entries in data.items():
+            if c_id not in self.times:
+                continue
+            self.times[c_id] = array('d')
+            self.cumulative[c_id] = array('d')
+            if isinstance(entries, list):
+                self.compacted_ml[c_id] = 0.0
+                for entry in entries:
+                    self.add(c_id, entry["ml"], datetime.fromisoformat(
+                        entry["time"]).timestamp())
+            else:
+                self.compacted_ml[c_id] = entries["compacted_ml"]
+                self.times[c_id].extend(entries["times"])
+                self.cumulative[c_id].extend(entries["cumulative"])
+            self.compact(c_id)
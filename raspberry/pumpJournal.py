@@ -0,0 +1,133 @@
+import json
+import os
+import zlib
+from hardware import clock
+
+# First line of the journals whose lines end with their checksum. Journals
+# without it were written before, their lines are read without checksum.
+journal_header = "pump-journal v2\n"
+
+
+class PumpJournal:
+    """Write-ahead journal of pump doses on top of a PumpHistory snapshot.
+
+    Every dose is appended to the journal as one short line and fsync'd
+    before it is applied to the history, so a write costs the same whatever
+    the history length. Every compact_every doses the history is written to
+    the snapshot file (temporary file + atomic rename) and the journal is
+    truncated. At startup the snapshot is loaded, the journal replayed and
+    compacted into a new snapshot.
+
+    Journal lines are "seq,timestamp,container_id,ml,crc", crc being the
+    CRC-32 of the rest of the line, so a line torn by a crash is skipped even
+    when what was written of it still parses. The snapshot stores the last
+    seq it contains, so lines still in the journal after a crash between
+    snapshot and truncate are not applied twice. A snapshot that cannot be
+    read is moved to snapshot_path + ".bak" before a new one is written.
+    """
+
+    def __init__(self, pump_history, snapshot_path, journal_path, compact_every=500):
+        self.pump_history = pump_history
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self.seq = 0
+        self.entries_since_snapshot = 0
+        self.journal = None
+
+    def load(self):
+        snapshot_seq = 0
+        if os.path.isfile(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    data = json.load(f)
+                if "history" in data:
+                    snapshot_seq = data["seq"]
+                    self.pump_history.load_dict(data["history"])
+                else:
+                    # pump_ml_log.json written before the journal existed
+                    self.pump_history.load_dict(data)
+            except (json.JSONDecodeError, IOError, KeyError, ValueError) as e:
+                print(f"Error loading pump ml snapshot: {e}")
+                # Kept for inspection, the next snapshot would overwrite it
+                try:
+                    os.replace(self.snapshot_path, self.snapshot_path + ".bak")
+                    print(f"Unreadable snapshot moved to {self.snapshot_path}.bak")
+                except OSError as e:
+                    print(f"Error moving pump ml snapshot aside: {e}")
+        self.seq = snapshot_seq
+
+        replayed = 0
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                lines = f.readlines()
+            checksummed = bool(lines) and lines[0] == journal_header
+            for line in lines[1 if checksummed else 0:]:
+                text = line.rstrip("\n")
+                if checksummed:
+                    text, _, crc = text.rpartition(",")
+                    if f"{zlib.crc32(text.encode()):08x}" != crc:
+                        # Torn last line from a crash during the append
+                        print(f"Skipping pump journal line with a bad checksum: {line!r}")
+                        continue
+                try:
+                    seq, timestamp, container_id, ml = text.split(",")
+                    seq = int(seq)
+                    timestamp = float(timestamp)
+                    ml = float(ml)
+                except ValueError:
+                    # Torn last line from a crash during the append
+                    print(f"Skipping invalid pump journal line: {line!r}")
+                    continue
+                if seq <= snapshot_seq or container_id not in self.pump_history.times:
+                    continue
+                self.pump_history.add(container_id, ml, timestamp)
+                self.seq = max(self.seq, seq)
+                replayed += 1
+        print(f"Pump journal loaded: {replayed} doses replayed")
+        # Start from a fresh journal, which also drops a torn last line
+        self.snapshot()
+
+    def record(self, container_id, ml, timestamp=None):
+        """Durably log a dose, then apply it to the history."""
+        if timestamp is None:
+            timestamp = clock.time()
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+            if self.journal.tell() == 0:
+                self.journal.write(journal_header)
+        self.seq += 1
+        line = f"{self.seq},{timestamp:.3f},{container_id},{ml}"
+        self.journal.write(f"{line},{zlib.crc32(line.encode()):08x}\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pump_history.add(container_id, ml, timestamp)
+
+        self.entries_since_snapshot += 1
+        if self.entries_since_snapshot >= self.compact_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """Write the history to the snapshot file and truncate the journal."""
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"seq": self.seq,
+                           "history": self.pump_history.to_dict()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, 'w')
+            self.journal.write(journal_header)
+            self.journal.flush()
+            self.entries_since_snapshot = 0
+        except IOError as e:
+            print(f"Error saving pump ml snapshot: {e}")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
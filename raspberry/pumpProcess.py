@@ -0,0 +1,490 @@
+# Pump control in a separate process
+# The pumps are run by a PumpSupervisor in a child process, so dose timing
+# does not depend on the GIL or on blocking calls of the controller (uploads,
+# logging, sensor sweeps), and running doses are still stopped on time if the
+# controller stalls. If the controller dies, the child stops every pump and
+# exits. If the child dies, the controller stops every pump and runs the
+# doses from then on with a PumpSupervisor thread of its own, starting with
+# the pump time the child had not run yet.
+#
+# The two processes share one block of memory (multiprocessing.shared_memory)
+# holding:
+#   - a ring of dose commands, written by the controller, read by the child
+#   - a ring of status records (pump started, dose finished), written by the
+#     child, read by the controller
+#   - a table with the running and waiting pump time of every zone, written
+#     by the child and read by the controller without any message
+# The rings have a single producer and a single consumer, each updating only
+# its own index, and the table is protected by a sequence counter per zone,
+# so neither side ever waits for a lock held by the other. Pipes only wake
+# the reader up, and tell each process when the other one is gone.
+
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+import hardware
+import metrics
+from hardware import clock
+from Pump import stop_all_pumps, seconds_to_ml
+from pumpSupervisor import PumpSupervisor, observe_dose, pump_wait, pumps_running, doses_waiting
+from zones import zones
+
+# Commands: kind, container id, ml
+command_record = struct.Struct("<B7x16sd")
+command_dose = 1
+command_shutdown = 2
+
+# Status: kind, interrupted, container id, ml, seconds, submitted, started,
+# actual seconds, actual ml
+status_record = struct.Struct("<B?6x16sdddddd")
+status_started = 1
+status_finished = 2
+
+# Table: records dropped because the status ring was full, then per zone:
+# sequence, off deadline of the running dose (NaN if none), pump seconds
+# waiting
+table_header = struct.Struct("<Q")
+table_entry = struct.Struct("<I4xdd")
+
+max_container_id_bytes = 16
+# The child checks the controller at least this often (seconds)
+check_interval = 0.5
+# Max time submit() waits for a free command slot (seconds)
+submit_timeout = 5.0
+# Max time a read of the zone table retries while its entry is being written
+# (seconds): a child killed during the write leaves it odd for good
+zone_read_timeout = 1.0
+
+nan = float("nan")
+
+status_dropped = metrics.gauge(
+    "irrigation_pump_status_dropped", "Status records of the pump process lost to a full ring")
+
+
+class SpscRing:
+    """Single-producer single-consumer ring of fixed-size records in a
+    shared buffer: head (next record to read) and tail (next slot to write)
+    followed by the slots. Only the consumer writes head and only the
+    producer writes tail."""
+
+    indices = struct.Struct("<QQ")
+
+    def __init__(self, buffer, offset, record, slots):
+        self.buffer = buffer
+        self.offset = offset
+        self.record = record
+        self.slots = slots
+
+    @classmethod
+    def size(cls, record, slots):
+        return cls.indices.size + record.size * slots
+
+    def slot_offset(self, index):
+        return self.offset + self.indices.size + (index % self.slots) * self.record.size
+
+    def put(self, *values):
+        """Append a record, False if the ring is full."""
+        head, tail = self.indices.unpack_from(self.buffer, self.offset)
+        if tail - head >= self.slots:
+            return False
+        self.record.pack_into(self.buffer, self.slot_offset(tail), *values)
+        # Publish the record only once it is written
+        struct.pack_into("<Q", self.buffer, self.offset + 8, tail + 1)
+        return True
+
+    def get(self):
+        """Oldest record, None if the ring is empty."""
+        head, tail = self.indices.unpack_from(self.buffer, self.offset)
+        if head == tail:
+            return None
+        values = self.record.unpack_from(self.buffer, self.slot_offset(head))
+        struct.pack_into("<Q", self.buffer, self.offset, head + 1)
+        return values
+
+
+class Wakeup:
+    """Wake-up signal through a non-blocking pipe.
+
+    Unlike a multiprocessing.Event, no lock is shared, so a process killed
+    while signalling cannot block the other one. Once every process holding
+    the write end is gone, the reader sees the end of the pipe.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def set(self):
+        """Wake the reader up, False if it is gone."""
+        try:
+            os.write(self.write_fd, b"\0")
+        except BlockingIOError:
+            pass  # wake-ups already pending
+        except BrokenPipeError:
+            return False
+        return True
+
+    def clear(self):
+        """Drop pending wake-ups, False once the writers are gone."""
+        try:
+            while True:
+                data = os.read(self.read_fd, 4096)
+                if not data:
+                    return False
+        except BlockingIOError:
+            return True
+
+    def close_read(self):
+        os.close(self.read_fd)
+
+    def close_write(self):
+        os.close(self.write_fd)
+
+
+def wait(wakeups, timeout):
+    select.select([wakeup.read_fd for wakeup in wakeups], [], [], timeout)
+
+
+def encode_id(container_id):
+    encoded = container_id.encode()
+    if len(encoded) > max_container_id_bytes:
+        raise ValueError(f"Container id {container_id} is longer than {max_container_id_bytes} bytes")
+    return encoded
+
+
+def decode_id(encoded):
+    return encoded.rstrip(b"\0").decode()
+
+
+class SharedState:
+    """Views of the rings and the zone table in one shared memory block."""
+
+    def __init__(self, buffer, slots):
+        self.buffer = buffer
+        self.commands = SpscRing(buffer, 0, command_record, slots)
+        status_offset = SpscRing.size(command_record, slots)
+        self.status = SpscRing(buffer, status_offset, status_record, slots)
+        self.table_offset = status_offset + SpscRing.size(status_record, slots)
+
+    @staticmethod
+    def size(slots):
+        return (SpscRing.size(command_record, slots) + SpscRing.size(status_record, slots)
+                + table_header.size + table_entry.size * len(zones))
+
+    def entry_offset(self, i):
+        return self.table_offset + table_header.size + i * table_entry.size
+
+    def write_zone(self, i, deadline, waiting_seconds):
+        # Odd sequence while the entry is being written
+        offset = self.entry_offset(i)
+        (sequence,) = struct.unpack_from("<I", self.buffer, offset)
+        struct.pack_into("<I", self.buffer, offset, sequence + 1)
+        table_entry.pack_into(self.buffer, offset, sequence + 1, deadline, waiting_seconds)
+        struct.pack_into("<I", self.buffer, offset, sequence + 2)
+
+    def read_zone(self, i):
+        offset = self.entry_offset(i)
+        deadline_to_read = time.monotonic() + zone_read_timeout
+        while True:
+            sequence, deadline, waiting_seconds = table_entry.unpack_from(self.buffer, offset)
+            if sequence % 2 == 0 and struct.unpack_from("<I", self.buffer, offset)[0] == sequence:
+                return deadline, waiting_seconds
+            if time.monotonic() > deadline_to_read:
+                raise RuntimeError(f"Zone table entry {i} is still being written")
+
+    def dropped(self):
+        return table_header.unpack_from(self.buffer, self.table_offset)[0]
+
+    def add_dropped(self):
+        table_header.pack_into(self.buffer, self.table_offset, self.dropped() + 1)
+
+
+def run_child(shm, slots, commands_ready, status_ready, max_running):
+    # Ctrl+C reaches the whole process group: the controller decides when to
+    # stop. SIGTERM still stops the pumps on the way out.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    commands_ready.close_write()
+    status_ready.close_read()
+
+    state = SharedState(shm.buf, slots)
+    # Doses started or finished: the zone table is rewritten
+    doses_changed = Wakeup()
+
+    def send(kind, dose):
+        # Called by the supervisor thread only, the single status producer
+        if not state.status.put(
+                kind, dose.get("interrupted", False), encode_id(dose["container_id"]),
+                dose["ml"], dose["seconds"], dose["submitted"], dose["started"],
+                dose.get("actual_seconds", 0.0), dose.get("actual_ml", 0.0)):
+            state.add_dropped()
+        status_ready.set()
+        doses_changed.set()
+
+    supervisor = PumpSupervisor(
+        max_running,
+        on_dose_started=lambda dose: send(status_started, dose),
+        on_dose_done=lambda dose: send(status_finished, dose))
+
+    def publish():
+        with supervisor.lock:
+            deadlines = {dose["container_id"]: deadline for deadline, _, dose in supervisor.running}
+            waiting = {}
+            # Doses not yet taken from the queue by the supervisor thread
+            with supervisor.requests.mutex:
+                queued = [dose for dose in supervisor.requests.queue if dose is not None]
+            for dose in list(supervisor.waiting) + queued:
+                waiting[dose["container_id"]] = waiting.get(dose["container_id"], 0.0) + dose["seconds"]
+        for i, c_id in enumerate(zones.ids):
+            state.write_zone(i, deadlines.get(c_id, nan), waiting.get(c_id, 0.0))
+
+    # Outputs set up again by the process that drives them, every pump off
+    stop_all_pumps()
+    supervisor.start()
+    try:
+        while True:
+            wait([commands_ready, doses_changed], check_interval)
+            doses_changed.clear()
+            controller_alive = commands_ready.clear()
+            shutdown = False
+            while (command := state.commands.get()) is not None:
+                kind, container_id, ml = command
+                if kind == command_shutdown:
+                    shutdown = True
+                    break
+                supervisor.submit(decode_id(container_id), ml)
+            publish()
+            if shutdown:
+                break
+            if not controller_alive:
+                print("Controller process gone, stopping the pumps")
+                break
+    finally:
+        supervisor.stop()
+        stop_all_pumps()
+        publish()
+        status_ready.set()
+        status_ready.close_write()
+        shm.close()
+
+
+class PumpProcess:
+    """Runs the doses in a child process, with the interface of
+    PumpSupervisor.
+
+    A thread of the controller reads the status records of the child to keep
+    completed, the pump metrics and on_dose_done as with PumpSupervisor.
+    in_flight() reads the zone table directly. If the child dies, every pump
+    is stopped from the controller and the doses are run by a PumpSupervisor
+    thread (fallback) instead.
+
+    start() forks the child, so it should be called before other threads are
+    started.
+    """
+
+    def __init__(self, max_running=3, history_size=100, on_dose_done=None, on_dose_started=None,
+                 slots=None):
+        self.max_running = max_running
+        self.on_dose_done = on_dose_done
+        self.on_dose_started = on_dose_started
+        self.completed = deque(maxlen=history_size)
+        # One command per zone and cycle at least, with room for a backlog
+        self.slots = slots if slots is not None else max(64, 4 * len(zones))
+        self.shm = None
+        self.state = None
+        self.process = None
+        self.commands_ready = None
+        self.status_ready = None
+        self.stopping = threading.Event()
+        self.thread = None
+        # Doses started but not finished, as started by the child
+        self.started = {}
+        # PumpSupervisor thread running the doses once the child is gone
+        self.fallback = None
+        self.fallback_lock = threading.Lock()
+
+    def start(self):
+        # fork: the child shares the (simulated) clock and the hardware setup
+        context = multiprocessing.get_context("fork")
+        self.shm = shared_memory.SharedMemory(create=True, size=SharedState.size(self.slots))
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+        self.state = SharedState(self.shm.buf, self.slots)
+        for i in range(len(zones)):
+            self.state.write_zone(i, nan, 0.0)
+        self.commands_ready = Wakeup()
+        self.status_ready = Wakeup()
+        self.process = context.Process(
+            target=run_child, name="pumps", daemon=True,
+            args=(self.shm, self.slots, self.commands_ready, self.status_ready,
+                  self.max_running))
+        self.process.start()
+        self.commands_ready.close_read()
+        self.status_ready.close_write()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f"Pump process started (pid {self.process.pid})")
+
+    def send(self, *command):
+        deadline = time.monotonic() + submit_timeout
+        while not self.state.commands.put(*command):
+            if time.monotonic() > deadline or not self.process.is_alive():
+                raise RuntimeError("Pump process is not taking commands")
+            time.sleep(0.01)
+        if not self.commands_ready.set():
+            raise RuntimeError("Pump process is gone")
+
+    def submit(self, container_id, ml):
+        if self.fallback is None:
+            try:
+                self.send(command_dose, encode_id(container_id), ml)
+                return
+            except RuntimeError as e:
+                if self.process.is_alive():
+                    raise
+                print(f"Pump process: {e}")
+                self.fall_back()
+        self.fallback.submit(container_id, ml)
+
+    def fall_back(self):
+        """Stop every pump and run the doses from a thread of the
+        controller, including the pump time the child had not run yet."""
+        with self.fallback_lock:
+            if self.fallback is not None:
+                return
+            unfinished = self.zone_doses(skip_torn=True)
+            stop_all_pumps()
+            for c_id in list(self.started):
+                self.mirror_pump(c_id, False)
+            self.started.clear()
+
+            def dose_done(dose):
+                self.completed.append(dose)
+                if self.on_dose_done is not None:
+                    self.on_dose_done(dose)
+
+            fallback = PumpSupervisor(self.max_running, on_dose_done=dose_done,
+                                      on_dose_started=self.on_dose_started)
+            fallback.start()
+            for dose in unfinished:
+                if dose["seconds_remaining"] > 0:
+                    fallback.submit(dose["container_id"],
+                                    seconds_to_ml(dose["container_id"], dose["seconds_remaining"]))
+            self.fallback = fallback
+            print(f"Pumps now run by the controller, {len(unfinished)} unfinished dose(s) resumed")
+
+    def stop(self):
+        """Stop all pumps, including doses in progress, and end the child."""
+        if self.process is None:
+            return
+        self.stopping.set()
+        if self.fallback is not None:
+            self.fallback.stop()
+        if self.process.is_alive():
+            try:
+                self.send(command_shutdown, b"", 0.0)
+            except RuntimeError as e:
+                print(f"Pump process: {e}")
+            self.process.join(10)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(5)
+        # The status thread ends with the child
+        self.thread.join()
+        self.read_status()
+        self.commands_ready.close_write()
+        self.status_ready.close_read()
+        self.state = None
+        self.shm.close()
+        self.shm.unlink()
+        self.process = None
+
+    def in_flight(self):
+        """Running and waiting doses with the pump seconds they still need,
+        one entry per zone and state."""
+        if self.fallback is not None:
+            return self.fallback.in_flight()
+        try:
+            return self.zone_doses()
+        except RuntimeError as e:
+            if self.process.is_alive():
+                raise
+            # The child died while writing the table
+            print(f"Pump process: {e}")
+            self.fall_back()
+            return self.fallback.in_flight()
+
+    def zone_doses(self, skip_torn=False):
+        """Doses of the zone table, see in_flight(). With skip_torn, the
+        zones whose entry a dead child left half-written are left out."""
+        now = clock.monotonic()
+        wall_now = clock.time()
+        doses = []
+        for i, c_id in enumerate(zones.ids):
+            try:
+                deadline, waiting_seconds = self.state.read_zone(i)
+            except RuntimeError:
+                if not skip_torn:
+                    raise
+                print(f"Pump process died while updating zone {c_id}, its doses are not resumed")
+                continue
+            if deadline == deadline:  # not NaN
+                doses.append({"container_id": c_id, "seconds_remaining": max(0.0, deadline - now),
+                              "off_time": wall_now + max(0.0, deadline - now)})
+            if waiting_seconds > 0:
+                doses.append({"container_id": c_id, "seconds_remaining": waiting_seconds,
+                              "off_time": None})
+        return doses
+
+    def run(self):
+        while True:
+            wait([self.status_ready], check_interval)
+            child_alive = self.status_ready.clear()
+            self.read_status()
+            if not child_alive:
+                if not self.stopping.is_set():
+                    print("Pump process died, stopping the pumps")
+                    self.fall_back()
+                break
+
+    def read_status(self):
+        while (status := self.state.status.get()) is not None:
+            (kind, interrupted, container_id, ml, seconds, submitted, started,
+             actual_seconds, actual_ml) = status
+            dose = {"container_id": decode_id(container_id), "ml": ml, "seconds": seconds,
+                    "submitted": submitted, "started": started}
+            if kind == status_started:
+                pump_wait.observe(started - submitted)
+                self.started[dose["container_id"]] = dose
+                self.mirror_pump(dose["container_id"], True)
+                if self.on_dose_started is not None:
+                    self.on_dose_started(dose)
+                continue
+            dose.update(actual_seconds=actual_seconds, actual_ml=actual_ml, interrupted=interrupted)
+            self.started.pop(dose["container_id"], None)
+            self.mirror_pump(dose["container_id"], False)
+            self.completed.append(dose)
+            observe_dose(dose)
+            if self.on_dose_done is not None:
+                self.on_dose_done(dose)
+        pumps_running.set(len(self.started))
+        try:
+            doses_waiting.set(sum(1 for i in range(len(zones)) if self.state.read_zone(i)[1] > 0))
+        except RuntimeError:
+            # Entry left half-written by a dead child, which run() falls back from
+            pass
+        status_dropped.set(self.state.dropped())
+
+    def mirror_pump(self, container_id, on):
+        # The simulated soil is read by the controller: mirror the pumps of
+        # the child into it
+        if hardware.simulated:
+            i = zones.index[container_id]
+            hardware.get_soil_model().set_pump(zones.gpio_bank[i], zones.pin[i], on)
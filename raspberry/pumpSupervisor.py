@@ -0,0 +1,158 @@
+import heapq
+import queue
+import threading
+from collections import deque
+import metrics
+from hardware import clock
+from Pump import start_pump, stop_pump, seconds_for_pump, seconds_to_ml
+
+pump_requested_seconds = metrics.counter(
+    "irrigation_pump_requested_seconds_total", "Pump on-time requested by finished doses", ["container"])
+pump_on_seconds = metrics.counter(
+    "irrigation_pump_on_seconds_total", "Measured pump on-time of finished doses", ["container"])
+pump_doses = metrics.counter(
+    "irrigation_pump_doses_total", "Finished doses", ["container", "interrupted"])
+pump_on_time_error = metrics.histogram(
+    "irrigation_pump_on_time_error_seconds", "Measured minus requested on-time of a dose",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+pump_wait = metrics.histogram(
+    "irrigation_pump_wait_seconds", "Time from submission to pump start of a dose")
+pumps_running = metrics.gauge("irrigation_pumps_running", "Pumps running")
+doses_waiting = metrics.gauge("irrigation_doses_waiting", "Doses waiting for a free pump slot")
+
+
+def observe_dose(dose):
+    # Metrics of a finished dose
+    pump_requested_seconds.inc(dose["seconds"], container=dose["container_id"])
+    pump_on_seconds.inc(dose["actual_seconds"], container=dose["container_id"])
+    pump_doses.inc(container=dose["container_id"], interrupted=dose["interrupted"])
+    if not dose["interrupted"]:
+        pump_on_time_error.observe(dose["actual_seconds"] - dose["seconds"])
+
+
+class PumpSupervisor:
+    """Runs every pump dose from a single thread.
+
+    Doses are submitted through a queue. Running pumps are kept in a heap of
+    pump-off deadlines and the thread sleeps exactly until the next deadline
+    or the next submission. At most max_running pumps run at the same time
+    to limit the power draw; further doses wait in submission order, and a
+    container only runs one dose at a time.
+
+    The actual on-time of every dose is measured between start_pump and
+    stop_pump and kept in completed (most recent last). Doses are passed to
+    on_dose_started when their pump starts and to on_dose_done when it stops.
+    """
+
+    def __init__(self, max_running=3, history_size=100, on_dose_done=None, on_dose_started=None):
+        self.max_running = max_running
+        self.on_dose_done = on_dose_done
+        self.on_dose_started = on_dose_started
+        self.requests = queue.Queue()
+        self.waiting = deque()
+        self.running = []  # heap of (off_deadline, seq, dose)
+        self.completed = deque(maxlen=history_size)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, container_id, ml):
+        self.requests.put({"container_id": container_id, "ml": ml,
+                           "seconds": seconds_for_pump(container_id, ml),
+                           "submitted": clock.monotonic()})
+
+    def stop(self):
+        """Stop all pumps, including doses in progress, and end the thread."""
+        if self.thread is not None and self.thread.is_alive():
+            self.requests.put(None)
+            self.thread.join()
+
+    def in_flight(self):
+        """Running and waiting doses with the pump seconds they still need,
+        and for the running ones the wall-clock time (epoch seconds) their
+        pump goes off (None for the waiting ones)."""
+        now = clock.monotonic()
+        wall_now = clock.time()
+        with self.lock:
+            doses = [{"container_id": dose["container_id"],
+                      "seconds_remaining": max(0.0, deadline - now),
+                      "off_time": wall_now + max(0.0, deadline - now)}
+                     for deadline, _, dose in self.running]
+            doses += [{"container_id": dose["container_id"],
+                       "seconds_remaining": dose["seconds"],
+                       "off_time": None}
+                      for dose in self.waiting]
+        return doses
+
+    def run(self):
+        try:
+            while True:
+                timeout = None
+                if self.running:
+                    timeout = clock.real_seconds(
+                        max(0.0, self.running[0][0] - clock.monotonic()))
+                try:
+                    dose = self.requests.get(timeout=timeout)
+                    if dose is None:
+                        break
+                    with self.lock:
+                        self.waiting.append(dose)
+                except queue.Empty:
+                    pass
+
+                self.stop_due_pumps()
+                self.start_waiting_pumps()
+                pumps_running.set(len(self.running))
+                doses_waiting.set(len(self.waiting))
+        finally:
+            with self.lock:
+                for _, _, dose in self.running:
+                    self.finish(dose, interrupted=True)
+                self.running = []
+                self.waiting.clear()
+
+    def stop_due_pumps(self):
+        with self.lock:
+            while self.running and self.running[0][0] <= clock.monotonic():
+                _, _, dose = heapq.heappop(self.running)
+                self.finish(dose, interrupted=False)
+
+    def start_waiting_pumps(self):
+        with self.lock:
+            busy = {dose["container_id"] for _, _, dose in self.running}
+            for dose in list(self.waiting):
+                if len(self.running) >= self.max_running:
+                    break
+                if dose["container_id"] in busy:
+                    continue
+                self.waiting.remove(dose)
+                busy.add(dose["container_id"])
+                start_pump(dose["container_id"])
+                dose["started"] = clock.monotonic()
+                pump_wait.observe(dose["started"] - dose["submitted"])
+                self.seq += 1
+                heapq.heappush(
+                    self.running, (dose["started"] + dose["seconds"], self.seq, dose))
+                if self.on_dose_started is not None:
+                    self.on_dose_started(dose)
+                print(
+                    f"Pump {dose['container_id']} on for {dose['ml']:.0f} ml ({dose['seconds']:.2f}s), "
+                    f"waited {dose['started'] - dose['submitted']:.1f}s")
+
+    def finish(self, dose, interrupted):
+        stop_pump(dose["container_id"])
+        actual_seconds = clock.monotonic() - dose["started"]
+        dose["actual_seconds"] = actual_seconds
+        dose["actual_ml"] = seconds_to_ml(dose["container_id"], actual_seconds)
+        dose["interrupted"] = interrupted
+        self.completed.append(dose)
+        observe_dose(dose)
+        print(
+            f"Pump {dose['container_id']} off after {actual_seconds:.3f}s "
+            f"(requested {dose['seconds']:.3f}s, {dose['actual_ml']:.1f} ml)" + (" - interrupted" if interrupted else ""))
+        if self.on_dose_done is not None:
+            self.on_dose_done(dose)
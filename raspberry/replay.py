@@ -0,0 +1,299 @@
+# Replay of recorded readings
+# Streams the rows of log.csv (or of a history store) through the control
+# functions of main.py (low_pass_filter, check_and_water and
+# watering_allowed_ml_time_based) on a virtual clock set to the time of each
+# row: no sleeps, no hardware, no files written. The doses decided by the
+# replay are compared with the doses recorded in the log (the increase of the
+# cumulative pump ml of each container between two rows).
+#
+# Containers without a value at a row (failed reads, or not read at that
+# minute, see sensingSchedule.py) are skipped, as by the controller.
+#
+# The dose of the first row is not known, and doses made before the first row
+# are not in the replayed history, so the first rows can disagree.
+#
+# Settings can be changed for the replay to check a config change before it
+# is deployed:
+#   python3 replay.py log/log.csv
+#   python3 replay.py log/history --p-factor 20 --target A=0.7 --threshold-scale 0.8
+#   python3 replay.py log/log.csv --filter-factor 5 --output decisions.csv
+#
+# --recalibrate recomputes the percentages from the raw values with the
+# calibration in effect at each row (see calibration.py).
+
+import argparse
+import contextlib
+import csv
+import functools
+import itertools
+import math
+import os
+import tempfile
+import time
+
+# Before importing main: simulated devices, a virtual clock and no metrics
+# endpoint. Nothing is written to the log directory by the replay.
+os.environ["IRRIGATION_BACKEND"] = "sim"
+os.environ["IRRIGATION_SIM_SPEED"] = "virtual"
+os.environ["IRRIGATION_METRICS_PORT"] = "0"
+os.environ.setdefault("IRRIGATION_LOG_DIR", os.path.join(tempfile.gettempdir(), "irrigation_replay"))
+
+import control  # noqa: E402
+import main  # noqa: E402
+from hardware import clock  # noqa: E402
+from historyStore import HistoryStore, csv_columns  # noqa: E402
+from pumpHistory import PumpHistory  # noqa: E402
+
+# Recorded cumulative ml going down by more than this (counter reset, old
+# logs holding a window sum) starts a new baseline instead of a dose
+ml_tolerance = 0.5
+
+
+def read_csv_rows(path):
+    """Rows of log.csv as dicts of history store columns, in time order."""
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        names = csv_columns(next(reader))
+        last_time = None
+        hour_starts = {}
+        numbers = Numbers()
+        for line in reader:
+            if not line:
+                continue
+            # log.csv holds local time. Parsing is the slow part of a replay,
+            # so the start of each hour is converted once.
+            hour = line[0][:13]
+            hour_start = hour_starts.get(hour)
+            if hour_start is None:
+                hour_start = hour_starts[hour] = time.mktime(time.strptime(hour, "%Y-%m-%d %H"))
+            timestamp = hour_start + int(line[0][14:16]) * 60 + int(line[0][17:19])
+            if last_time is not None and timestamp < last_time:
+                timestamp = last_time
+            last_time = timestamp
+            row = dict(zip(names, map(numbers.__getitem__, line[1:])))
+            row["time"] = timestamp
+            yield row
+
+
+def read_store_rows(directory):
+    store = HistoryStore(directory)
+    columns = set()
+    for day in store.index:
+        columns.update(name[:-len(".f64")] for name in os.listdir(os.path.join(directory, day))
+                       if name.endswith(".f64"))
+    columns.discard("time")
+    data = store.query(-math.inf, math.inf, sorted(columns))
+    names = list(data)
+    for values in zip(*data.values()):
+        yield {name: (None if value != value else value) for name, value in zip(names, values)}
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class Numbers(dict):
+    """Parsed values by their text. Targets, pump totals and temperatures
+    repeat over many rows, so most values are converted once."""
+
+    def __missing__(self, text):
+        value = self[text] = to_number(text)
+        return value
+
+
+def containers_of(row):
+    return [name[:-len("_pct")] for name in row if name.endswith("_pct")]
+
+
+@contextlib.contextmanager
+def settings(p_factor=None, filter_factor=None, threshold_scale=None):
+    """Control settings of main.py changed for the duration of a replay."""
+    saved = {name: getattr(main, name) for name in
+             ("P_factor", "low_pass_filter_step", "watering_thresholds")}
+    if p_factor is not None:
+        main.P_factor = p_factor
+    if filter_factor is not None:
+        main.low_pass_filter_step = functools.partial(control.low_pass_filter_step, factor=filter_factor)
+    if threshold_scale is not None:
+        main.watering_thresholds = {hours: max_ml * threshold_scale
+                                    for hours, max_ml in control.watering_thresholds.items()}
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(main, name, value)
+
+
+class ReplayJournal:
+    """Stands in for the PumpJournal of main.py: doses go to the history
+    only."""
+
+    def __init__(self, pump_history):
+        self.pump_history = pump_history
+
+    def record(self, container_id, ml):
+        self.pump_history.add(container_id, ml)
+
+
+def replay(rows, targets=None, recalibrate=False, on_decision=None):
+    """Run the control functions of main.py over rows, return per container
+    totals of the recorded and replayed doses.
+
+    targets maps a container id or group to a target replacing the recorded
+    one. on_decision(row time, container id, pct, filtered pct, recorded ml,
+    replayed ml) is called for every container and row where the log or the
+    replay has a dose.
+    """
+    targets = targets or {}
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return {}
+    containers = containers_of(first)
+    calibrations = None
+    recalibrated = {}
+    if recalibrate:
+        from calibration import calibrations
+
+    main.pump_history = PumpHistory(containers, max(main.watering_thresholds))
+    main.pump_journal = ReplayJournal(main.pump_history)
+    main.low_pass_filter_values = {c_id: None for c_id in containers}
+    main.low_pass_filter_times = {c_id: None for c_id in containers}
+    dosed = {}
+    main.add_ml_to_container = lambda container_id, ml: dosed.__setitem__(container_id, ml)
+
+    totals = {c_id: {"rows": 0, "recorded_doses": 0, "recorded_ml": 0.0,
+                     "replayed_doses": 0, "replayed_ml": 0.0, "disagreements": 0}
+              for c_id in containers}
+    previous_ml = {c_id: None for c_id in containers}
+    values = {c_id: {"tgt": None, "raw": None, "pct": None} for c_id in containers}
+    # Everything looked up per container, so that a row costs little more
+    # than the control functions themselves
+    columns = []
+    for c_id in containers:
+        group = main.zones.group[main.zones.index[c_id]] if c_id in main.zones.index else None
+        target = targets.get(c_id, targets.get(group))
+        columns.append((c_id, values[c_id], target, f"{c_id}_tgt", f"{c_id}_raw",
+                        f"{c_id}_pct", f"{c_id}_pump_ml", totals[c_id]))
+    check_and_water = main.check_and_water
+    num_rows = 0
+
+    # check_and_water prints every decision
+    main.print = lambda *args, **kwargs: None
+    try:
+        for row in itertools.chain([first], rows):
+            now = row["time"]
+            clock.set(now)
+            num_rows += 1
+            dosed.clear()
+            for c_id, value, target, tgt_column, raw_column, pct_column, _, _ in columns:
+                pct = row[pct_column]
+                raw = row[raw_column]
+                if recalibrate and raw is not None:
+                    curve = calibrations.set_at(now).curve(c_id)
+                    if curve is not None:
+                        # Raw values and temperatures repeat, so do fractions
+                        key = (curve, raw, row.get("room_temp_SHT40"))
+                        pct = recalibrated.get(key)
+                        if pct is None:
+                            pct = recalibrated[key] = curve.value(raw, key[2])
+                if target is None:
+                    value["tgt"] = row[tgt_column]
+                else:
+                    value["tgt"] = target
+                value["raw"] = raw
+                value["pct"] = pct
+                if pct is not None and value["tgt"] is not None:
+                    check_and_water(c_id, values)
+
+            for c_id, value, _, _, _, _, ml_column, total in columns:
+                cumulative = row[ml_column]
+                previous = previous_ml[c_id]
+                if cumulative is not None:
+                    previous_ml[c_id] = cumulative
+                if previous is None:
+                    # No recorded dose is known before the first pump total
+                    continue
+                recorded = 0.0
+                if cumulative is not None and cumulative > previous + ml_tolerance:
+                    recorded = cumulative - previous
+                replayed = dosed.get(c_id, 0.0)
+                if not recorded and not replayed:
+                    continue
+                if recorded:
+                    total["recorded_doses"] += 1
+                    total["recorded_ml"] += recorded
+                if replayed:
+                    total["replayed_doses"] += 1
+                    total["replayed_ml"] += replayed
+                if not recorded or not replayed:
+                    total["disagreements"] += 1
+                if on_decision is not None:
+                    on_decision(now, c_id, value["pct"], main.low_pass_filter_values[c_id],
+                                recorded, replayed)
+    finally:
+        del main.print
+
+    for total in totals.values():
+        total["rows"] = num_rows
+    return totals
+
+
+def parse_targets(items):
+    targets = {}
+    for item in items or []:
+        name, _, value = item.partition("=")
+        targets[name] = float(value)
+    return targets
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay recorded readings through the controller")
+    parser.add_argument("source", help="log.csv or a history store directory")
+    parser.add_argument("--p-factor", type=float)
+    parser.add_argument("--filter-factor", type=float)
+    parser.add_argument("--threshold-scale", type=float, help="factor applied to every ml limit")
+    parser.add_argument("--target", action="append", metavar="ID=VALUE",
+                        help="target of a container or group, e.g. A=0.7 or B2=0.5")
+    parser.add_argument("--recalibrate", action="store_true",
+                        help="recompute the percentages from the raw values")
+    parser.add_argument("--output", help="CSV of the rows where the replay and the log disagree")
+    args = parser.parse_args()
+
+    rows = read_store_rows(args.source) if os.path.isdir(args.source) else read_csv_rows(args.source)
+
+    output = None
+    on_decision = None
+    if args.output:
+        output = open(args.output, 'w', newline='')
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["date time", "container", "pct", "filtered pct", "recorded ml", "replayed ml"])
+
+        def write_disagreement(timestamp, c_id, pct, filtered, recorded, replayed):
+            if bool(recorded) != bool(replayed):
+                writer.writerow([time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), c_id,
+                                 pct, None if filtered is None else round(filtered, 4),
+                                 round(recorded, 1), round(replayed, 1)])
+        on_decision = write_disagreement
+
+    started = time.perf_counter()
+    with settings(args.p_factor, args.filter_factor, args.threshold_scale):
+        totals = replay(rows, parse_targets(args.target), args.recalibrate, on_decision)
+    elapsed = time.perf_counter() - started
+    if output is not None:
+        output.close()
+
+    num_rows = max((total["rows"] for total in totals.values()), default=0)
+    print(f"Replayed {num_rows} rows of {len(totals)} containers in {elapsed:.2f}s")
+    print(f"{'container':<10} {'recorded doses':>15} {'recorded ml':>12} "
+          f"{'replayed doses':>15} {'replayed ml':>12} {'disagreements':>14}")
+    for c_id, total in totals.items():
+        print(f"{c_id:<10} {total['recorded_doses']:>15} {total['recorded_ml']:>12.0f} "
+              f"{total['replayed_doses']:>15} {total['replayed_ml']:>12.0f} {total['disagreements']:>14}")
+
+
+if __name__ == "__main__":
+    main_cli()
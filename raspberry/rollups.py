@@ -0,0 +1,98 @@
+import json
+import time
+
+# Bucket lengths (seconds) of the rollups, aligned on UTC
+rollup_periods = {"hour": 3600, "day": 86400}
+
+
+def utc_string(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
+
+
+class Rollups:
+    """Hourly and daily aggregates of the readings, updated one reading at a
+    time.
+
+    Every channel (an environmental value or a container column, named as in
+    the history store) keeps count, sum, min and max for the open bucket of
+    each period. Cumulative channels (the pump ml totals) keep their last
+    value instead, and the ml added during the bucket is the difference with
+    the last value of the previous bucket. Memory does not grow with the
+    number of readings.
+
+    When a reading falls into a new bucket, the previous one is closed and
+    written as one JSON line to path, and passed to on_close if given.
+    """
+
+    def __init__(self, path, cumulative=(), on_close=None):
+        self.path = path
+        self.cumulative = set(cumulative)
+        self.on_close = on_close
+        # Per period: start of the open bucket and the aggregates per channel
+        self.buckets = {period: {"start": None, "channels": {}} for period in rollup_periods}
+        # Last value of each cumulative channel in the previous bucket
+        self.previous_last = {period: {} for period in rollup_periods}
+
+    def add(self, timestamp, values):
+        for period, seconds in rollup_periods.items():
+            bucket = self.buckets[period]
+            start = timestamp - timestamp % seconds
+            if bucket["start"] is not None and start > bucket["start"]:
+                self.close(period)
+            if bucket["start"] is None or start > bucket["start"]:
+                bucket["start"] = start
+            channels = bucket["channels"]
+            for channel, value in values.items():
+                if value is None:
+                    continue
+                aggregate = channels.get(channel)
+                if channel in self.cumulative:
+                    if aggregate is None:
+                        channels[channel] = {"first": value, "last": value}
+                    else:
+                        aggregate["last"] = value
+                elif aggregate is None:
+                    channels[channel] = {"count": 1, "sum": value, "min": value, "max": value}
+                else:
+                    aggregate["count"] += 1
+                    aggregate["sum"] += value
+                    if value < aggregate["min"]:
+                        aggregate["min"] = value
+                    if value > aggregate["max"]:
+                        aggregate["max"] = value
+
+    def close(self, period):
+        bucket = self.buckets[period]
+        if bucket["start"] is None or not bucket["channels"]:
+            return None
+        record = {"period": period, "start": utc_string(bucket["start"]),
+                  "channels": {}, "cumulative": {}}
+        previous_last = self.previous_last[period]
+        for channel, aggregate in bucket["channels"].items():
+            if channel in self.cumulative:
+                before = previous_last.get(channel, aggregate["first"])
+                record["cumulative"][channel] = {"last": aggregate["last"],
+                                                 "added": aggregate["last"] - before}
+                previous_last[channel] = aggregate["last"]
+            else:
+                record["channels"][channel] = dict(
+                    aggregate, mean=aggregate["sum"] / aggregate["count"])
+        bucket["start"] = None
+        bucket["channels"] = {}
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if self.on_close is not None:
+            self.on_close(record)
+        return record
+
+    def to_dict(self):
+        # Open buckets, kept in the checkpoint across restarts
+        return {"buckets": self.buckets, "previous_last": self.previous_last}
+
+    def load_dict(self, data):
+        for period in rollup_periods:
+            if period in data.get("buckets", {}):
+                self.buckets[period] = data["buckets"][period]
+            if period in data.get("previous_last", {}):
+                self.previous_last[period] = data["previous_last"][period]
@@ -0,0 +1,95 @@
+import heapq
+import threading
+import metrics
+from hardware import clock
+
+job_duration = metrics.histogram(
+    "irrigation_job_duration_seconds", "Duration of each run of a job of the main loop", ["job"])
+job_lateness = metrics.histogram(
+    "irrigation_job_lateness_seconds", "Start of a job run after its deadline", ["job"])
+job_overruns = metrics.counter(
+    "irrigation_job_overruns_total", "Job runs still going at their next deadline", ["job"])
+job_skipped = metrics.counter(
+    "irrigation_job_skipped_total", "Job runs skipped after an overrun", ["job"])
+job_failures = metrics.counter(
+    "irrigation_job_failures_total", "Job runs that raised an exception", ["job"])
+
+
+class Scheduler:
+    """Runs periodic jobs on deadlines of the monotonic clock.
+
+    Each job has a period and an offset, both in seconds. The first deadline
+    is aligned on the wall clock (a 60 s job with offset 0 starts at the top
+    of a minute) and later deadlines advance by whole periods, so the
+    cadence does not drift with the duration of the jobs. Jobs sharing a
+    deadline run in the order they were added.
+
+    A job that is still running at its next deadline counts as an overrun.
+    The deadlines it missed are skipped instead of being run in a burst.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.stop_event = threading.Event()
+
+    def add_job(self, name, period, function, offset=0):
+        self.jobs.append({"name": name, "period": period, "offset": offset,
+                          "function": function, "runs": 0, "overruns": 0,
+                          "skipped": 0, "last_duration": 0.0,
+                          "max_duration": 0.0, "max_lateness": 0.0})
+
+    def first_deadline(self, job, now, monotonic_now):
+        wait = (job["offset"] - now) % job["period"]
+        return monotonic_now + wait
+
+    def run(self):
+        # One reading of the clocks for every job, so that jobs meant to
+        # share a deadline get exactly the same one and run in order
+        now, monotonic_now = clock.time(), clock.monotonic()
+        queue = [(self.first_deadline(job, now, monotonic_now), order, job)
+                 for order, job in enumerate(self.jobs)]
+        heapq.heapify(queue)
+
+        while not self.stop_event.is_set():
+            deadline, order, job = queue[0]
+            wait = deadline - clock.monotonic()
+            if wait > 0:
+                self.stop_event.wait(clock.real_seconds(wait))
+                continue
+            heapq.heappop(queue)
+
+            start = clock.monotonic()
+            try:
+                job["function"]()
+            except Exception as e:
+                job_failures.inc(job=job["name"])
+                print(f"Job {job['name']} failed: {e!r}")
+            end = clock.monotonic()
+
+            duration = end - start
+            job["runs"] += 1
+            job["last_duration"] = duration
+            job["max_duration"] = max(job["max_duration"], duration)
+            job["max_lateness"] = max(job["max_lateness"], start - deadline)
+            job_duration.observe(duration, job=job["name"])
+            job_lateness.observe(start - deadline, job=job["name"])
+
+            next_deadline = deadline + job["period"]
+            if end > next_deadline:
+                missed = int((end - deadline) // job["period"])
+                job["overruns"] += 1
+                job["skipped"] += missed
+                job_overruns.inc(job=job["name"])
+                job_skipped.inc(missed, job=job["name"])
+                next_deadline = deadline + (missed + 1) * job["period"]
+                print(
+                    f"Job {job['name']} overran its {job['period']}s period (done {end - deadline:.1f}s after its deadline), {missed} run(s) skipped")
+            heapq.heappush(queue, (next_deadline, order, job))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {job["name"]: {key: value for key, value in job.items()
+                              if key != "function"}
+                for job in self.jobs}
@@ -1,8 +1,11 @@
 import requests
-import json
-from TemperatureHumidity import getTemperatureHumiditySHT40
-from Pressure import getTemperaturePressureBMP280
-from helpers import get_datetime_utc_string
+from requests.adapters import HTTPAdapter
+import random
+import threading
+from time import monotonic
+import metrics
+from uploadQueue import UploadQueue
+import telemetry
 
 
 # Global API configuration
@@ -10,30 +13,54 @@ from helpers import get_datetime_utc_string
 api = {"url": 'https://irrigationmars.com/api/api_store_data.php',
        "key": 'hiufew8GQRYHW%W651#!!&79uojjbho89gRWpio'}
 
+# Connect and read timeouts of one request (seconds)
+upload_timeout = (5, 30)
+# Max records per request, used when backfilling after an outage
+upload_batch_size = 60
+# Encoding of the uploads: "json" for api_store_data.php, or "telemetry" for
+# the compressed binary batches of telemetry.py (API key sent as a header)
+upload_encodings = ("json", "telemetry")
+# Wait between failed attempts, doubled after each failure (seconds)
+upload_backoff = {"min": 5, "max": 600}
+# Server errors (5xx other than 503) in a row on the same batch before the
+# record the server fails on is looked for: the batch is halved at each
+# further server error, down to one record, which is moved to the dead-letter
+# table of the queue so that it does not hold back the ones behind it.
+# Network errors and 503 (server busy) are retried until they succeed.
+upload_max_server_errors = 10
 
-def send_data_to_server(values, cpu, log_pump_ml_added, Containers):
-    global api
-    cpuTempC = round(cpu.temperature, 1)
-    roomTempC_SHT40, roomHumiditySHT40 = getTemperatureHumiditySHT40()
-    roomTempC_BMP280, roomPressureBMP280 = getTemperaturePressureBMP280()
+upload_seconds = metrics.histogram(
+    "irrigation_upload_seconds", "Duration of an upload request", ["status"])
+upload_failures = metrics.counter(
+    "irrigation_upload_failures_total", "Failed upload requests", ["reason"])
+uploaded_records = metrics.counter(
+    "irrigation_uploaded_records_total", "Records accepted or rejected by the server, or moved to the dead-letter table", ["result"])
+upload_backlog = metrics.gauge(
+    "irrigation_upload_queue_records", "Records waiting in the upload queue")
+
+
+def build_record(values, enviro, pump_history, Containers):
+    cpuTempC = enviro.cpu_temp
 
     # Limit the values to 1 digit after the comma
-    roomTempC_SHT40 = round(roomTempC_SHT40, 1)
-    roomTempC_BMP280 = round(roomTempC_BMP280, 1)
-    roomHumiditySHT40 = round(roomHumiditySHT40, 1)
-    roomPressureBMP280 = round(roomPressureBMP280, 1)
+    roomTempC_SHT40 = round(enviro.room_temp_SHT40, 1)
+    roomTempC_BMP280 = round(enviro.room_temp_BMP280, 1)
+    roomHumiditySHT40 = round(enviro.room_humidity_SHT40, 1)
+    roomPressureBMP280 = round(enviro.room_pressure_BMP280, 1)
 
-    # Get the current datetime in the correct format
-    datetime = get_datetime_utc_string()  # This should return a formatted timestamp
+    # Time at which the environmental sensors were read
+    datetime = enviro.datetime_utc_string
 
     # Gather dynamic sensor values
     sensor_data = []
 
     for container_id in Containers:
-        # Calculate total pump ml added from log_pump_ml_added
-        # Sum ml added entries
-        pump_ml_added = sum(entry["ml"]
-                            for entry in log_pump_ml_added[container_id])
+        # Containers without a reading are left out: the servers refuse
+        # null values
+        if values[container_id]['raw'] is None or values[container_id]['pct'] is None:
+            continue
+        # Cumulative pump ml added to the container
+        pump_ml_added = pump_history.total_ml(container_id)
         data = {
             'container_id': container_id,
             'humidity_tgt': values[container_id]['tgt'],
@@ -45,9 +72,7 @@ def send_data_to_server(values, cpu, log_pump_ml_added, Containers):
         # Append a dictionary with the sensor values to the list
         sensor_data.append(data)
 
-    # Create the payload for the API request
-    payload = {
-        "api_key": api["key"],
+    return {
         "date_time": datetime,
         "cpu_temp": cpuTempC,
         "room_temp_SHT40": roomTempC_SHT40,
@@ -57,12 +82,144 @@ def send_data_to_server(values, cpu, log_pump_ml_added, Containers):
         "containers": sensor_data
     }
 
-    # Send the data to the server
-    print("sending to server")
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(api["url"], headers=headers, json=payload)
 
-    if response.status_code == 200:
-        print("Data sent successfully:", response.json())
-    else:
-        print("Failed to send data:", response.status_code, response.json())
+def build_payload(records):
+    # Multi-record payload accepted by api_store_data.php
+    return {
+        "api_key": api["key"],
+        "records": records
+    }
+
+
+class Uploader:
+    """Uploads records from an on-disk queue with a single worker thread.
+
+    Records are queued with enqueue() and survive network outages and
+    restarts. The worker drains the queue in batches of up to batch_size
+    records over one keep-alive session, and backs off exponentially while
+    the server cannot be reached.
+    """
+
+    def __init__(self, queue_path, url=None, batch_size=upload_batch_size, encoding="json"):
+        if encoding not in upload_encodings:
+            raise ValueError(f"Unknown upload encoding {encoding}")
+        self.queue = UploadQueue(queue_path)
+        self.url = url if url is not None else api["url"]
+        self.batch_size = batch_size
+        self.encoding = encoding
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def enqueue(self, record):
+        self.queue.put(record)
+        upload_backlog.set(len(self.queue))
+        self.wake_event.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                # Still inside a request: the queue is left open under it,
+                # the records stay on disk for the next start
+                print("Upload worker did not stop, upload queue left open")
+                return
+        self.session.close()
+        self.queue.close()
+
+    def send_batch(self, records):
+        """Post records, return "done" when they can be removed from the
+        queue, "server_error" when the server failed on them and "failed"
+        otherwise."""
+        print(f"sending {len(records)} record(s) to server")
+        start_time = monotonic()
+        try:
+            if self.encoding == "telemetry":
+                batch = telemetry.encode_batch([telemetry.record_row(r) for r in records])
+                response = self.session.post(
+                    self.url, data=batch,
+                    headers={'Content-Type': telemetry.content_type, 'X-Api-Key': api["key"]},
+                    timeout=upload_timeout)
+            else:
+                response = self.session.post(
+                    self.url, json=build_payload(records), timeout=upload_timeout)
+        except requests.exceptions.RequestException as e:
+            upload_seconds.observe(monotonic() - start_time, status="error")
+            upload_failures.inc(reason=type(e).__name__)
+            print("Failed to send data:", e)
+            return "failed"
+
+        upload_seconds.observe(monotonic() - start_time, status=response.status_code)
+        if response.status_code == 200:
+            uploaded_records.inc(len(records), result="accepted")
+            print(
+                f"Data sent successfully in {monotonic() - start_time:.2f}s:", response.text)
+            return "done"
+        if response.status_code == 400:
+            # The server will never accept these records, do not retry them
+            uploaded_records.inc(len(records), result="rejected")
+            print("Data rejected by server, dropping batch:", response.text)
+            return "done"
+        upload_failures.inc(reason=f"http_{response.status_code}")
+        print("Failed to send data:", response.status_code, response.text)
+        if response.status_code >= 500 and response.status_code != 503:
+            return "server_error"
+        return "failed"
+
+    def run(self):
+        backoff = 0
+        # Server errors in a row on the batch starting at head_id, and the
+        # batch size while looking for the record the server fails on
+        head_id = None
+        server_errors = 0
+        probe_size = self.batch_size
+        while not self.stop_event.is_set():
+            batch = self.queue.peek(probe_size)
+            if not batch:
+                probe_size = self.batch_size
+                self.wake_event.wait()
+                self.wake_event.clear()
+                continue
+
+            result = self.send_batch([record for _, record in batch])
+            if result == "server_error":
+                if batch[0][0] != head_id:
+                    head_id = batch[0][0]
+                    server_errors = 0
+                server_errors += 1
+                if server_errors >= upload_max_server_errors or probe_size < self.batch_size:
+                    if len(batch) > 1:
+                        probe_size = len(batch) // 2
+                        print(f"Server failed {server_errors} times, retrying with {probe_size} record(s)")
+                    else:
+                        self.queue.move_to_dead_letter([batch[0][0]], f"{server_errors} server errors")
+                        uploaded_records.inc(result="dead_letter")
+                        print(f"Server failed {server_errors} times on record {batch[0][0]}, "
+                              f"moved to the dead-letter table")
+                        upload_backlog.set(len(self.queue))
+                        head_id = None
+                        probe_size = self.batch_size
+                        continue
+            if result == "done":
+                self.queue.remove([row_id for row_id, _ in batch])
+                upload_backlog.set(len(self.queue))
+                backoff = 0
+            else:
+                backoff = min(upload_backoff["max"],
+                              backoff * 2 if backoff else upload_backoff["min"])
+                print(
+                    f"{len(self.queue)} record(s) waiting, retrying in {backoff}s")
+                self.stop_event.wait(backoff * random.uniform(0.8, 1.2))
@@ -0,0 +1,111 @@
+# Multi-rate sensing
+# Each container is read at its own interval, a whole number of runs of the
+# sensing job, set from its recent readings and its pump:
+#   - from a dose submitted with add_ml_to_container until settle_seconds
+#     after its pump stopped, the container is read at every run (dense),
+#   - a read that moved by active_change or more (fraction wet) brings it
+#     back to every run, and a missing read is retried at the next run,
+#   - each read that moved by less than flat_change doubles its interval, up
+#     to max_interval (sparse).
+# Intervals are powers of two and due runs are multiples of the interval, so
+# containers backed off to the same interval are read in the same sweep.
+
+import threading
+import metrics
+from hardware import clock
+
+sensing_interval = metrics.gauge(
+    "irrigation_sensing_interval_seconds", "Interval between two reads of a soil sensor", ["container"])
+sensor_reads_skipped = metrics.counter(
+    "irrigation_sensor_reads_skipped_total", "Runs of the sensing job a soil sensor was not read", ["container"])
+
+
+class SensingSchedule:
+    """Decides which containers are read at each run of the sensing job."""
+
+    def __init__(self, container_ids, period=60, max_interval=480, settle_seconds=15 * 60,
+                 flat_change=0.005, active_change=0.02):
+        self.period = period
+        # Largest power of two of runs within max_interval
+        self.max_runs = 1
+        while self.max_runs * 2 * period <= max_interval:
+            self.max_runs *= 2
+        self.settle_seconds = settle_seconds
+        self.flat_change = flat_change
+        self.active_change = active_change
+        self.lock = threading.Lock()
+        self.run = 0
+        # Per container: interval (runs), next run due, last value read, end
+        # of the dense window after a dose (monotonic seconds)
+        self.interval = {c_id: 1 for c_id in container_ids}
+        self.next_run = {c_id: 0 for c_id in container_ids}
+        self.last_value = {c_id: None for c_id in container_ids}
+        self.dense_until = {c_id: None for c_id in container_ids}
+        self.counts = {"runs": 0, "reads": 0, "skipped": 0}
+
+    def due(self):
+        """Containers to read at this run, in zone order. Each call is one
+        run of the sensing job."""
+        now = clock.monotonic()
+        with self.lock:
+            run = self.run
+            self.run += 1
+            self.counts["runs"] += 1
+            due = []
+            for c_id, next_run in self.next_run.items():
+                dense_until = self.dense_until[c_id]
+                if run >= next_run or (dense_until is not None and now < dense_until):
+                    due.append(c_id)
+                else:
+                    sensor_reads_skipped.inc(container=c_id)
+            self.counts["reads"] += len(due)
+            self.counts["skipped"] += len(self.next_run) - len(due)
+            return due
+
+    def update(self, values):
+        """Set the next run of the containers read, from values
+        {container id: fraction wet or None}."""
+        now = clock.monotonic()
+        with self.lock:
+            # due() already counted the current run
+            run = self.run - 1
+            for c_id, value in values.items():
+                last = self.last_value[c_id]
+                dense_until = self.dense_until[c_id]
+                if value is None:
+                    interval = 1
+                elif dense_until is not None and now < dense_until:
+                    interval = 1
+                elif last is None or abs(value - last) >= self.active_change:
+                    interval = 1
+                elif abs(value - last) < self.flat_change:
+                    interval = min(self.interval[c_id] * 2, self.max_runs)
+                else:
+                    interval = self.interval[c_id]
+                if value is not None:
+                    self.last_value[c_id] = value
+                self.interval[c_id] = interval
+                self.next_run[c_id] = (run // interval + 1) * interval
+                sensing_interval.set(interval * self.period, container=c_id)
+
+    def dose(self, container_id):
+        """Read container_id at every run until settle_seconds from now.
+        Called when a dose is submitted and when its pump stops."""
+        with self.lock:
+            if container_id not in self.dense_until:
+                return
+            self.dense_until[container_id] = clock.monotonic() + self.settle_seconds
+            self.interval[container_id] = 1
+            self.next_run[container_id] = min(self.next_run[container_id], self.run)
+
+    def wake(self, container_ids=None):
+        """Read container_ids (all by default) at the next run."""
+        with self.lock:
+            for c_id in container_ids if container_ids is not None else list(self.next_run):
+                self.interval[c_id] = 1
+                self.next_run[c_id] = self.run
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, intervals={c_id: interval * self.period
+                                                for c_id, interval in self.interval.items()})
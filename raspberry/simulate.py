@@ -0,0 +1,206 @@
+# Closed-loop watering simulator
+# Runs the control law of control.py on NumPy arrays holding every
+# combination of parameters for every simulated container at once, one step
+# per minute, to compare settings before changing them on the Pi.
+#
+# Example: 30 days, 20 containers, 4 x 3 x 4 x 3 parameter sets
+#   python3 simulate.py --days 30 --containers 20 --p-factor 10 20 30 50 \
+#       --target 0.4 0.6 0.8 --filter-factor 1 5 10 20 --threshold-scale 0.5 1 2
+
+import argparse
+import csv
+import itertools
+import time
+
+import numpy as np
+
+from control import (P_factor, low_pass_filter_factor, low_pass_filter_step,
+                     ml_allowed, ml_requested, target_threshold_baseline,
+                     watering_thresholds)
+from pumpHistory import PumpHistory
+
+
+def make_containers(num_containers, seed):
+    """Random soil properties of the simulated containers."""
+    rng = np.random.default_rng(seed)
+    return {
+        # Hours for the soil moisture to halve without watering
+        "half_life_hours": rng.uniform(24, 72, num_containers),
+        # ml taking a container from dry (0) to wet (1)
+        "ml_for_full_range": rng.uniform(400, 800, num_containers),
+        "initial_moisture": rng.uniform(0.2, 0.9, num_containers),
+        # Standard deviation of the calibrated sensor reading
+        "noise": rng.uniform(0.005, 0.02, num_containers),
+    }
+
+
+def simulate(params, containers, minutes, seed=0):
+    """Simulate every parameter set on every container.
+
+    params maps p_factor, target, filter_factor and threshold_scale to 1-D
+    arrays of the same length (one entry per parameter set). Returns a dict
+    of metric arrays shaped (parameter sets, containers).
+    """
+    rng = np.random.default_rng(seed + 1)
+    num_containers = len(containers["half_life_hours"])
+
+    # Parameters as columns, container properties as rows: (sets, containers)
+    p_factor = params["p_factor"][:, None]
+    target = params["target"][:, None]
+    filter_factor = params["filter_factor"][:, None]
+    thresholds = {hours: max_ml * params["threshold_scale"][:, None]
+                  for hours, max_ml in watering_thresholds.items()}
+    shape = (len(params["p_factor"]), num_containers)
+
+    decay = 2 ** (-1 / (containers["half_life_hours"] * 60))
+    moisture = np.broadcast_to(containers["initial_moisture"], shape).copy()
+    filtered = None
+
+    # Doses of the last max window minutes, with running sums per window
+    window_minutes = {hours: hours * 60 for hours in thresholds}
+    ring_size = max(window_minutes.values())
+    dose_ring = np.zeros((ring_size,) + shape)
+    window_sums = {hours: np.zeros(shape) for hours in thresholds}
+
+    water_ml = np.zeros(shape)
+    minutes_below = np.zeros(shape)
+    overshoot_sum = np.zeros(shape)
+    overshoot_max = np.zeros(shape)
+
+    for minute in range(minutes):
+        moisture *= decay
+        # Same sensor noise for every parameter set of a container
+        noise = rng.normal(0, containers["noise"])
+        reading = np.round(np.clip(moisture + noise, 0, 1), 4)
+
+        if filtered is None:
+            filtered = reading.copy()
+        else:
+            filtered = low_pass_filter_step(filtered, reading, filter_factor)
+
+        # Doses leaving each window: entries must be newer than now - window
+        for hours, length in window_minutes.items():
+            if minute >= length:
+                window_sums[hours] -= dose_ring[(minute - length) % ring_size]
+
+        requested = ml_requested(target, filtered, p_factor, rounding=np.round)
+        allowed = ml_allowed(window_sums, target, requested, thresholds,
+                             target_threshold_baseline,
+                             minimum=np.minimum, maximum=np.maximum)
+        dose = np.where(filtered < target, allowed, 0.0)
+
+        dose_ring[minute % ring_size] = dose
+        for hours in window_sums:
+            window_sums[hours] += dose
+
+        moisture = np.minimum(
+            1.0, moisture + dose / containers["ml_for_full_range"])
+        water_ml += dose
+        minutes_below += moisture < target
+        excess = np.maximum(0.0, moisture - target)
+        overshoot_sum += excess
+        overshoot_max = np.maximum(overshoot_max, excess)
+
+    return {"water_ml_per_day": water_ml / (minutes / 1440),
+            "time_below_target": minutes_below / minutes,
+            "mean_overshoot": overshoot_sum / minutes,
+            "max_overshoot": overshoot_max}
+
+
+def verify(minutes=3000, seed=0):
+    """Check one simulated lane against the scalar path used by main.py."""
+    containers = make_containers(1, seed)
+    params = {"p_factor": np.array([P_factor], dtype=float),
+              "target": np.array([0.8]),
+              "filter_factor": np.array([low_pass_filter_factor], dtype=float),
+              "threshold_scale": np.array([1.0])}
+    vector_water = simulate(params, containers, minutes, seed)[
+        "water_ml_per_day"][0, 0] * minutes / 1440
+
+    rng = np.random.default_rng(seed + 1)
+    history = PumpHistory(["X"], max(watering_thresholds))
+    moisture = containers["initial_moisture"][0]
+    decay = 2 ** (-1 / (containers["half_life_hours"][0] * 60))
+    filtered = None
+    for minute in range(minutes):
+        moisture *= decay
+        noise = rng.normal(0, containers["noise"])[0]
+        reading = round(min(1, max(0, moisture + noise)), 4)
+        filtered = reading if filtered is None else low_pass_filter_step(
+            filtered, reading)
+        if filtered >= 0.8:
+            continue
+        requested = ml_requested(0.8, filtered)
+        allowed = ml_allowed(history.window_sums(
+            "X", watering_thresholds, minute * 60), 0.8, requested)
+        if allowed > 0:
+            history.add("X", allowed, minute * 60)
+            moisture = min(
+                1.0, moisture + allowed / containers["ml_for_full_range"][0])
+
+    scalar_water = history.total_ml("X")
+    print(f"Water used - vectorized: {vector_water:.1f} ml, scalar: {scalar_water:.1f} ml")
+    assert abs(vector_water - scalar_water) < 1e-6 * max(1, scalar_water)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Closed-loop simulation of the watering control law")
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--containers", type=int, default=20)
+    parser.add_argument("--p-factor", type=float, nargs="+", default=[P_factor])
+    parser.add_argument("--target", type=float, nargs="+", default=[0.8])
+    parser.add_argument("--filter-factor", type=float, nargs="+",
+                        default=[low_pass_filter_factor])
+    parser.add_argument("--threshold-scale", type=float, nargs="+", default=[1.0],
+                        help="multiplier applied to every watering_thresholds limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sort", default="time_below_target",
+                        choices=["time_below_target", "water_ml_per_day",
+                                 "mean_overshoot", "max_overshoot"])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--csv", help="write the metrics of every parameter set")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the vectorized model against the scalar control path")
+    args = parser.parse_args()
+
+    if args.verify:
+        verify(seed=args.seed)
+
+    combos = list(itertools.product(args.p_factor, args.target,
+                                    args.filter_factor, args.threshold_scale))
+    names = ["p_factor", "target", "filter_factor", "threshold_scale"]
+    params = {name: np.array([combo[i] for combo in combos], dtype=float)
+              for i, name in enumerate(names)}
+    containers = make_containers(args.containers, args.seed)
+    minutes = int(args.days * 1440)
+
+    start = time.perf_counter()
+    metrics = simulate(params, containers, minutes, args.seed)
+    elapsed = time.perf_counter() - start
+    print(f"Simulated {len(combos)} parameter sets x {args.containers} containers x "
+          f"{minutes} minutes in {elapsed:.1f}s")
+
+    # Average over containers
+    rows = []
+    for i, combo in enumerate(combos):
+        row = dict(zip(names, combo))
+        row.update({metric: float(values[i].mean())
+                   for metric, values in metrics.items()})
+        rows.append(row)
+    rows.sort(key=lambda row: row[args.sort])
+
+    header = names + list(metrics)
+    print(" ".join(f"{name:>17}" for name in header))
+    for row in rows[:args.top]:
+        print(" ".join(f"{row[name]:>17.4g}" for name in header))
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
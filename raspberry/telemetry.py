@@ -0,0 +1,316 @@
+# Binary telemetry format
+# A batch holds consecutive readings as flat rows (the columns of the history
+# store, see log.reading_row) in a self-describing, compressed block:
+#
+#   b"IRTM" | version (u8) | zlib(schema length (u32) | schema (JSON)
+#                                 | record count (u32) | columns)
+#
+# The schema lists the columns and the number of decimals kept for each.
+# Values are stored as integers (value * 10**decimals), column by column,
+# each as the first value followed by the differences between consecutive
+# values (int64, little endian), which compress to almost nothing for slowly
+# changing readings. A column with missing values is preceded by a bitmap of
+# the rows that have one.
+#
+# Files (log/telemetry.bin) are a sequence of frames, so they can be appended
+# to and read batch by batch:
+#
+#   b"IRTF" | batch length (u32) | CRC-32 of the batch (u32) | batch
+#
+# A frame torn by a crash or a damaged card fails its CRC: readers skip to the
+# next b"IRTF" marker, and TelemetryLog.open() truncates a torn last frame
+# before appending.
+#
+# Usage:
+#   python3 telemetry.py decode log/telemetry.bin > telemetry.csv
+#   python3 telemetry.py stats log/telemetry.bin
+
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timezone
+from itertools import accumulate
+
+magic = b"IRTM"
+version = 1
+frame_magic = b"IRTF"
+frame_header = struct.Struct("<4sII")
+content_type = "application/x-irrigation-telemetry"
+
+# Decimals kept per column, by name or by container column suffix
+column_decimals = {"time": 3, "cpu_temp": 2, "room_temp_SHT40": 2,
+                   "room_temp_BMP280": 2, "room_humidity_SHT40": 2,
+                   "room_pressure_BMP280": 2}
+suffix_decimals = {"_tgt": 4, "_raw": 4, "_pct": 4, "_pump_ml": 1}
+# Container fields of the records of sendToServer.build_record by suffix
+suffix_fields = {"_tgt": "humidity_tgt", "_raw": "humidity_raw",
+                 "_pct": "humidity_pct", "_pump_ml": "pump_ml_added"}
+default_decimals = 4
+
+compression_level = 6
+
+little_endian = sys.byteorder == "little"
+
+
+def decimals_of(column):
+    if column in column_decimals:
+        return column_decimals[column]
+    for suffix, decimals in suffix_decimals.items():
+        if column.endswith(suffix):
+            return decimals
+    return default_decimals
+
+
+def make_schema(columns):
+    """Schema of the rows having these columns, "time" first."""
+    columns = ["time"] + [c for c in columns if c != "time"]
+    return {"version": version, "columns": [[c, decimals_of(c)] for c in columns]}
+
+
+def pack_int64(values):
+    packed = array('q', values)
+    if not little_endian:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_int64(data):
+    values = array('q')
+    values.frombytes(data)
+    if not little_endian:
+        values.byteswap()
+    return values
+
+
+def encode_batch(rows, schema=None):
+    """One batch holding rows (dicts of column to value or None)."""
+    if schema is None:
+        # Every column of any row: records leave out containers without a
+        # reading
+        schema = make_schema(dict.fromkeys(column for row in rows for column in row))
+    schema_bytes = json.dumps(schema, separators=(",", ":")).encode()
+    body = [struct.pack("<I", len(schema_bytes)), schema_bytes, struct.pack("<I", len(rows))]
+
+    for column, decimals in schema["columns"]:
+        scale = 10 ** decimals
+        values = [row.get(column) for row in rows]
+        present = [value is not None for value in values]
+        if all(present):
+            body.append(b"\x00")
+        else:
+            body.append(b"\x01")
+            bitmap = bytearray((len(rows) + 7) // 8)
+            for i, has_value in enumerate(present):
+                if has_value:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+            body.append(bytes(bitmap))
+            values = [value for value in values if value is not None]
+        previous = 0
+        deltas = []
+        for value in values:
+            scaled = round(value * scale)
+            deltas.append(scaled - previous)
+            previous = scaled
+        body.append(struct.pack("<I", len(deltas)))
+        body.append(pack_int64(deltas))
+
+    return magic + bytes([version]) + zlib.compress(b"".join(body), compression_level)
+
+
+def decode_batch(data):
+    """Schema and rows of one batch."""
+    if data[:4] != magic:
+        raise ValueError("Not a telemetry batch")
+    if data[4] != version:
+        raise ValueError(f"Unsupported telemetry version {data[4]}")
+    body = zlib.decompress(data[5:])
+
+    (schema_length,) = struct.unpack_from("<I", body, 0)
+    offset = 4
+    schema = json.loads(body[offset:offset + schema_length])
+    offset += schema_length
+    (count,) = struct.unpack_from("<I", body, offset)
+    offset += 4
+
+    columns = {}
+    for column, decimals in schema["columns"]:
+        has_bitmap = body[offset]
+        offset += 1
+        bitmap = None
+        if has_bitmap:
+            bitmap = body[offset:offset + (count + 7) // 8]
+            offset += len(bitmap)
+        (length,) = struct.unpack_from("<I", body, offset)
+        offset += 4
+        deltas = unpack_int64(body[offset:offset + length * 8])
+        offset += length * 8
+
+        scale = 10 ** decimals
+        values = [value / scale for value in accumulate(deltas)]
+        if bitmap is not None:
+            present = iter(values)
+            values = [next(present) if bitmap[i >> 3] >> (i & 7) & 1 else None
+                      for i in range(count)]
+        columns[column] = values
+
+    names = list(columns)
+    rows = [dict(zip(names, row_values)) for row_values in zip(*columns.values())]
+    return schema, rows
+
+
+def epoch(date_time):
+    return datetime.fromisoformat(date_time).replace(tzinfo=timezone.utc).timestamp()
+
+
+def utc_string(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def record_row(record):
+    """Flat row of a record of sendToServer.build_record."""
+    row = {column: value for column, value in record.items()
+           if column not in ("date_time", "containers")}
+    row["time"] = epoch(record["date_time"])
+    for container in record["containers"]:
+        c_id = container["container_id"]
+        for suffix, field in suffix_fields.items():
+            row[c_id + suffix] = container[field]
+    return row
+
+
+def row_record(row):
+    """Record in the layout of sendToServer.build_record from a flat row."""
+    record = {"date_time": utc_string(row["time"])}
+    containers = {}
+    for column, value in row.items():
+        if column == "time":
+            continue
+        for suffix, field in suffix_fields.items():
+            if column.endswith(suffix):
+                c_id = column[:-len(suffix)]
+                containers.setdefault(c_id, {"container_id": c_id})[field] = value
+                break
+        else:
+            record[column] = value
+    # Containers missing from the row are left out, as in build_record
+    record["containers"] = [container for container in containers.values()
+                            if None not in container.values()]
+    return record
+
+
+class TelemetryLog:
+    """Appends readings to a telemetry file, one batch per batch_size rows.
+
+    Rows waiting for their batch are lost if the process dies; flush() writes
+    them as a shorter batch and is called by close(). open() drops a torn
+    last frame and gives the time of the last row written, from which the
+    lost rows can be appended again.
+    """
+
+    def __init__(self, path, batch_size=60):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.last_time = None
+
+    def open(self):
+        end = 0
+        last_batch = None
+        for _, end, last_batch in scan_frames(self.path):
+            pass
+        if last_batch is not None:
+            self.last_time = decode_batch(last_batch)[1][-1]["time"]
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > end:
+            print(f"Telemetry log: dropping {os.path.getsize(self.path) - end} bytes "
+                  "after its last complete batch")
+            os.truncate(self.path, end)
+        return self.last_time
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = encode_batch(self.rows)
+        with open(self.path, 'ab') as f:
+            f.write(frame_header.pack(frame_magic, len(batch), zlib.crc32(batch)) + batch)
+        self.last_time = self.rows[-1]["time"]
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def scan_frames(path):
+    """(start, end, batch) of the intact frames of a telemetry file, skipping
+    damaged ones."""
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset = 0
+        while True:
+            start = data.find(frame_magic, offset)
+            if start < 0 or start + frame_header.size > len(data):
+                return
+            _, length, crc = frame_header.unpack_from(data, start)
+            end = start + frame_header.size + length
+            batch = data[start + frame_header.size:end]
+            if len(batch) == length and zlib.crc32(batch) == crc:
+                yield start, end, batch
+                offset = end
+            else:
+                # Torn or damaged frame: resync on the next marker
+                offset = start + 1
+
+
+def read_batches(path):
+    """Raw batches of a telemetry file, damaged frames skipped."""
+    for _, _, batch in scan_frames(path):
+        yield batch
+
+
+def read_rows(path):
+    for batch in read_batches(path):
+        yield from decode_batch(batch)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telemetry file tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    decode = subparsers.add_parser("decode", help="write the rows of a telemetry file as CSV")
+    decode.add_argument("path")
+    stats = subparsers.add_parser("stats", help="batch, row and size counts of a telemetry file")
+    stats.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "decode":
+        writer = None
+        for row in read_rows(args.path):
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        batches = rows = 0
+        raw_size = 0
+        for batch in read_batches(args.path):
+            batch_rows = decode_batch(batch)[1]
+            batches += 1
+            rows += len(batch_rows)
+            raw_size += sum(len(json.dumps(row_record(row))) for row in batch_rows)
+        size = os.path.getsize(args.path)
+        print(f"{batches} batches, {rows} rows, {size} bytes "
+              f"({size / max(rows, 1):.1f} bytes per row, {raw_size} bytes as JSON records)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Exercise the upload pipeline against a local stand-in of api_store_data.php.
+# The stand-in fails the first requests to check that records are kept in the
+# queue during an outage and backfilled in batches afterwards, and answers 500
+# to batches with a poison record to check that this record alone is moved to
+# the dead-letter table instead of blocking the queue.
+
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+import sendToServer
+from sendToServer import Uploader
+
+failures_before_success = 2
+received_batches = []
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        payload = json.loads(body)
+
+        global failures_before_success
+        if any(record["date_time"] == "poison" for record in payload["records"]):
+            self.reply(500, {"status": "error", "message": "Transaction failed"})
+        elif failures_before_success > 0:
+            failures_before_success -= 1
+            self.reply(503, {"status": "error", "message": "Unavailable"})
+        elif payload.get("api_key") != sendToServer.api["key"]:
+            self.reply(403, {"status": "error", "message": "Unauthorized"})
+        else:
+            received_batches.append(payload["records"])
+            self.reply(200, {"status": "success",
+                       "records": len(payload["records"])})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test(num_records=150):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sendToServer.upload_backoff = {"min": 0.1, "max": 0.5}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uploader = Uploader(os.path.join(tmp, "queue.sqlite"),
+                            url=f"http://127.0.0.1:{server.server_port}/")
+        for i in range(num_records):
+            uploader.enqueue({"date_time": f"record {i}", "containers": []})
+        uploader.start()
+
+        while len(uploader.queue) > 0:
+            sleep(0.1)
+        uploader.stop()
+
+    server.shutdown()
+    received = [record["date_time"]
+                for batch in received_batches for record in batch]
+    print(
+        f"{len(received)} records received in {len(received_batches)} requests")
+    assert received == [f"record {i}" for i in range(num_records)]
+    print("Upload test passed")
+
+
+def test_dead_letter(num_records=20):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sendToServer.upload_backoff = {"min": 0.01, "max": 0.05}
+    sendToServer.upload_max_server_errors = 3
+    received_batches.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uploader = Uploader(os.path.join(tmp, "queue.sqlite"),
+                            url=f"http://127.0.0.1:{server.server_port}/", batch_size=8)
+        for i in range(num_records):
+            uploader.enqueue({"date_time": f"record {i}", "containers": []})
+            if i == 4:
+                uploader.enqueue({"date_time": "poison", "containers": []})
+        uploader.start()
+
+        while len(uploader.queue) > 0:
+            sleep(0.1)
+        dead_letters = uploader.queue.dead_letter_count()
+        uploader.stop()
+
+    server.shutdown()
+    received = [record["date_time"]
+                for batch in received_batches for record in batch]
+    # Only the poison record is left out
+    assert dead_letters == 1, dead_letters
+    assert received == [f"record {i}" for i in range(num_records)], received
+    print("Dead-letter test passed")
+
+
+if __name__ == "__main__":
+    test()
+    test_dead_letter()
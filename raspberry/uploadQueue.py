@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import threading
+
+
+class UploadQueue:
+    """On-disk FIFO of records waiting to be uploaded.
+
+    Records survive restarts and network outages. When more than max_records
+    are waiting, the oldest ones are dropped. Records the server keeps failing
+    on are moved to the upload_dead_letter table of the same file, to be
+    inspected or queued again by hand.
+    """
+
+    def __init__(self, path, max_records=60 * 24 * 14):
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS upload_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS upload_dead_letter (id INTEGER PRIMARY KEY, record TEXT NOT NULL, "
+            "reason TEXT NOT NULL)")
+        self.conn.commit()
+
+    def put(self, record):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO upload_queue (record) VALUES (?)", (json.dumps(record),))
+            self.conn.execute(
+                "DELETE FROM upload_queue WHERE id <= (SELECT MAX(id) FROM upload_queue) - ?", (self.max_records,))
+            self.conn.commit()
+
+    def peek(self, count):
+        """Oldest records as a list of (id, record), without removing them."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, record FROM upload_queue ORDER BY id LIMIT ?", (count,)).fetchall()
+        return [(row_id, json.loads(record)) for row_id, record in rows]
+
+    def remove(self, ids):
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM upload_queue WHERE id = ?", [(row_id,) for row_id in ids])
+            self.conn.commit()
+
+    def move_to_dead_letter(self, ids, reason):
+        """Move records out of the queue into the dead-letter table."""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO upload_dead_letter (id, record, reason) "
+                "SELECT id, record, ? FROM upload_queue WHERE id = ?", [(reason, row_id) for row_id in ids])
+            self.conn.executemany(
+                "DELETE FROM upload_queue WHERE id = ?", [(row_id,) for row_id in ids])
+            self.conn.commit()
+
+    def dead_letter_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM upload_dead_letter").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM upload_queue").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
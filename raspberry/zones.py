@@ -0,0 +1,118 @@
+# Zone registry
+# Every container (zone) of the installation is declared once in zones.json:
+# the ADC Pi board and channel of its soil sensor, the GPIO bank and pin of
+# its pump, the pump calibration and its target. Several ADC Pi boards (each
+# a pair of I2C addresses with 8 channels) and GPIO banks (the Pi header or
+# MCP23017 I2C expanders) can be declared. The sensor calibration is in
+# calibrations.json; a zone can set dry/wet volts for containers without a
+# curve there, as the synthetic zones of make_config do.
+#
+# IRRIGATION_ZONES selects another file, e.g. for simulated runs with more
+# containers.
+
+import json
+import math
+import os
+from array import array
+
+zones_file_path = os.environ.get(
+    "IRRIGATION_ZONES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zones.json"))
+
+adc_channels_per_board = 8
+gpio_bank_types = ("pi", "mcp23017")
+
+
+class ZoneRegistry:
+    """Zones loaded from a zones.json config.
+
+    Zone fields are stored column-wise, in lists and arrays indexed by the
+    zone number (the order of the zones in the config), so per-cycle loops
+    run over the zone numbers instead of looking up dicts. index maps a
+    container id to its zone number.
+    """
+
+    def __init__(self, config):
+        self.adc_boards = {}
+        for name, board in config["adc_boards"].items():
+            addresses = [int(address, 0) for address in board["addresses"]]
+            if len(addresses) != 2:
+                raise ValueError(f"ADC board {name} needs 2 I2C addresses")
+            self.adc_boards[name] = {"name": name, "addresses": addresses,
+                                     "bit_rate": board.get("bit_rate", 18)}
+
+        self.gpio_banks = {}
+        for name, bank in config["gpio_banks"].items():
+            if bank["type"] not in gpio_bank_types:
+                raise ValueError(f"GPIO bank {name} has unknown type {bank['type']}")
+            self.gpio_banks[name] = {"name": name, "type": bank["type"]}
+            if "address" in bank:
+                self.gpio_banks[name]["address"] = int(bank["address"], 0)
+
+        targets = config.get("targets", {})
+        zones = config["zones"]
+        self.ids = [zone["id"] for zone in zones]
+        self.index = {c_id: i for i, c_id in enumerate(self.ids)}
+        if len(self.index) != len(self.ids):
+            raise ValueError("Zone ids must be unique")
+
+        self.group = [zone.get("group") for zone in zones]
+        self.adc_board = [zone["adc"] for zone in zones]
+        self.channel = array('B', [zone["channel"] for zone in zones])
+        self.gpio_bank = [zone["gpio"] for zone in zones]
+        self.pin = array('B', [zone["pin"] for zone in zones])
+        self.seconds_per_100ml = array('d', [zone["seconds_per_100ml"] for zone in zones])
+        # NaN for zones calibrated in calibrations.json only
+        self.dry = array('d', [zone.get("dry", math.nan) for zone in zones])
+        self.wet = array('d', [zone.get("wet", math.nan) for zone in zones])
+        # A zone target overrides the target of its group
+        self.target = array('d', [zone["target"] if "target" in zone else targets[zone["group"]]
+                                  for zone in zones])
+
+        sensors = set()
+        pumps = set()
+        for i, c_id in enumerate(self.ids):
+            if self.adc_board[i] not in self.adc_boards:
+                raise ValueError(f"Zone {c_id} uses unknown ADC board {self.adc_board[i]}")
+            if not 1 <= self.channel[i] <= adc_channels_per_board:
+                raise ValueError(f"Zone {c_id} uses invalid ADC channel {self.channel[i]}")
+            if self.gpio_bank[i] not in self.gpio_banks:
+                raise ValueError(f"Zone {c_id} uses unknown GPIO bank {self.gpio_bank[i]}")
+            sensor = (self.adc_board[i], self.channel[i])
+            pump = (self.gpio_bank[i], self.pin[i])
+            if sensor in sensors or pump in pumps:
+                raise ValueError(f"Zone {c_id} shares its sensor or pump with another zone")
+            sensors.add(sensor)
+            pumps.add(pump)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def make_config(num_zones, pump_bank_size=16):
+    """Config of num_zones synthetic zones, for simulated runs and
+    benchmarks: 8 sensors per ADC Pi board and pump_bank_size pumps per
+    MCP23017 bank. Only simulated runs can use more than 4 ADC Pi boards,
+    the I2C addresses past 0x6F do not exist on real boards."""
+    num_boards = (num_zones + adc_channels_per_board - 1) // adc_channels_per_board
+    num_banks = (num_zones + pump_bank_size - 1) // pump_bank_size
+    return {
+        "adc_boards": {f"adc{b}": {"addresses": [hex(0x68 + 2 * b), hex(0x69 + 2 * b)]}
+                       for b in range(num_boards)},
+        "gpio_banks": {f"gpio{b}": {"type": "mcp23017", "address": hex(0x20 + b)}
+                       for b in range(num_banks)},
+        "targets": {"A": 0.8, "B": 0.4},
+        "zones": [{"id": f"{'AB'[i % 2]}{i + 1}", "group": "AB"[i % 2],
+                   "adc": f"adc{i // adc_channels_per_board}",
+                   "channel": i % adc_channels_per_board + 1,
+                   "gpio": f"gpio{i // pump_bank_size}", "pin": i % pump_bank_size,
+                   "seconds_per_100ml": 100.0, "dry": 0.95, "wet": 0.5}
+                  for i in range(num_zones)],
+    }
+
+
+def load_zones(path=zones_file_path):
+    with open(path, 'r') as f:
+        return ZoneRegistry(json.load(f))
+
+
+zones = load_zones()
@@ -0,0 +1,28 @@
+-- Running sums of the hourly aggregates, for databases created before they
+-- were added to create_database.sql. Used by server/python/ingest_service.py,
+-- which updates an hour with one upsert instead of re-averaging its rows.
+-- Hours stored before the migration have no samples: their averages are
+-- restarted from the readings received after it.
+
+ALTER TABLE long_term_sensor_data
+    ADD COLUMN samples INT NOT NULL DEFAULT 0,
+    ADD COLUMN cpu_temp_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN room_temp_SHT40_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN room_temp_BMP280_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN room_humidity_SHT40_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN room_pressure_BMP280_sum DOUBLE NOT NULL DEFAULT 0;
+
+-- pump_ml_date_time is the date_time of the reading pump_ml_added comes
+-- from, so that backfilled readings do not replace a newer total.
+ALTER TABLE long_term_container_data
+    ADD COLUMN pump_ml_date_time DATETIME NULL,
+    ADD COLUMN samples INT NOT NULL DEFAULT 0,
+    ADD COLUMN humidity_tgt_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN humidity_raw_sum DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN humidity_pct_sum DOUBLE NOT NULL DEFAULT 0;
+
+-- One row per hour and per hour and container, as the upserts need. Duplicate
+-- hours left by concurrent requests to api_store_data.php must be removed
+-- first.
+CREATE UNIQUE INDEX uq_long_term_sensor_date_time ON long_term_sensor_data(date_time);
+CREATE UNIQUE INDEX uq_long_term_container_sensor_container ON long_term_container_data(sensor_data_id, container_id);
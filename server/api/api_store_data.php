@@ -46,21 +46,55 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         exit;
     }
 
+    // A payload holds either one record or a batch of records under 'records'
+    $records = (isset($data['records']) && is_array($data['records'])) ? $data['records'] : [$data];
+    if (empty($records)) {
+        log_message("Invalid data received. Empty batch");
+        http_response_code(400);
+        echo json_encode(["status" => "error", "message" => "Invalid data. Empty batch"]);
+        exit;
+    }
+
     // Validate incoming data
     $required_fields = ['date_time', 'cpu_temp', 'room_temp_SHT40', 'room_temp_BMP280', 'room_humidity_SHT40', 'room_pressure_BMP280', 'containers'];
     $missing_fields = [];
-    foreach ($required_fields as $field) {
-        if (!isset($data[$field])) {
-            $missing_fields[] = $field;
+    foreach ($records as $record) {
+        foreach ($required_fields as $field) {
+            if (!isset($record[$field])) {
+                $missing_fields[] = $field;
+            }
         }
     }
     if (!empty($missing_fields)) {
+        $missing_fields = array_unique($missing_fields);
         log_message("Invalid data received. Missing fields: " . implode(", ", $missing_fields));
         http_response_code(400);
         echo json_encode(["status" => "error", "message" => "Invalid data. Missing fields: " . implode(", ", $missing_fields)]);
         exit;
     }
 
+    // Validate container data before the transaction: a record that can never
+    // be stored is refused with 400, so that the client does not retry it
+    $container_required_fields = ['container_id', 'humidity_tgt', 'humidity_raw', 'humidity_pct', 'pump_ml_added'];
+    foreach ($records as $record) {
+        if (!is_array($record['containers'])) {
+            log_message("Invalid data received. containers is not a list");
+            http_response_code(400);
+            echo json_encode(["status" => "error", "message" => "Invalid data. containers is not a list"]);
+            exit;
+        }
+        foreach ($record['containers'] as $container) {
+            foreach ($container_required_fields as $c_field) {
+                if (!isset($container[$c_field])) {
+                    log_message("Invalid container data received. Missing field: " . $c_field);
+                    http_response_code(400);
+                    echo json_encode(["status" => "error", "message" => "Invalid container data. Missing field: " . $c_field]);
+                    exit;
+                }
+            }
+        }
+    }
+
     // Begin transaction to ensure data consistency
     $conn->begin_transaction();
 
@@ -72,21 +106,6 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         }
         $stmtShortTerm->bind_param("sddddd", $datetime, $cpuTempC, $roomTempC_SHT40, $roomTempC_BMP280, $roomHumiditySHT40, $roomPressureBMP280);
 
-        // Insert data into short-term sensor data table
-        $datetime = $data['date_time'];
-        $cpuTempC = floatval($data['cpu_temp']);
-        $roomTempC_SHT40 = floatval($data['room_temp_SHT40']);
-        $roomTempC_BMP280 = floatval($data['room_temp_BMP280']);
-        $roomHumiditySHT40 = floatval($data['room_humidity_SHT40']);
-        $roomPressureBMP280 = floatval($data['room_pressure_BMP280']);
-
-        if (!$stmtShortTerm->execute()) {
-            throw new Exception("Database insert failed for short-term sensor data: " . $stmtShortTerm->error);
-        }
-
-        // Get the last inserted ID for short-term data
-        $shortTermSensorDataId = $conn->insert_id;
-
         // Prepare SQL statement for short-term container data
         $stmtContainerShortTerm = $conn->prepare("INSERT INTO short_term_container_data (sensor_data_id, container_id, humidity_tgt, humidity_raw, humidity_pct, pump_ml_added) VALUES (?, ?, ?, ?, ?, ?)");
         if (!$stmtContainerShortTerm) {
@@ -94,27 +113,44 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         }
         $stmtContainerShortTerm->bind_param("isdddi", $shortTermSensorDataId, $container_id, $humidity_tgt, $humidity_raw, $humidity_pct, $pump_ml_added);
 
-        // Iterate over containers and insert data into short-term container data table
-        foreach ($data['containers'] as $container) {
-            // Validate container data
-            $container_required_fields = ['container_id', 'humidity_tgt', 'humidity_raw', 'humidity_pct', 'pump_ml_added'];
-            foreach ($container_required_fields as $c_field) {
-                if (!isset($container[$c_field])) {
-                    throw new Exception("Invalid container data. Missing field: " . $c_field);
-                }
-            }
+        // Hours touched by this payload, aggregated once each after the inserts
+        $hours = [];
 
-            // Get values from the container data
-            $container_id = $container['container_id'];
-            $humidity_tgt = floatval($container['humidity_tgt']);
-            $humidity_raw = floatval($container['humidity_raw']);
-            $humidity_pct = floatval($container['humidity_pct']);
-            $pump_ml_added = intval($container['pump_ml_added']); // Cast to integer
+        foreach ($records as $data) {
+            // Insert data into short-term sensor data table
+            $datetime = $data['date_time'];
+            $cpuTempC = floatval($data['cpu_temp']);
+            $roomTempC_SHT40 = floatval($data['room_temp_SHT40']);
+            $roomTempC_BMP280 = floatval($data['room_temp_BMP280']);
+            $roomHumiditySHT40 = floatval($data['room_humidity_SHT40']);
+            $roomPressureBMP280 = floatval($data['room_pressure_BMP280']);
+
+            if (!$stmtShortTerm->execute()) {
+                throw new Exception("Database insert failed for short-term sensor data: " . $stmtShortTerm->error);
+            }
 
-            // Execute statement for container data
-            if (!$stmtContainerShortTerm->execute()) {
-                throw new Exception("Database insert failed for container ID $container_id: " . $stmtContainerShortTerm->error);
+            // Get the last inserted ID for short-term data
+            $shortTermSensorDataId = $conn->insert_id;
+
+            // Iterate over containers and insert data into short-term container data table
+            foreach ($data['containers'] as $container) {
+                // Get values from the container data
+                $container_id = $container['container_id'];
+                $humidity_tgt = floatval($container['humidity_tgt']);
+                $humidity_raw = floatval($container['humidity_raw']);
+                $humidity_pct = floatval($container['humidity_pct']);
+                $pump_ml_added = intval($container['pump_ml_added']); // Cast to integer
+
+                // Execute statement for container data
+                if (!$stmtContainerShortTerm->execute()) {
+                    throw new Exception("Database insert failed for container ID $container_id: " . $stmtContainerShortTerm->error);
+                }
             }
+
+            // Remember the hour of this record for the long-term aggregation
+            $dt = new DateTime($datetime);
+            $dt->setTime($dt->format('H'), 0, 0);
+            $hours[$dt->format('Y-m-d H:i:s')] = true;
         }
 
         // Close short-term statements
@@ -125,263 +161,265 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
          * -------- Long-Term Data Aggregation --------
          */
 
-        // 1. Parse the date_time to get the start of the hour
-        $dt = new DateTime($datetime);
-        $dt->setTime($dt->format('H'), 0, 0);
-        $hour_start = $dt->format('Y-m-d H:i:s');
-
-        // 2. Define the end of the hour
-        $dt_end = clone $dt;
-        $dt_end->modify('+1 hour');
-        $hour_end = $dt_end->format('Y-m-d H:i:s');
-
-        /**
-         * 3. Calculate average sensor data for the hour
-         */
-        $stmtAvgSensors = $conn->prepare("
-            SELECT
-                AVG(cpu_temp) AS avg_cpu_temp,
-                AVG(room_temp_SHT40) AS avg_room_temp_SHT40,
-                AVG(room_temp_BMP280) AS avg_room_temp_BMP280,
-                AVG(room_humidity_SHT40) AS avg_room_humidity_SHT40,
-                AVG(room_pressure_BMP280) AS avg_room_pressure_BMP280
-            FROM short_term_sensor_data
-            WHERE date_time >= ? AND date_time < ?
-        ");
-        if (!$stmtAvgSensors) {
-            throw new Exception("Prepare failed for averaging sensors: " . $conn->error);
-        }
-        $stmtAvgSensors->bind_param("ss", $hour_start, $hour_end);
-
-        if (!$stmtAvgSensors->execute()) {
-            throw new Exception("Execution failed for averaging sensors: " . $stmtAvgSensors->error);
-        }
-
-        $resultAvgSensors = $stmtAvgSensors->get_result();
-        if ($resultAvgSensors->num_rows === 0) {
-            throw new Exception("No short-term sensor data found for the specified hour.");
-        }
-        $avgSensors = $resultAvgSensors->fetch_assoc();
-        $stmtAvgSensors->close();
-
-        /**
-         * 4. Insert or Update long_term_sensor_data
-         */
-        // Check if an entry for this hour already exists
-        $stmtCheckLongTermSensor = $conn->prepare("SELECT id FROM long_term_sensor_data WHERE date_time = ?");
-        if (!$stmtCheckLongTermSensor) {
-            throw new Exception("Prepare failed for checking long_term_sensor_data: " . $conn->error);
-        }
-        $stmtCheckLongTermSensor->bind_param("s", $hour_start);
-        if (!$stmtCheckLongTermSensor->execute()) {
-            throw new Exception("Execution failed for checking long_term_sensor_data: " . $stmtCheckLongTermSensor->error);
-        }
-        $resultCheckLongTermSensor = $stmtCheckLongTermSensor->get_result();
-
-        if ($resultCheckLongTermSensor->num_rows > 0) {
-            // Entry exists, perform update
-            $longTermSensorId = $resultCheckLongTermSensor->fetch_assoc()['id'];
-            $stmtUpdateLongTermSensor = $conn->prepare("
-                UPDATE long_term_sensor_data
-                SET cpu_temp = ?, room_temp_SHT40 = ?, room_temp_BMP280 = ?, room_humidity_SHT40 = ?, room_pressure_BMP280 = ?
-                WHERE id = ?
+        foreach (array_keys($hours) as $hour_start) {
+            // 1. Start of the hour
+            $dt = new DateTime($hour_start);
+
+            // 2. Define the end of the hour
+            $dt_end = clone $dt;
+            $dt_end->modify('+1 hour');
+            $hour_end = $dt_end->format('Y-m-d H:i:s');
+
+            /**
+             * 3. Calculate average sensor data for the hour
+             */
+            $stmtAvgSensors = $conn->prepare("
+                SELECT
+                    AVG(cpu_temp) AS avg_cpu_temp,
+                    AVG(room_temp_SHT40) AS avg_room_temp_SHT40,
+                    AVG(room_temp_BMP280) AS avg_room_temp_BMP280,
+                    AVG(room_humidity_SHT40) AS avg_room_humidity_SHT40,
+                    AVG(room_pressure_BMP280) AS avg_room_pressure_BMP280
+                FROM short_term_sensor_data
+                WHERE date_time >= ? AND date_time < ?
             ");
-            if (!$stmtUpdateLongTermSensor) {
-                throw new Exception("Prepare failed for updating long_term_sensor_data: " . $conn->error);
-            }
-            $stmtUpdateLongTermSensor->bind_param(
-                "dddddi",
-                $avgSensors['avg_cpu_temp'],
-                $avgSensors['avg_room_temp_SHT40'],
-                $avgSensors['avg_room_temp_BMP280'],
-                $avgSensors['avg_room_humidity_SHT40'],
-                $avgSensors['avg_room_pressure_BMP280'],
-                $longTermSensorId
-            );
-            if (!$stmtUpdateLongTermSensor->execute()) {
-                throw new Exception("Execution failed for updating long_term_sensor_data: " . $stmtUpdateLongTermSensor->error);
+            if (!$stmtAvgSensors) {
+                throw new Exception("Prepare failed for averaging sensors: " . $conn->error);
             }
-            $stmtUpdateLongTermSensor->close();
-        } else {
-            // Entry does not exist, perform insert
-            $stmtInsertLongTermSensor = $conn->prepare("
-                INSERT INTO long_term_sensor_data (date_time, cpu_temp, room_temp_SHT40, room_temp_BMP280, room_humidity_SHT40, room_pressure_BMP280)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ");
-            if (!$stmtInsertLongTermSensor) {
-                throw new Exception("Prepare failed for inserting into long_term_sensor_data: " . $conn->error);
-            }
-            $stmtInsertLongTermSensor->bind_param(
-                "sddddd",
-                $hour_start,
-                $avgSensors['avg_cpu_temp'],
-                $avgSensors['avg_room_temp_SHT40'],
-                $avgSensors['avg_room_temp_BMP280'],
-                $avgSensors['avg_room_humidity_SHT40'],
-                $avgSensors['avg_room_pressure_BMP280']
-            );
-            if (!$stmtInsertLongTermSensor->execute()) {
-                throw new Exception("Execution failed for inserting into long_term_sensor_data: " . $stmtInsertLongTermSensor->error);
-            }
-            $longTermSensorId = $conn->insert_id;
-            $stmtInsertLongTermSensor->close();
-        }
-        $stmtCheckLongTermSensor->close();
-
-        /**
-         * 5. Retrieve all short_term_sensor_data IDs for the specified hour
-         */
-        $stmtGetShortTermIds = $conn->prepare("
-            SELECT id FROM short_term_sensor_data
-            WHERE date_time >= ? AND date_time < ?
-        ");
-        if (!$stmtGetShortTermIds) {
-            throw new Exception("Prepare failed for retrieving short_term_sensor_data IDs: " . $conn->error);
-        }
-        $stmtGetShortTermIds->bind_param("ss", $hour_start, $hour_end);
-        if (!$stmtGetShortTermIds->execute()) {
-            throw new Exception("Execution failed for retrieving short_term_sensor_data IDs: " . $stmtGetShortTermIds->error);
-        }
-        $resultShortTermIds = $stmtGetShortTermIds->get_result();
-        $shortTermIds = [];
-        while ($row = $resultShortTermIds->fetch_assoc()) {
-            $shortTermIds[] = $row['id'];
-        }
-        $stmtGetShortTermIds->close();
-
-        if (empty($shortTermIds)) {
-            throw new Exception("No short-term sensor data IDs found for the specified hour.");
-        }
-
-        // Prepare a comma-separated list of IDs for SQL IN clause
-        $shortTermIdsPlaceholders = implode(',', array_fill(0, count($shortTermIds), '?'));
-        $shortTermIdsTypes = str_repeat('i', count($shortTermIds));
-
-        /**
-         * 6. Calculate averages for container data
-         */
-        // Prepare the SQL statement to retrieve container averages and latest pump_ml_added
-        $sqlContainer = "
-            SELECT
-                sc.container_id,
-                AVG(sc.humidity_tgt) AS avg_humidity_tgt,
-                AVG(sc.humidity_raw) AS avg_humidity_raw,
-                AVG(sc.humidity_pct) AS avg_humidity_pct,
-                sc_latest.pump_ml_added
-            FROM short_term_container_data sc
-            INNER JOIN (
-                SELECT sc1.container_id, sc1.pump_ml_added
-                FROM short_term_container_data sc1
-                INNER JOIN short_term_sensor_data sss1 ON sc1.sensor_data_id = sss1.id
-                WHERE sss1.date_time >= ? AND sss1.date_time < ?
-                ORDER BY sc1.container_id, sc1.id DESC
-            ) sc_latest ON sc.container_id = sc_latest.container_id
-            INNER JOIN short_term_sensor_data sss ON sc.sensor_data_id = sss.id
-            WHERE sc.sensor_data_id IN (" . $shortTermIdsPlaceholders . ")
-            AND sss.date_time >= ? AND sss.date_time < ?
-            GROUP BY sc.container_id
-        ";
-
-        $stmtContainer = $conn->prepare($sqlContainer);
-        if (!$stmtContainer) {
-            throw new Exception("Prepare failed for retrieving container data: " . $conn->error);
-        }
+            $stmtAvgSensors->bind_param("ss", $hour_start, $hour_end);
 
-        // Bind parameters
-        $bindTypes = 'ss' . $shortTermIdsTypes . 'ss';
-        $bindParams = array_merge([$hour_start, $hour_end], $shortTermIds, [$hour_start, $hour_end]);
-
-        // Use references for bind_param
-        $bindParamsRefs = [];
-        foreach ($bindParams as $key => $value) {
-            $bindParamsRefs[$key] = &$bindParams[$key];
-        }
-
-        // Call bind_param dynamically
-        call_user_func_array([$stmtContainer, 'bind_param'], array_merge([$bindTypes], $bindParamsRefs));
-
-        if (!$stmtContainer->execute()) {
-            throw new Exception("Execution failed for retrieving container data: " . $stmtContainer->error);
-        }
-
-        $resultContainer = $stmtContainer->get_result();
-        if ($resultContainer->num_rows === 0) {
-            throw new Exception("No container data found for the specified hour.");
-        }
+            if (!$stmtAvgSensors->execute()) {
+                throw new Exception("Execution failed for averaging sensors: " . $stmtAvgSensors->error);
+            }
 
-        /**
-         * 7. Insert or Update long_term_container_data
-         */
-        while ($row = $resultContainer->fetch_assoc()) {
-            $container_id = $row['container_id'];
-            $avg_humidity_tgt = floatval($row['avg_humidity_tgt']);
-            $avg_humidity_raw = floatval($row['avg_humidity_raw']);
-            $avg_humidity_pct = floatval($row['avg_humidity_pct']);
-            $pump_ml_added = intval($row['pump_ml_added']);
-
-            // Check if an entry for this sensor_data_id and container_id exists
-            $stmtCheckLongTermContainer = $conn->prepare("
-                SELECT id FROM long_term_container_data
-                WHERE sensor_data_id = ? AND container_id = ?
-            ");
-            if (!$stmtCheckLongTermContainer) {
-                throw new Exception("Prepare failed for checking long_term_container_data: " . $conn->error);
+            $resultAvgSensors = $stmtAvgSensors->get_result();
+            if ($resultAvgSensors->num_rows === 0) {
+                throw new Exception("No short-term sensor data found for the specified hour.");
             }
-            $stmtCheckLongTermContainer->bind_param("is", $longTermSensorId, $container_id);
-            if (!$stmtCheckLongTermContainer->execute()) {
-                throw new Exception("Execution failed for checking long_term_container_data: " . $stmtCheckLongTermContainer->error);
+            $avgSensors = $resultAvgSensors->fetch_assoc();
+            $stmtAvgSensors->close();
+
+            /**
+             * 4. Insert or Update long_term_sensor_data
+             */
+            // Check if an entry for this hour already exists
+            $stmtCheckLongTermSensor = $conn->prepare("SELECT id FROM long_term_sensor_data WHERE date_time = ?");
+            if (!$stmtCheckLongTermSensor) {
+                throw new Exception("Prepare failed for checking long_term_sensor_data: " . $conn->error);
             }
-            $resultCheckLongTermContainer = $stmtCheckLongTermContainer->get_result();
+            $stmtCheckLongTermSensor->bind_param("s", $hour_start);
+            if (!$stmtCheckLongTermSensor->execute()) {
+                throw new Exception("Execution failed for checking long_term_sensor_data: " . $stmtCheckLongTermSensor->error);
+            }
+            $resultCheckLongTermSensor = $stmtCheckLongTermSensor->get_result();
 
-            if ($resultCheckLongTermContainer->num_rows > 0) {
+            if ($resultCheckLongTermSensor->num_rows > 0) {
                 // Entry exists, perform update
-                $longTermContainerId = $resultCheckLongTermContainer->fetch_assoc()['id'];
-                $stmtUpdateLongTermContainer = $conn->prepare("
-                    UPDATE long_term_container_data
-                    SET humidity_tgt = ?, humidity_raw = ?, humidity_pct = ?, pump_ml_added = ?
+                $longTermSensorId = $resultCheckLongTermSensor->fetch_assoc()['id'];
+                $stmtUpdateLongTermSensor = $conn->prepare("
+                    UPDATE long_term_sensor_data
+                    SET cpu_temp = ?, room_temp_SHT40 = ?, room_temp_BMP280 = ?, room_humidity_SHT40 = ?, room_pressure_BMP280 = ?
                     WHERE id = ?
                 ");
-                if (!$stmtUpdateLongTermContainer) {
-                    throw new Exception("Prepare failed for updating long_term_container_data: " . $conn->error);
+                if (!$stmtUpdateLongTermSensor) {
+                    throw new Exception("Prepare failed for updating long_term_sensor_data: " . $conn->error);
                 }
-                $stmtUpdateLongTermContainer->bind_param(
-                    "dddii",
-                    $avg_humidity_tgt,
-                    $avg_humidity_raw,
-                    $avg_humidity_pct,
-                    $pump_ml_added,
-                    $longTermContainerId
+                $stmtUpdateLongTermSensor->bind_param(
+                    "dddddi",
+                    $avgSensors['avg_cpu_temp'],
+                    $avgSensors['avg_room_temp_SHT40'],
+                    $avgSensors['avg_room_temp_BMP280'],
+                    $avgSensors['avg_room_humidity_SHT40'],
+                    $avgSensors['avg_room_pressure_BMP280'],
+                    $longTermSensorId
                 );
-                if (!$stmtUpdateLongTermContainer->execute()) {
-                    throw new Exception("Execution failed for updating long_term_container_data: " . $stmtUpdateLongTermContainer->error);
+                if (!$stmtUpdateLongTermSensor->execute()) {
+                    throw new Exception("Execution failed for updating long_term_sensor_data: " . $stmtUpdateLongTermSensor->error);
                 }
-                $stmtUpdateLongTermContainer->close();
+                $stmtUpdateLongTermSensor->close();
             } else {
                 // Entry does not exist, perform insert
-                $stmtInsertLongTermContainer = $conn->prepare("
-                    INSERT INTO long_term_container_data (sensor_data_id, container_id, humidity_tgt, humidity_raw, humidity_pct, pump_ml_added)
+                $stmtInsertLongTermSensor = $conn->prepare("
+                    INSERT INTO long_term_sensor_data (date_time, cpu_temp, room_temp_SHT40, room_temp_BMP280, room_humidity_SHT40, room_pressure_BMP280)
                     VALUES (?, ?, ?, ?, ?, ?)
                 ");
-                if (!$stmtInsertLongTermContainer) {
-                    throw new Exception("Prepare failed for inserting into long_term_container_data: " . $conn->error);
+                if (!$stmtInsertLongTermSensor) {
+                    throw new Exception("Prepare failed for inserting into long_term_sensor_data: " . $conn->error);
                 }
-                $stmtInsertLongTermContainer->bind_param(
-                    "isdddi",
-                    $longTermSensorId,
-                    $container_id,
-                    $avg_humidity_tgt,
-                    $avg_humidity_raw,
-                    $avg_humidity_pct,
-                    $pump_ml_added
+                $stmtInsertLongTermSensor->bind_param(
+                    "sddddd",
+                    $hour_start,
+                    $avgSensors['avg_cpu_temp'],
+                    $avgSensors['avg_room_temp_SHT40'],
+                    $avgSensors['avg_room_temp_BMP280'],
+                    $avgSensors['avg_room_humidity_SHT40'],
+                    $avgSensors['avg_room_pressure_BMP280']
                 );
-                if (!$stmtInsertLongTermContainer->execute()) {
-                    throw new Exception("Execution failed for inserting into long_term_container_data: " . $stmtInsertLongTermContainer->error);
+                if (!$stmtInsertLongTermSensor->execute()) {
+                    throw new Exception("Execution failed for inserting into long_term_sensor_data: " . $stmtInsertLongTermSensor->error);
+                }
+                $longTermSensorId = $conn->insert_id;
+                $stmtInsertLongTermSensor->close();
+            }
+            $stmtCheckLongTermSensor->close();
+
+            /**
+             * 5. Retrieve all short_term_sensor_data IDs for the specified hour
+             */
+            $stmtGetShortTermIds = $conn->prepare("
+                SELECT id FROM short_term_sensor_data
+                WHERE date_time >= ? AND date_time < ?
+            ");
+            if (!$stmtGetShortTermIds) {
+                throw new Exception("Prepare failed for retrieving short_term_sensor_data IDs: " . $conn->error);
+            }
+            $stmtGetShortTermIds->bind_param("ss", $hour_start, $hour_end);
+            if (!$stmtGetShortTermIds->execute()) {
+                throw new Exception("Execution failed for retrieving short_term_sensor_data IDs: " . $stmtGetShortTermIds->error);
+            }
+            $resultShortTermIds = $stmtGetShortTermIds->get_result();
+            $shortTermIds = [];
+            while ($row = $resultShortTermIds->fetch_assoc()) {
+                $shortTermIds[] = $row['id'];
+            }
+            $stmtGetShortTermIds->close();
+
+            if (empty($shortTermIds)) {
+                throw new Exception("No short-term sensor data IDs found for the specified hour.");
+            }
+
+            // Prepare a comma-separated list of IDs for SQL IN clause
+            $shortTermIdsPlaceholders = implode(',', array_fill(0, count($shortTermIds), '?'));
+            $shortTermIdsTypes = str_repeat('i', count($shortTermIds));
+
+            /**
+             * 6. Calculate averages for container data
+             */
+            // Prepare the SQL statement to retrieve container averages and latest pump_ml_added
+            $sqlContainer = "
+                SELECT
+                    sc.container_id,
+                    AVG(sc.humidity_tgt) AS avg_humidity_tgt,
+                    AVG(sc.humidity_raw) AS avg_humidity_raw,
+                    AVG(sc.humidity_pct) AS avg_humidity_pct,
+                    sc_latest.pump_ml_added
+                FROM short_term_container_data sc
+                INNER JOIN (
+                    SELECT sc1.container_id, sc1.pump_ml_added
+                    FROM short_term_container_data sc1
+                    INNER JOIN short_term_sensor_data sss1 ON sc1.sensor_data_id = sss1.id
+                    WHERE sss1.date_time >= ? AND sss1.date_time < ?
+                    ORDER BY sc1.container_id, sc1.id DESC
+                ) sc_latest ON sc.container_id = sc_latest.container_id
+                INNER JOIN short_term_sensor_data sss ON sc.sensor_data_id = sss.id
+                WHERE sc.sensor_data_id IN (" . $shortTermIdsPlaceholders . ")
+                AND sss.date_time >= ? AND sss.date_time < ?
+                GROUP BY sc.container_id
+            ";
+
+            $stmtContainer = $conn->prepare($sqlContainer);
+            if (!$stmtContainer) {
+                throw new Exception("Prepare failed for retrieving container data: " . $conn->error);
+            }
+
+            // Bind parameters
+            $bindTypes = 'ss' . $shortTermIdsTypes . 'ss';
+            $bindParams = array_merge([$hour_start, $hour_end], $shortTermIds, [$hour_start, $hour_end]);
+
+            // Use references for bind_param
+            $bindParamsRefs = [];
+            foreach ($bindParams as $key => $value) {
+                $bindParamsRefs[$key] = &$bindParams[$key];
+            }
+
+            // Call bind_param dynamically
+            call_user_func_array([$stmtContainer, 'bind_param'], array_merge([$bindTypes], $bindParamsRefs));
+
+            if (!$stmtContainer->execute()) {
+                throw new Exception("Execution failed for retrieving container data: " . $stmtContainer->error);
+            }
+
+            $resultContainer = $stmtContainer->get_result();
+            if ($resultContainer->num_rows === 0) {
+                // Records of the hour without any container reading so far
+                $stmtContainer->close();
+                continue;
+            }
+
+            /**
+             * 7. Insert or Update long_term_container_data
+             */
+            while ($row = $resultContainer->fetch_assoc()) {
+                $container_id = $row['container_id'];
+                $avg_humidity_tgt = floatval($row['avg_humidity_tgt']);
+                $avg_humidity_raw = floatval($row['avg_humidity_raw']);
+                $avg_humidity_pct = floatval($row['avg_humidity_pct']);
+                $pump_ml_added = intval($row['pump_ml_added']);
+
+                // Check if an entry for this sensor_data_id and container_id exists
+                $stmtCheckLongTermContainer = $conn->prepare("
+                    SELECT id FROM long_term_container_data
+                    WHERE sensor_data_id = ? AND container_id = ?
+                ");
+                if (!$stmtCheckLongTermContainer) {
+                    throw new Exception("Prepare failed for checking long_term_container_data: " . $conn->error);
+                }
+                $stmtCheckLongTermContainer->bind_param("is", $longTermSensorId, $container_id);
+                if (!$stmtCheckLongTermContainer->execute()) {
+                    throw new Exception("Execution failed for checking long_term_container_data: " . $stmtCheckLongTermContainer->error);
+                }
+                $resultCheckLongTermContainer = $stmtCheckLongTermContainer->get_result();
+
+                if ($resultCheckLongTermContainer->num_rows > 0) {
+                    // Entry exists, perform update
+                    $longTermContainerId = $resultCheckLongTermContainer->fetch_assoc()['id'];
+                    $stmtUpdateLongTermContainer = $conn->prepare("
+                        UPDATE long_term_container_data
+                        SET humidity_tgt = ?, humidity_raw = ?, humidity_pct = ?, pump_ml_added = ?
+                        WHERE id = ?
+                    ");
+                    if (!$stmtUpdateLongTermContainer) {
+                        throw new Exception("Prepare failed for updating long_term_container_data: " . $conn->error);
+                    }
+                    $stmtUpdateLongTermContainer->bind_param(
+                        "dddii",
+                        $avg_humidity_tgt,
+                        $avg_humidity_raw,
+                        $avg_humidity_pct,
+                        $pump_ml_added,
+                        $longTermContainerId
+                    );
+                    if (!$stmtUpdateLongTermContainer->execute()) {
+                        throw new Exception("Execution failed for updating long_term_container_data: " . $stmtUpdateLongTermContainer->error);
+                    }
+                    $stmtUpdateLongTermContainer->close();
+                } else {
+                    // Entry does not exist, perform insert
+                    $stmtInsertLongTermContainer = $conn->prepare("
+                        INSERT INTO long_term_container_data (sensor_data_id, container_id, humidity_tgt, humidity_raw, humidity_pct, pump_ml_added)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ");
+                    if (!$stmtInsertLongTermContainer) {
+                        throw new Exception("Prepare failed for inserting into long_term_container_data: " . $conn->error);
+                    }
+                    $stmtInsertLongTermContainer->bind_param(
+                        "isdddi",
+                        $longTermSensorId,
+                        $container_id,
+                        $avg_humidity_tgt,
+                        $avg_humidity_raw,
+                        $avg_humidity_pct,
+                        $pump_ml_added
+                    );
+                    if (!$stmtInsertLongTermContainer->execute()) {
+                        throw new Exception("Execution failed for inserting into long_term_container_data: " . $stmtInsertLongTermContainer->error);
+                    }
+                    $stmtInsertLongTermContainer->close();
                 }
-                $stmtInsertLongTermContainer->close();
+                $stmtCheckLongTermContainer->close();
             }
-            $stmtCheckLongTermContainer->close();
+            $stmtContainer->close();
         }
-        $stmtContainer->close();
 
         /**
          * Commit the transaction after successful operations
@@ -417,8 +455,8 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
         $conn->close();
 
         // Respond with success
-        log_message("Data inserted successfully for client IP: $client_ip");
-        echo json_encode(["status" => "success", "message" => "Data inserted successfully"]);
+        log_message(count($records) . " record(s) inserted successfully for client IP: $client_ip");
+        echo json_encode(["status" => "success", "message" => "Data inserted successfully", "records" => count($records)]);
     } catch (Exception $e) {
         // Rollback the transaction on error
         $conn->rollback();
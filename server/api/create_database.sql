@@ -22,6 +22,8 @@ CREATE TABLE short_term_container_data (
 );
 
 -- Long-Term Main Sensor Data Table
+-- One row per hour. samples and the *_sum columns are the running totals
+-- the averages are computed from by the Python ingestion service.
 CREATE TABLE long_term_sensor_data (
     id INT AUTO_INCREMENT PRIMARY KEY,
     date_time DATETIME NOT NULL,
@@ -29,7 +31,13 @@ CREATE TABLE long_term_sensor_data (
     room_temp_SHT40 FLOAT NOT NULL,
     room_temp_BMP280 FLOAT NOT NULL,
     room_humidity_SHT40 FLOAT NOT NULL,
-    room_pressure_BMP280 FLOAT NOT NULL
+    room_pressure_BMP280 FLOAT NOT NULL,
+    samples INT NOT NULL DEFAULT 0,
+    cpu_temp_sum DOUBLE NOT NULL DEFAULT 0,
+    room_temp_SHT40_sum DOUBLE NOT NULL DEFAULT 0,
+    room_temp_BMP280_sum DOUBLE NOT NULL DEFAULT 0,
+    room_humidity_SHT40_sum DOUBLE NOT NULL DEFAULT 0,
+    room_pressure_BMP280_sum DOUBLE NOT NULL DEFAULT 0
 );
 
 -- Long-Term Container-Specific Data Table
@@ -41,6 +49,11 @@ CREATE TABLE long_term_container_data (
     humidity_raw FLOAT NOT NULL,
     humidity_pct FLOAT NOT NULL,
     pump_ml_added INT NOT NULL,
+    pump_ml_date_time DATETIME NULL,
+    samples INT NOT NULL DEFAULT 0,
+    humidity_tgt_sum DOUBLE NOT NULL DEFAULT 0,
+    humidity_raw_sum DOUBLE NOT NULL DEFAULT 0,
+    humidity_pct_sum DOUBLE NOT NULL DEFAULT 0,
     FOREIGN KEY (sensor_data_id) REFERENCES long_term_sensor_data(id) ON DELETE CASCADE
 );
 
@@ -55,11 +68,13 @@ CREATE INDEX idx_short_term_container_sensor_container ON short_term_container_d
 
 -- long_term_sensor_data
 CREATE INDEX idx_long_term_sensor_date_time ON long_term_sensor_data(date_time);
+CREATE UNIQUE INDEX uq_long_term_sensor_date_time ON long_term_sensor_data(date_time);
 
 -- long_term_container_data
 CREATE INDEX idx_long_term_container_sensor_id ON long_term_container_data(sensor_data_id);
 CREATE INDEX idx_long_term_container_container_id ON long_term_container_data(container_id);
 CREATE INDEX idx_long_term_container_sensor_container ON long_term_container_data(sensor_data_id, container_id);
+CREATE UNIQUE INDEX uq_long_term_container_sensor_container ON long_term_container_data(sensor_data_id, container_id);
 
 -- verification 
 SHOW INDEX FROM short_term_sensor_data;
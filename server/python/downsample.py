@@ -0,0 +1,85 @@
+# Downsampling of chart series
+# Both functions take the x values (ascending) and y values of one series
+# and return the indices of the points to keep, first and last included, so
+# that the caller can pick the same points from any other column.
+
+
+def min_max(xs, ys, points):
+    """First, last and the min and max of equal-width x buckets.
+
+    Keeps every spike, at most points indices.
+    """
+    n = len(xs)
+    if n <= points:
+        return list(range(n))
+    if points < 4:
+        return largest_triangle(xs, ys, points)
+
+    buckets = (points - 2) // 2
+    x_start = xs[0]
+    width = (xs[-1] - x_start) / buckets or 1
+    keep = [0]
+    i = 1
+    for bucket in range(buckets):
+        bucket_end = x_start + (bucket + 1) * width
+        low = high = None
+        while i < n - 1 and (xs[i] < bucket_end or bucket == buckets - 1):
+            if ys[i] is not None:
+                if low is None or ys[i] < ys[low]:
+                    low = i
+                if high is None or ys[i] > ys[high]:
+                    high = i
+            i += 1
+        if low is not None:
+            keep.extend(sorted({low, high}))
+    keep.append(n - 1)
+    return keep
+
+
+def largest_triangle(xs, ys, points):
+    """Largest-Triangle-Three-Buckets (Steinarsson, 2013).
+
+    Keeps points indices that preserve the visual shape of the series.
+    None values are never picked, except as first or last point.
+    """
+    n = len(xs)
+    if n <= points:
+        return list(range(n))
+    if points < 3:
+        # No bucket between the first and last points
+        return [0, n - 1][:points]
+
+    every = (n - 2) / (points - 2)
+    keep = [0]
+    a = 0
+    for bucket in range(points - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        # Average of the next bucket, the third point of the triangles
+        next_start = end
+        next_end = min(int((bucket + 2) * every) + 1, n)
+        next_values = [(xs[j], ys[j]) for j in range(next_start, next_end) if ys[j] is not None]
+        if not next_values:
+            next_values = [(xs[n - 1], ys[n - 1] if ys[n - 1] is not None else 0.0)]
+        avg_x = sum(x for x, _ in next_values) / len(next_values)
+        avg_y = sum(y for _, y in next_values) / len(next_values)
+
+        ax = xs[a]
+        ay = ys[a] if ys[a] is not None else avg_y
+        best = None
+        best_area = -1.0
+        for j in range(start, end):
+            if ys[j] is None:
+                continue
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        if best is not None:
+            keep.append(best)
+            a = best
+    keep.append(n - 1)
+    return keep
+
+
+methods = {"minmax": min_max, "lttb": largest_triangle}
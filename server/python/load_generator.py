@@ -0,0 +1,369 @@
+# Fleet load generator for the upload endpoint
+# Simulates N controllers uploading their readings and measures what the
+# server sustains: requests and records per second, latency percentiles,
+# errors, and the records the devices could not get accepted in time.
+#
+# Every device behaves like raspberry/sendToServer.py: one record per
+# reading, built by its build_record() and posted in its build_payload()
+# over one keep-alive connection. Records the server did not accept stay queued
+# and go in the next request, up to batch_size records, so a slow server
+# sees growing batches as it would from the fleet. Device clocks are offset
+# by a few seconds, drift, and each reading starts a little late like the
+# scheduler jobs of the Pi. --speed compresses the reading interval: at
+# --speed 60 every device posts once per second, with record times still a
+# minute apart.
+#
+# Usage:
+#   python3 load_generator.py --stand-in --devices 10 50 100 --speed 60 --duration 30
+#   python3 load_generator.py --stand-in ingest --encoding telemetry --devices 100 200 --speed 60
+#   python3 load_generator.py --url http://server/api/api_store_data.php --api-key KEY --devices 20
+#
+# --stand-in starts store_service.py (the statements of api_store_data.php)
+# or, with --stand-in ingest, ingest_service.py on a temporary SQLite
+# database for the run. Several --devices values run one step each, one
+# after another, against the same database. --encoding telemetry posts the
+# binary batches of raspberry/telemetry.py, which only ingest_service.py
+# accepts.
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+# The records, payloads and telemetry encoder are the ones of the Pi
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "raspberry"))
+try:
+    import sendToServer
+except ImportError:
+    sendToServer = None
+try:
+    import telemetry
+except ImportError:
+    telemetry = None
+
+# Containers of every device, with the targets and sensor range of zones.json
+containers = {"A1": 0.8, "A2": 0.8, "A3": 0.8, "B1": 0.4, "B2": 0.4, "B3": 0.4}
+sensor_dry = 0.9
+sensor_wet = 0.55
+# Reading interval of the Pi (seconds)
+reading_interval = 60
+# Max records per request, as upload_batch_size of sendToServer.py
+batch_size = 60
+# Connect and read timeout of one request (seconds)
+request_timeout = 30
+# Device clocks: offset from the real time (seconds), drift (ppm), and
+# lateness of each reading (mean seconds, exponentially distributed)
+clock_offset = 5.0
+clock_drift_ppm = 50.0
+reading_lateness = 0.3
+# Latency percentiles reported
+percentiles = (50, 90, 99)
+# Services started by --stand-in
+stand_in_scripts = {"store": "store_service.py", "ingest": "ingest_service.py"}
+
+
+def build_record(reading_time, state):
+    """Record of one reading, from build_record() of sendToServer.py."""
+    # Stand-ins for the EnviroSnapshot of helpers.py and the PumpHistory
+    enviro = SimpleNamespace(
+        datetime_utc_string=datetime.fromtimestamp(reading_time, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        cpu_temp=round(state["cpu_temp"], 1),
+        room_temp_SHT40=state["room_temp"],
+        room_temp_BMP280=state["room_temp"] + 0.3,
+        room_humidity_SHT40=state["room_humidity"],
+        room_pressure_BMP280=state["room_pressure"])
+    values = {c_id: {"tgt": target,
+                     "raw": round(sensor_dry - state["pct"][c_id] * (sensor_dry - sensor_wet), 4),
+                     "pct": round(state["pct"][c_id], 4)}
+              for c_id, target in containers.items()}
+    pump_history = SimpleNamespace(total_ml=state["total_ml"].get)
+    return sendToServer.build_record(values, enviro, pump_history, containers)
+
+
+def build_payload(records, api_key):
+    """Payload of build_payload() of sendToServer.py, with api_key."""
+    return dict(sendToServer.build_payload(records), api_key=api_key)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+class Stats:
+    """Outcomes of the requests of one step, shared by the device threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.records = 0
+        self.errors = {}
+
+    def add(self, latency, records, error=None):
+        with self.lock:
+            self.latencies.append(latency)
+            if error is None:
+                self.records += records
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def take(self):
+        """Latencies, accepted records and errors since the last take()."""
+        with self.lock:
+            taken = (self.latencies, self.records, self.errors)
+            self.latencies, self.records, self.errors = [], 0, {}
+        return taken
+
+
+class Device(threading.Thread):
+    """One simulated controller with its own clock, readings and upload queue."""
+
+    def __init__(self, number, url, api_key, encoding, speed, epoch, stats, stop_event):
+        super().__init__(daemon=True)
+        self.number = number
+        self.epoch = epoch
+        self.url = urlparse(url)
+        self.api_key = api_key
+        self.encoding = encoding
+        self.speed = speed
+        self.stats = stats
+        self.stop_event = stop_event
+        self.random = random.Random(number)
+        self.offset = self.random.uniform(-clock_offset, clock_offset)
+        self.rate = speed * (1 + self.random.gauss(0, clock_drift_ppm) * 1e-6)
+        self.pending = []
+        self.connection = None
+        self.state = {
+            "cpu_temp": self.random.uniform(40, 55), "room_temp": self.random.uniform(18, 25),
+            "room_humidity": self.random.uniform(35, 60), "room_pressure": self.random.uniform(1000, 1025),
+            "pct": {c_id: self.random.uniform(target - 0.1, target + 0.1)
+                    for c_id, target in containers.items()},
+            "total_ml": {c_id: 0.0 for c_id in containers}}
+
+    def device_time(self, real_time):
+        return self.epoch + self.offset + (real_time - self.started) * self.rate
+
+    def step_state(self):
+        # Slow drift of the room, drying soil and a dose when below target
+        state = self.state
+        state["cpu_temp"] += self.random.gauss(0, 0.2)
+        state["room_temp"] += self.random.gauss(0, 0.05)
+        state["room_humidity"] += self.random.gauss(0, 0.1)
+        state["room_pressure"] += self.random.gauss(0, 0.05)
+        for c_id, target in containers.items():
+            pct = state["pct"][c_id] - abs(self.random.gauss(0.0005, 0.0005))
+            if pct < target:
+                state["total_ml"][c_id] += 10.0
+                pct += 0.02
+            state["pct"][c_id] = min(1.0, max(0.0, pct + self.random.gauss(0, 0.001)))
+
+    def post(self, records):
+        """Post records, return the error or None when they were accepted."""
+        if self.encoding == "telemetry":
+            body = telemetry.encode_batch([telemetry.record_row(record) for record in records])
+            headers = {"Content-Type": telemetry.content_type, "X-Api-Key": self.api_key}
+        else:
+            body = json.dumps(build_payload(records, self.api_key), allow_nan=False).encode()
+            headers = {"Content-Type": "application/json"}
+        try:
+            if self.connection is None:
+                connection_class = (http.client.HTTPSConnection if self.url.scheme == "https"
+                                    else http.client.HTTPConnection)
+                self.connection = connection_class(self.url.netloc, timeout=request_timeout)
+            self.connection.request("POST", self.url.path or "/", body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            return type(e).__name__
+        if response.status == 200:
+            return None
+        if response.status == 400:
+            # Dropped by the Pi, never retried
+            self.pending = self.pending[len(records):]
+        return f"http_{response.status}"
+
+    def run(self):
+        self.started = time.time()
+        # Devices were not all started at the same second of the minute
+        phase = self.random.uniform(0, reading_interval)
+        reading = 0
+        while not self.stop_event.is_set():
+            due = (self.started + (phase + reading * reading_interval) / self.rate
+                   + self.random.expovariate(1 / reading_lateness) / self.rate)
+            while self.pending and time.time() < due and not self.stop_event.is_set():
+                # Backlog left from a failed or partial upload
+                if not self.upload():
+                    break
+            if self.stop_event.wait(max(0.0, due - time.time())):
+                break
+            self.step_state()
+            self.pending.append(build_record(self.device_time(time.time()), self.state))
+            reading += 1
+            self.upload()
+        if self.connection is not None:
+            self.connection.close()
+
+    def upload(self):
+        records = self.pending[:batch_size]
+        start = time.perf_counter()
+        error = self.post(records)
+        self.stats.add(time.perf_counter() - start, len(records), error)
+        if error is None:
+            self.pending = self.pending[len(records):]
+        return error is None
+
+
+def run_step(num_devices, url, api_key, encoding, speed, epoch, duration, report_every):
+    """Run num_devices devices for duration seconds from the device time
+    epoch, return the step summary."""
+    stats = Stats()
+    stop_event = threading.Event()
+    devices = [Device(number, url, api_key, encoding, speed, epoch, stats, stop_event)
+               for number in range(num_devices)]
+    for device in devices:
+        device.start()
+
+    all_latencies = []
+    records = 0
+    errors = {}
+    started = time.time()
+    while True:
+        remaining = started + duration - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(report_every, remaining))
+        latencies, window_records, window_errors = stats.take()
+        all_latencies.extend(latencies)
+        records += window_records
+        for error, count in window_errors.items():
+            errors[error] = errors.get(error, 0) + count
+        latencies.sort()
+        backlog = sum(len(device.pending) for device in devices)
+        print(f"{num_devices:>5} devices {time.time() - started:>6.0f}s: "
+              f"{len(latencies) / report_every:>7.1f} req/s, {window_records / report_every:>7.1f} records/s, "
+              f"p50 {format_ms(percentile(latencies, 50))}, p99 {format_ms(percentile(latencies, 99))}, "
+              f"{sum(window_errors.values())} errors, {backlog} records waiting", flush=True)
+
+    stop_event.set()
+    for device in devices:
+        device.join(request_timeout)
+    latencies, window_records, window_errors = stats.take()
+    all_latencies.extend(latencies)
+    records += window_records
+    for error, count in window_errors.items():
+        errors[error] = errors.get(error, 0) + count
+
+    elapsed = time.time() - started
+    all_latencies.sort()
+    offered = num_devices * speed / reading_interval
+    summary = {"devices": num_devices, "seconds": round(elapsed, 1),
+               "offered_records_per_s": round(offered, 1),
+               "requests_per_s": round(len(all_latencies) / elapsed, 1),
+               "records_per_s": round(records / elapsed, 1),
+               "errors": errors,
+               "error_rate": round(sum(errors.values()) / len(all_latencies), 4) if all_latencies else 0.0,
+               "records_waiting": sum(len(device.pending) for device in devices),
+               "latency_max_ms": round(all_latencies[-1] * 1000, 1) if all_latencies else None}
+    for p in percentiles:
+        value = percentile(all_latencies, p)
+        summary[f"latency_p{p}_ms"] = None if value is None else round(value * 1000, 1)
+    return summary
+
+
+def format_ms(seconds):
+    return "    -" if seconds is None else f"{seconds * 1000:>5.0f}ms"
+
+
+def start_stand_in(service, database_path):
+    """Start store_service.py or ingest_service.py on a free port, return
+    the process and its URL."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), stand_in_scripts[service])
+    process = subprocess.Popen(
+        [sys.executable, script, "--db", database_path, "--port", "0", "--api-key", "local"],
+        stdout=subprocess.PIPE, text=True)
+    # "Serving <db> on port <port>"
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError("The stand-in server did not start")
+    port = int(line.split()[-1])
+    return process, f"http://127.0.0.1:{port}/api/api_store_data.php"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet load generator for the upload endpoint")
+    parser.add_argument("--url", help="upload endpoint, e.g. http://localhost:8081/api/api_store_data.php")
+    parser.add_argument("--api-key", default="local")
+    parser.add_argument("--stand-in", nargs="?", const="store", choices=list(stand_in_scripts),
+                        help="start store_service.py (default) or ingest_service.py "
+                             "on a temporary SQLite database")
+    parser.add_argument("--encoding", choices=["json", "telemetry"], default="json")
+    parser.add_argument("--devices", type=int, nargs="+", default=[10],
+                        help="number of devices, one step per value")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="reading interval compression, 60 = one reading per device per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per step")
+    parser.add_argument("--report", type=float, default=5, help="seconds between progress lines")
+    parser.add_argument("--output", help="JSON file of the step summaries")
+    args = parser.parse_args()
+    if not args.stand_in and not args.url:
+        parser.error("--url or --stand-in is required")
+    if sendToServer is None:
+        parser.error("needs raspberry/sendToServer.py and its dependencies (requests)")
+    if args.encoding == "telemetry" and telemetry is None:
+        parser.error("--encoding telemetry needs raspberry/telemetry.py")
+
+    stand_in = None
+    temporary_directory = None
+    url = args.url
+    api_key = args.api_key
+    if args.stand_in:
+        temporary_directory = tempfile.TemporaryDirectory()
+        stand_in, url = start_stand_in(args.stand_in, os.path.join(temporary_directory.name, "load.sqlite"))
+        api_key = "local"
+
+    summaries = []
+    # Each step continues the device time of the previous one, so that the
+    # steps store about the same number of rows per hour
+    epoch = time.time()
+    try:
+        for num_devices in args.devices:
+            summaries.append(run_step(num_devices, url, api_key, args.encoding, args.speed, epoch,
+                                      args.duration, args.report))
+            epoch += (args.duration + clock_offset) * args.speed + reading_interval
+    finally:
+        if stand_in is not None:
+            stand_in.terminate()
+            stand_in.wait()
+            temporary_directory.cleanup()
+
+    print(f"\n{'devices':>7} {'offered/s':>10} {'records/s':>10} {'req/s':>8} "
+          + " ".join(f"{'p' + str(p) + ' ms':>8}" for p in percentiles)
+          + f" {'max ms':>8} {'errors':>7} {'waiting':>8}")
+    for s in summaries:
+        print(f"{s['devices']:>7} {s['offered_records_per_s']:>10} {s['records_per_s']:>10} "
+              f"{s['requests_per_s']:>8} "
+              + " ".join(f"{s[f'latency_p{p}_ms']!s:>8}" for p in percentiles)
+              + f" {s['latency_max_ms']!s:>8} {sum(s['errors'].values()):>7} {s['records_waiting']:>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summaries, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Exercise the batched write path of ingest_service.py against SQLite:
+#   - the hourly averages of its running sums match the ones store_service.py
+#     recomputes from the short-term rows like api_store_data.php,
+#   - pump_ml_added is the one of the latest reading of the hour, also when
+#     an older reading is backfilled afterwards,
+#   - when the transaction of a group of requests fails, the requests are
+#     retried alone and only the failing one gets the error.
+
+import os
+import tempfile
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+
+from database import connect
+from ingest_service import IngestError, IngestService, container_average_columns, date_time_format
+from store_service import StoreService
+
+api_key = "test"
+# Short-term rows older than 48 hours are deleted, readings are kept recent
+hour = (datetime.now(timezone.utc) - timedelta(hours=3)).replace(minute=0, second=0, microsecond=0)
+
+
+def make_record(minute, value, pump_ml_added=0):
+    return {
+        "date_time": (hour + timedelta(minutes=minute)).strftime(date_time_format),
+        "cpu_temp": 40 + value, "room_temp_SHT40": 20 + value, "room_temp_BMP280": 21 + value,
+        "room_humidity_SHT40": 50 + value, "room_pressure_BMP280": 1000 + value,
+        "containers": [
+            {"container_id": c_id, "humidity_tgt": 30, "humidity_raw": 15000 + 100 * value + c_id,
+             "humidity_pct": 25 + value + c_id, "pump_ml_added": pump_ml_added + c_id}
+            for c_id in (1, 2)],
+    }
+
+
+def long_term(database):
+    sensor = database.query(
+        "SELECT date_time, cpu_temp, room_temp_SHT40, room_temp_BMP280, room_humidity_SHT40, "
+        "room_pressure_BMP280 FROM long_term_sensor_data ORDER BY date_time")
+    containers = database.query(
+        "SELECT s.date_time, c.container_id, c." + ", c.".join(container_average_columns)
+        + ", c.pump_ml_added FROM long_term_container_data c "
+        "JOIN long_term_sensor_data s ON c.sensor_data_id = s.id ORDER BY s.date_time, c.container_id")
+    return sensor, containers
+
+
+def assert_close(rows, expected_rows):
+    assert len(rows) == len(expected_rows), (rows, expected_rows)
+    for row, expected in zip(rows, expected_rows):
+        for value, expected_value in zip(row, expected):
+            if isinstance(expected_value, float):
+                assert abs(value - expected_value) < 1e-6, (row, expected)
+            else:
+                assert str(value) == str(expected_value), (row, expected)
+
+
+def check_averages(directory):
+    # Requests of one and several records, across two hours
+    payloads = [[make_record(5, 1, 10)], [make_record(20, 2, 20), make_record(35, 4, 30)],
+                [make_record(50, 3, 40)], [make_record(65, 7, 50), make_record(70, 8, 60)]]
+
+    store = StoreService(connect(os.path.join(directory, "store.sqlite"), check_same_thread=False), api_key)
+    ingest = IngestService(connect(os.path.join(directory, "ingest.sqlite"), check_same_thread=False), api_key)
+    ingest.start()
+    for records in payloads:
+        store.store({"api_key": api_key, "records": records})
+        assert ingest.ingest({"api_key": api_key, "records": records}) == len(records)
+
+    expected = long_term(store.database)
+    assert len(expected[0]) == 2 and len(expected[1]) == 4
+    # Backfilled reading older than the last one of the first hour
+    assert ingest.ingest({"api_key": api_key, "records": [make_record(1, 5, 1000)]}) == 1
+    ingest.stop()
+
+    sensor, containers = long_term(ingest.database)
+    first_hour = hour.strftime(date_time_format)
+    assert_close(sensor[1:], expected[0][1:])
+    assert_close([row[:-1] for row in containers if row[0] != first_hour],
+                 [row[:-1] for row in expected[1] if row[0] != first_hour])
+    # The first hour is averaged with the backfilled reading
+    store.store({"api_key": api_key, "records": [make_record(1, 5, 1000)]})
+    expected = long_term(store.database)
+    assert_close(sensor[:1], expected[0][:1])
+    assert_close([row[:-1] for row in containers], [row[:-1] for row in expected[1]])
+    # pump_ml_added comes from the latest reading of each hour, minutes 50
+    # and 70 (the join of the PHP query picks any reading of the hour)
+    assert [row[-1] for row in containers] == [41, 42, 61, 62], containers
+    print("Upserted averages match store_service.py")
+
+
+class FailingIngestService(IngestService):
+    """Fails any transaction with a reading at minute 13."""
+
+    def write(self, records):
+        if any(record["date_time"].endswith(":13:00") for record in records):
+            raise RuntimeError("Write failed")
+        super().write(records)
+
+
+def check_group_retry(directory):
+    ingest = FailingIngestService(
+        connect(os.path.join(directory, "retry.sqlite"), check_same_thread=False), api_key)
+    # Queued before the writer starts, so that they are committed as one group
+    futures = []
+    for minute in (10, 13, 16):
+        future = Future()
+        ingest.requests.put(([make_record(minute, 1)], future))
+        futures.append(future)
+    ingest.start()
+
+    for minute, future in zip((10, 13, 16), futures):
+        error = future.exception(5)
+        if minute == 13:
+            assert isinstance(error, IngestError) and error.status == 500, error
+        else:
+            assert error is None, error
+    ingest.stop()
+
+    stored = [row[0] for row in ingest.database.query(
+        "SELECT date_time FROM short_term_sensor_data ORDER BY date_time")]
+    assert stored == [(hour + timedelta(minutes=minute)).strftime(date_time_format)
+                      for minute in (10, 16)], stored
+    assert ingest.database.query("SELECT samples FROM long_term_sensor_data") == [(2,)]
+    print("Failed group retried one request at a time")
+
+
+def test():
+    with tempfile.TemporaryDirectory() as directory:
+        check_averages(directory)
+        check_group_retry(directory)
+    print("All ingestion tests passed")
+
+
+if __name__ == "__main__":
+    test()